@@ -0,0 +1,7 @@
+"""
+Benchmarks for fitapp's hot paths, run with ``run_benchmarks.py``.
+
+Each module is a suite with a ``run(options)`` function that returns a list
+of results, one dict per measured case, which the runner writes out as JSON
+so that they can be compared across releases.
+"""
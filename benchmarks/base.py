@@ -0,0 +1,156 @@
+"""
+Measurement helpers and a stub of the Fitbit API shared by the benchmarks.
+"""
+
+import gc
+import json
+import re
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2.7, peak memory isn't measured
+    tracemalloc = None
+
+import requests_mock
+
+from django.contrib.auth.models import User
+from django.db import connection
+
+from fitapp.models import UserFitbit
+
+
+# Any time series request of python-fitbit
+TIME_SERIES_URL = re.compile(
+    r'^https://api\.fitbit\.com/1/user/(?P<user>[^/]+)/(?P<resource>.+)'
+    r'/date/(?P<base_date>[^/]+)/(?P<end>[^/]+)\.json$')
+PERIOD_DAYS = {
+    '1d': 1, '7d': 7, '30d': 30, '1w': 7, '1m': 30, '3m': 91, '6m': 182,
+    '1y': 365, 'max': 3650,
+}
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def percentile(values, percent):
+    """Returns the nearest-rank percentile of a list of values"""
+    values = sorted(values)
+    rank = max(int(round(percent / 100.0 * len(values))), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+@contextmanager
+def measure(queries=False, memory=False):
+    """Measures the wall time of the block, and the number of database
+    queries it makes if ``queries`` is true, or its peak Python memory
+    allocation if ``memory`` is true (Python 3.4+).
+
+    Yields a dict that holds ``seconds``, ``queries`` and ``peak_memory_kb``
+    when the block is done. Logging queries and tracing memory slow the block
+    down, so measure time, queries and memory in separate runs.
+    """
+    result = {}
+    if queries:
+        # Log all queries, not just the last 9000
+        queries_log = connection.queries_log
+        force_debug_cursor = connection.force_debug_cursor
+        connection.queries_log = deque()
+        connection.force_debug_cursor = True
+    if memory and tracemalloc:
+        gc.collect()
+        tracemalloc.start()
+    try:
+        start = timer()
+        yield result
+        result['seconds'] = timer() - start
+    finally:
+        if memory and tracemalloc:
+            result['peak_memory_kb'] = (
+                tracemalloc.get_traced_memory()[1] // 1024)
+            tracemalloc.stop()
+        if queries:
+            result['queries'] = len(connection.queries_log)
+            connection.queries_log = queries_log
+            connection.force_debug_cursor = force_debug_cursor
+
+
+def run_case(setup, func, repeat):
+    """Runs ``func`` ``repeat`` times to time it, once to count its queries
+    and once to measure its memory, calling ``setup`` before each run.
+    Returns the median ``seconds`` and the time of each run as ``timings``,
+    ``queries``, ``peak_memory_kb``, and the value returned by the last run
+    of ``func`` as ``returned``.
+    """
+    runs = []
+    gc.collect()
+    for options in [{}] * repeat + [{'queries': True}, {'memory': True}]:
+        setup()
+        with measure(**options) as result:
+            returned = func()
+        runs.append(result)
+    timings = [r['seconds'] for r in runs[:repeat]]
+    return {
+        'seconds': median(timings),
+        'timings': timings,
+        'queries': runs[-2]['queries'],
+        'peak_memory_kb': runs[-1].get('peak_memory_kb'),
+        'returned': returned,
+    }
+
+
+def create_fitbit_user(name='benchmark'):
+    """Creates a user that is integrated with Fitbit"""
+    user = User.objects.create_user(name)
+    return UserFitbit.objects.create(
+        user=user, fitbit_user=name.upper(), access_token='access-' + name,
+        refresh_token='refresh-' + name, expires_at=time.time() + 10 ** 8)
+
+
+def synthetic_time_series(resource, start, days):
+    """Returns a Fitbit time series response for ``days`` days from
+    ``start``, with made up values
+    """
+    return {resource.replace('/', '-'): [
+        {'dateTime': (start + timedelta(days=i)).strftime('%Y-%m-%d'),
+         'value': str((i * 7919) % 20000)}
+        for i in range(days)
+    ]}
+
+
+def _time_series_response(request, context):
+    match = TIME_SERIES_URL.match(request.url)
+    base_date = match.group('base_date')
+    base_date = date.today() if base_date == 'today' else date(
+        *map(int, base_date.split('-')))
+    end = match.group('end')
+    if end in PERIOD_DAYS:
+        days = PERIOD_DAYS[end]
+        start = base_date - timedelta(days=days - 1)
+    else:
+        start = base_date
+        days = (date(*map(int, end.split('-'))) - base_date).days + 1
+    return json.dumps(
+        synthetic_time_series(match.group('resource'), start, days))
+
+
+@contextmanager
+def fitbit_stub():
+    """Serves synthetic time series data for any user, resource and period
+    from a stub of the Fitbit API, through requests-mock
+    """
+    with requests_mock.Mocker() as mocker:
+        mocker.get(TIME_SERIES_URL, text=_time_series_response)
+        yield mocker
@@ -0,0 +1,62 @@
+"""
+Ingestion throughput of the :func:`~fitapp.tasks.get_time_series_data` task.
+
+The task is run directly, against a stub of the Fitbit API that serves a day,
+a year or ten years of steps, first into an empty table (``insert``) and then
+again over the stored data (``update``). Each case reports the median time
+over ``--repeat`` runs, the rows ingested per second, the number of queries
+per task and per row, and the peak memory, see
+:func:`benchmarks.base.run_case`.
+"""
+
+from datetime import date, timedelta
+
+from django.core.cache import cache
+
+from fitapp.models import TimeSeriesData, TimeSeriesDataType
+from fitapp.tasks import get_time_series_data
+
+from .base import create_fitbit_user, fitbit_stub, run_case
+
+
+CASES = [('1 day', 1), ('1 year', 365), ('10 years', 3650)]
+QUICK_CASES = [('1 day', 1), ('1 month', 30)]
+START_DATE = date(2010, 1, 1)
+
+
+def run(options):
+    fbuser = create_fitbit_user()
+    steps = TimeSeriesDataType.objects.get(
+        category=TimeSeriesDataType.activities, resource='steps')
+    results = []
+    with fitbit_stub():
+        for case, days in QUICK_CASES if options.quick else CASES:
+            end_date = START_DATE + timedelta(days=days - 1)
+            for phase in ('insert', 'update'):
+                def setup():
+                    if phase == 'insert':
+                        TimeSeriesData.objects.filter(
+                            user=fbuser.user).delete()
+                    # Forget the rate limit and the task's lock
+                    cache.clear()
+
+                def ingest():
+                    get_time_series_data(
+                        fbuser.fitbit_user, steps.category, steps.resource,
+                        date=START_DATE, end_date=end_date)
+
+                result = run_case(setup, ingest, options.repeat)
+                assert TimeSeriesData.objects.filter(
+                    user=fbuser.user).count() == days
+                results.append({
+                    'benchmark': 'ingestion',
+                    'case': case,
+                    'phase': phase,
+                    'rows': days,
+                    'seconds': result['seconds'],
+                    'rows_per_sec': days / result['seconds'],
+                    'queries': result['queries'],
+                    'queries_per_row': result['queries'] / float(days),
+                    'peak_memory_kb': result['peak_memory_kb'],
+                })
+    return results
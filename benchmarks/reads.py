@@ -0,0 +1,115 @@
+"""
+Latency of reading stored data through the :func:`~fitapp.views.get_data`
+view, with :ref:`FITAPP_SUBSCRIBE` set.
+
+The time series table is seeded with five years of daily data of 30 types
+for ``--users`` users (100 by default, a year of data for 10 users with
+``--quick``). One of them then requests each ``period`` starting on the
+first day of their data, and ranges of a month, a year and five years, in
+the default and the columnar format. Each case reports the median, 50th and
+99th percentile response time, the number of queries and the size of the
+response.
+"""
+
+from datetime import date, timedelta
+import json
+
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.test.client import Client
+from django.test.utils import override_settings
+
+from fitapp.models import TimeSeriesData, TimeSeriesDataType
+from fitapp.utils import get_valid_periods
+
+from .base import create_fitbit_user, percentile, run_case
+
+
+TYPES = 30
+YEARS = 5
+QUICK_USERS = 10
+QUICK_YEARS = 1
+RANGES = [('1 month', 30), ('1 year', 365), ('5 years', 5 * 365)]
+FORMATS = [None, 'columnar']
+SAMPLE_REQUESTS = 100
+BATCH_SIZE = 5000
+
+
+def seed(users, types, start, days):
+    """Stores ``days`` days of data from ``start`` for each of the users and
+    types, in batches
+    """
+    batch = []
+    for user in users:
+        for resource_type in types:
+            for i in range(days):
+                batch.append(TimeSeriesData(
+                    user=user, resource_type=resource_type,
+                    date=start + timedelta(days=i),
+                    value=str((i * 7919 + user.pk) % 20000)))
+                if len(batch) == BATCH_SIZE:
+                    TimeSeriesData.objects.bulk_create(batch)
+                    batch = []
+    TimeSeriesData.objects.bulk_create(batch)
+
+
+def run(options):
+    users = QUICK_USERS if options.quick else options.users
+    years = QUICK_YEARS if options.quick else YEARS
+    days = years * 365
+    start = date.today() - timedelta(days=days - 1)
+
+    reader = create_fitbit_user('reader').user
+    reader.set_password('reader')
+    reader.save()
+    User.objects.bulk_create([
+        User(username='reads{}'.format(i)) for i in range(users - 1)])
+    steps = TimeSeriesDataType.objects.get(
+        category=TimeSeriesDataType.activities, resource='steps')
+    types = [steps] + list(TimeSeriesDataType.objects.exclude(
+        pk=steps.pk).order_by('pk')[:TYPES - 1])
+    seed(User.objects.order_by('pk'), types, start, days)
+
+    url = reverse('fitbit-data', args=['activities', 'steps'])
+    base_date = start.strftime('%Y-%m-%d')
+    cases = [(period, {'base_date': base_date, 'period': period})
+             for period in get_valid_periods()]
+    cases += [(case, {'base_date': base_date, 'end_date': (
+        start + timedelta(days=length - 1)).strftime('%Y-%m-%d')})
+        for case, length in RANGES if length <= days]
+
+    client = Client()
+    client.login(username=reader.username, password='reader')
+    results = []
+    with override_settings(FITAPP_SUBSCRIBE=True):
+        for case, params in cases:
+            for response_format in FORMATS:
+                if response_format:
+                    params = dict(params, format=response_format)
+
+                def get():
+                    response = client.get(url, params)
+                    assert response.status_code == 200, response
+                    return response
+
+                samples = max(options.repeat, SAMPLE_REQUESTS)
+                result = run_case(lambda: None, get, samples)
+                response = result['returned']
+                results.append({
+                    'benchmark': 'reads',
+                    'case': case,
+                    'format': response_format or 'default',
+                    'users': users,
+                    'types': len(types),
+                    'stored_rows': users * len(types) * days,
+                    'days': len(json.loads(
+                        response.content.decode('utf8'))['objects']),
+                    'requests': samples,
+                    'seconds': result['seconds'],
+                    'p50_ms': percentile(result['timings'], 50) * 1000,
+                    'p99_ms': percentile(result['timings'], 99) * 1000,
+                    'queries': result['queries'],
+                    'response_bytes': len(response.content),
+                    'peak_memory_kb': result['peak_memory_kb'],
+                })
+    return results
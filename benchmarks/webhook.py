@@ -0,0 +1,147 @@
+"""
+Throughput and latency of the :func:`~fitapp.views.update` subscriber view.
+
+Batches of 1 to 10,000 notifications are posted to the view, as a JSON body
+(``json``) and as a file upload (``file``), while its tasks are sent to an
+in-memory broker (``--broker memory``, the default) or run eagerly against a
+stub of the Fitbit API (``--broker eager``). Running the tasks is much slower
+than sending them, so eager batches are capped at 100 notifications and
+posted fewer times.
+
+Small batches are posted many times to get their latency percentiles. Each
+case reports the median, 50th and 99th percentile response time, the number
+of queries and tasks published per request, and the peak memory of a
+request.
+"""
+
+from contextlib import contextmanager
+from datetime import date, timedelta
+import json
+
+from celery import Celery, current_app
+from celery.app.task import Task
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.urlresolvers import reverse
+from django.test.client import BOUNDARY, Client, encode_multipart
+
+from .base import create_fitbit_user, fitbit_stub, percentile, run_case
+
+
+SIZES = [1, 10, 100, 1000, 10000]
+QUICK_SIZES = [1, 10, 100]
+EAGER_MAX_SIZE = 100
+# Post small batches enough times for their 99th percentile to mean something
+SAMPLE_UPDATES = 1000
+EAGER_SAMPLE_UPDATES = 100
+USERS = 100
+COLLECTION_TYPES = ['activities', 'foods', 'sleep', 'body']
+
+
+def notifications(owners, size):
+    """Returns ``size`` notifications for the last week, spread over the
+    owners and collection types
+    """
+    today = date.today()
+    return [{
+        'collectionType': COLLECTION_TYPES[i % len(COLLECTION_TYPES)],
+        'date': (today - timedelta(days=i % 7)).strftime('%Y-%m-%d'),
+        'ownerId': owners[i % len(owners)],
+        'ownerType': 'user',
+        'subscriptionId': str(i % len(owners)),
+    } for i in range(size)]
+
+
+def request_kwargs(updates, form):
+    """Returns the test client's post arguments for a batch of updates,
+    encoded once so that encoding isn't timed
+    """
+    body = json.dumps(updates).encode('utf8')
+    if form == 'file':
+        return {'data': encode_multipart(BOUNDARY, {
+            'updates': SimpleUploadedFile('updates.json', body)}),
+            # Not the client's MULTIPART_CONTENT, so it isn't encoded again
+            'content_type': 'multipart/form-data; boundary=' + BOUNDARY}
+    return {'data': body, 'content_type': 'application/json'}
+
+
+@contextmanager
+def count_published():
+    """Counts the tasks sent in the block, eagerly or not, by name"""
+    published = []
+    apply_async = Task.apply_async
+
+    def counting_apply_async(self, *args, **kwargs):
+        published.append(self.name)
+        return apply_async(self, *args, **kwargs)
+
+    Task.apply_async = counting_apply_async
+    try:
+        yield published
+    finally:
+        Task.apply_async = apply_async
+
+
+@contextmanager
+def celery_app(broker):
+    """Sends the tasks of the block to an in-memory broker, or runs them
+    eagerly
+    """
+    previous = current_app._get_current_object()
+    app = Celery('fitapp_benchmarks', broker='memory://')
+    app.conf.task_always_eager = broker == 'eager'
+    app.set_current()
+    try:
+        yield app
+    finally:
+        previous.set_current()
+
+
+def run(options):
+    owners = [create_fitbit_user('webhook{}'.format(i)).fitbit_user
+              for i in range(USERS)]
+    sizes = QUICK_SIZES if options.quick else SIZES
+    sample_updates = SAMPLE_UPDATES
+    if options.broker == 'eager':
+        sizes = [size for size in sizes if size <= EAGER_MAX_SIZE]
+        sample_updates = EAGER_SAMPLE_UPDATES
+    client = Client()
+    url = reverse('fitbit-update')
+    results = []
+    with fitbit_stub(), celery_app(options.broker) as app, \
+            count_published() as published:
+        for size in sizes:
+            updates = notifications(owners, size)
+            for form in ('json', 'file'):
+                kwargs = request_kwargs(updates, form)
+
+                def setup():
+                    if options.broker == 'memory':
+                        app.control.purge()
+                    # Forget the rate limits and the tasks' locks
+                    cache.clear()
+                    del published[:]
+
+                def post():
+                    response = client.post(url, **kwargs)
+                    assert response.status_code == 204, response
+                    return len(published)
+
+                samples = max(options.repeat, sample_updates // size)
+                result = run_case(setup, post, samples)
+                results.append({
+                    'benchmark': 'webhook',
+                    'case': '{} updates'.format(size),
+                    'form': form,
+                    'broker': options.broker,
+                    'updates': size,
+                    'requests': samples,
+                    'seconds': result['seconds'],
+                    'p50_ms': percentile(result['timings'], 50) * 1000,
+                    'p99_ms': percentile(result['timings'], 99) * 1000,
+                    'updates_per_sec': size / result['seconds'],
+                    'queries': result['queries'],
+                    'tasks': result['returned'],
+                    'peak_memory_kb': result['peak_memory_kb'],
+                })
+    return results
@@ -15,6 +15,10 @@ FITAPP_LOGOUT_REDIRECT = '/'
 
 # By default, don't subscribe to user data. Set this to true to subscribe.
 FITAPP_SUBSCRIBE = False
+# When FITAPP_SUBSCRIBE is False, the get_data view gives up on the Fitbit
+# API call after this many seconds and returns status code 106. None waits
+# as long as it takes.
+FITAPP_LIVE_DATA_TIMEOUT = 10
 # Only retrieve data for resources in FITAPP_SUBSCRIPTIONS. The default value
 # of none results in all subscriptions being retrieved. Override it to be an
 # OrderedDict of just the items you want retrieved, in the order you want them
@@ -29,8 +33,107 @@ FITAPP_SUBSCRIPTIONS = None
 
 # The initial delay (in seconds) when doing the historical data import
 FITAPP_HISTORICAL_INIT_DELAY = 10
-# The delay (in seconds) between items when doing requests
+# Deprecated and ignored, data is retrieved by priority instead (see
+# FITAPP_TASK_PRIORITIES). Setting it raises a DeprecationWarning.
 FITAPP_BETWEEN_DELAY = 5
+# The celery task priorities for retrieving data for today (or yesterday, to
+# allow for time zones), for the last FITAPP_RECENT_DAYS days, and for all
+# historical data. The defaults are suitable for RabbitMQ, where higher
+# numbers have higher priority. Redis gives lower numbers higher priority.
+FITAPP_TASK_PRIORITIES = {'today': 9, 'recent': 6, 'historical': 0}
+FITAPP_RECENT_DAYS = 7
+# The celery queues to send fitapp tasks to: 'realtime' for retrieving data
+# from subscription notifications, 'backfill' for importing historical data
+# and purging data, and 'subscriptions' for managing subscriptions and
+# refreshing tokens. None uses celery's default routing.
+FITAPP_QUEUES = {'realtime': None, 'backfill': None, 'subscriptions': None}
+
+# The refresh_expiring_tokens celery task refreshes access tokens that expire
+# within this many seconds, in batches of FITAPP_TOKEN_REFRESH_BATCH_SIZE
+# spread over the first half of this window.
+FITAPP_TOKEN_REFRESH_WINDOW = 60 * 60
+FITAPP_TOKEN_REFRESH_BATCH_SIZE = 100
+
+# Once a user's remaining Fitbit API quota drops below this fraction of their
+# rate limit, the remaining calls are spread out over the time until the rate
+# limit resets.
+FITAPP_RATE_LIMIT_THRESHOLD = 0.5
+
+# After FITAPP_CIRCUIT_BREAKER_THRESHOLD Fitbit server errors or timeouts in
+# a row, stop calling the Fitbit API for FITAPP_CIRCUIT_BREAKER_TIMEOUT
+# seconds, then let one call through to find out if it has recovered. None
+# disables the circuit breaker.
+FITAPP_CIRCUIT_BREAKER_THRESHOLD = 5
+FITAPP_CIRCUIT_BREAKER_TIMEOUT = 60
+
+# The number of connections the asyncio fetch engine makes to the Fitbit API
+# at the same time, across all users.
+FITAPP_FETCH_CONCURRENCY = 50
+
+# The number of threads the asyncio fetch engine stores data and refreshes
+# tokens in, each with its own database connection.
+FITAPP_FETCH_THREADS = 4
+
+# The dotted path of the class that fitapp's metrics are sent to, e.g.
+# 'fitapp.metrics.StatsdBackend', created with FITAPP_METRICS_OPTIONS as
+# keyword arguments. The default of None doesn't collect metrics.
+FITAPP_METRICS_BACKEND = None
+FITAPP_METRICS_OPTIONS = {}
+
+# The number of database queries that fitapp's hot paths may make, as a number
+# of queries plus a number of queries per row of data handled. The test suite
+# checks that the budgets hold, and when FITAPP_LOG_QUERY_BUDGETS is true,
+# paths that go over their budget are logged as a warning.
+FITAPP_QUERY_BUDGETS = {
+    'update': (2, 0),
+    'get_data': (3, 0),
+    'get_time_series_data': (10, 0),
+}
+FITAPP_LOG_QUERY_BUDGETS = False
+
+# The fraction of the executions of fitapp's celery tasks to profile, from 0
+# (the default, none) to 1 (all). The profiles are written as pstats files to
+# FITAPP_PROFILE_DIR, by default a fitapp-profiles directory in the system's
+# temporary directory.
+FITAPP_PROFILE_RATE = 0
+FITAPP_PROFILE_DIR = None
+
+# The reconcile_time_series_data celery task looks for and retrieves missing
+# data in the last FITAPP_RECONCILE_DAYS days.
+FITAPP_RECONCILE_DAYS = 30
+
+# The intraday time series to retrieve when a subscription notification is
+# received, as a dict of resource paths and their detail levels ('1min' or
+# '15min'), e.g. {'activities/steps': '1min', 'activities/heart': '1min'}.
+# Intraday data requires special access to the Fitbit API.
+FITAPP_INTRADAY_RESOURCES = {}
+
+# The archive_time_series_data celery task compacts the data of months that
+# ended more than this many days ago into one record per user, type and month.
+# The default of None doesn't archive any data.
+FITAPP_ARCHIVE_AFTER_DAYS = None
+
+# On PostgreSQL 12 and later, the time series data table can be partitioned by
+# date, every 'year' or 'month' (FITAPP_PARTITION_INTERVAL), with partitions
+# created FITAPP_PARTITIONS_AHEAD intervals in advance. When true while the
+# migrations are applied, the table is partitioned by a migration. To partition
+# it later, use the convert action of the fitapp_partitions command.
+FITAPP_PARTITION_TIME_SERIES = False
+FITAPP_PARTITION_INTERVAL = 'year'
+FITAPP_PARTITIONS_AHEAD = 2
+
+# When true, the logout view enqueues a task to delete all of the user's time
+# series data. The data is deleted FITAPP_PURGE_CHUNK_SIZE rows at a time,
+# waiting FITAPP_PURGE_DELAY seconds between chunks.
+FITAPP_PURGE_DATA = False
+FITAPP_PURGE_CHUNK_SIZE = 1000
+FITAPP_PURGE_DELAY = 0.1
+
+# The maximum number of objects the get_data view returns from the database in
+# a single response. When set, larger requests are paginated and a cursor for
+# the next page is included in the response meta. The default of None doesn't
+# limit the response size.
+FITAPP_MAX_PAGE_SIZE = None
 
 # The template to use when an unavoidable error occurs during Fitbit
 # integration.
@@ -0,0 +1,204 @@
+"""
+An asyncio engine that retrieves time series data for many users at once.
+
+Instead of waiting on one Fitbit API call at a time, like the
+:func:`~fitapp.tasks.get_time_series_data` task, the engine drives all of the
+API calls of a batch concurrently on one event loop, over a shared pool of
+:ref:`FITAPP_FETCH_CONCURRENCY` connections. Calls for the same user are made
+one at a time, and are spread out as the user's API quota runs low, like the
+tasks are (see :ref:`FITAPP_RATE_LIMIT_THRESHOLD`). The engine shares the
+circuit breaker of the tasks, see :func:`fitapp.utils.circuit_breaker`.
+
+The engine requires Python 3.5 or later and aiohttp, and is used by the
+:func:`~fitapp.tasks.get_time_series_data_batch` task and the
+:ref:`fitapp_fetch` command. Data is stored as it arrives. Storing data and
+refreshing tokens block, so they are done in a pool of
+:ref:`FITAPP_FETCH_THREADS` threads, leaving the event loop free to keep
+retrieving the data of the other users.
+"""
+
+import asyncio
+import time
+
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+from dateutil import parser
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections
+from fitbit import Fitbit
+
+from . import metrics, utils
+from .models import TimeSeriesDataType, UserFitbit
+
+
+SUCCESS = 'success'
+MAX_RETRIES = 3
+# Names of the python-fitbit exceptions for error statuses, so that failures
+# are reported the same way as by the tasks
+HTTP_ERRORS = {
+    400: 'HTTPBadRequest',
+    401: 'HTTPUnauthorized',
+    403: 'HTTPForbidden',
+    404: 'HTTPNotFound',
+    409: 'HTTPConflict',
+    429: 'HTTPTooManyRequests',
+}
+
+
+class FetchEngine(object):
+    """Retrieves and stores time series data for a batch of requests.
+
+    Each request is a ``(fitbit_user, category, resource, date, end_date)``
+    tuple, with the same meaning as the arguments of
+    :func:`~fitapp.tasks.get_time_series_data`: all data is retrieved if
+    ``date`` is ``None``, and only the data for ``date`` if ``end_date`` is
+    ``None``. Dates may be given as ``YYYY-MM-DD`` strings.
+    """
+
+    def __init__(self, concurrency=None, threads=None):
+        if aiohttp is None:
+            raise ImproperlyConfigured(
+                'The fetch engine requires the aiohttp package')
+        self.concurrency = concurrency or utils.get_setting(
+            'FITAPP_FETCH_CONCURRENCY')
+        self.threads = threads or utils.get_setting('FITAPP_FETCH_THREADS')
+
+    def run(self, requests):
+        """Retrieves the data of the requests on a new event loop, and
+        returns a Counter of the outcomes: ``'success'`` or the name of the
+        error, as for the :ref:`refresh_tokens` command.
+        """
+        loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        try:
+            return loop.run_until_complete(self.fetch_all(requests))
+        finally:
+            self.executor.shutdown()
+            loop.close()
+
+    async def in_thread(self, func, *args):
+        """Calls a blocking function in the engine's pool of threads"""
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, _call_and_close, func, args)
+
+    async def fetch_all(self, requests):
+        """Retrieves the data of the requests, see :meth:`run`"""
+        types = dict(
+            ((t.category, t.resource), t)
+            for t in TimeSeriesDataType.objects.all())
+        by_user = defaultdict(list)
+        outcomes = Counter()
+        for fitbit_user, cat, resource, date, end_date in requests:
+            _type = types.get((cat, resource))
+            if _type is None:
+                outcomes['DoesNotExist'] += 1
+                continue
+            by_user[fitbit_user].append((
+                _type, self.parse_date(date), self.parse_date(end_date)))
+
+        fbusers = list(
+            UserFitbit.objects.filter(fitbit_user__in=list(by_user))
+            .select_related('user'))
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            results = await asyncio.gather(*[
+                self.fetch_user(session, fbuser, by_user[fbuser.fitbit_user])
+                for fbuser in fbusers])
+        for result in results:
+            outcomes.update(result)
+        # Requests for users that are no longer integrated
+        missing = set(by_user) - set(fbuser.fitbit_user for fbuser in fbusers)
+        outcomes['DoesNotExist'] += sum(len(by_user[u]) for u in missing)
+        return +outcomes
+
+    async def fetch_user(self, session, fbuser, requests):
+        """Retrieves the data of one user's requests, one at a time"""
+        outcomes = Counter()
+        for _type, date, end_date in requests:
+            try:
+                if fbuser.expires_at < time.time():
+                    await self.in_thread(utils.refresh_access_token, fbuser)
+                data = await self.fetch(session, fbuser, _type, date, end_date)
+                if data is not None:
+                    await self.in_thread(
+                        utils.save_time_series_data, fbuser.user, _type, data)
+                outcomes[SUCCESS] += 1
+            except Exception as e:
+                outcomes[getattr(e, 'name', type(e).__name__)] += 1
+        return outcomes
+
+    async def fetch(self, session, fbuser, _type, date, end_date):
+        """Retrieves one time series, waiting for the user's quota as needed.
+
+        Returns the data, or ``None`` if the data doesn't exist for the user.
+        """
+        resource_path = _type.path()
+        url = '{0}/{1}/user/{2}/{3}/date/{4}/{5}.json'.format(
+            Fitbit.API_ENDPOINT, Fitbit.API_VERSION, fbuser.fitbit_user,
+            resource_path, date or 'today',
+            (end_date or date) if date else 'max')
+        headers = {'Authorization': 'Bearer ' + fbuser.access_token}
+        for retry in range(MAX_RETRIES + 1):
+            delay = utils.get_rate_limit_delay(fbuser.fitbit_user)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            utils.check_circuit()
+            start = metrics.timer()
+            try:
+                response = await session.get(url, headers=headers)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                utils.record_circuit_failure()
+                raise
+            async with response:
+                metrics.timing('api_latency', metrics.timer() - start)
+                metrics.increment('api_calls', status=response.status)
+                if response.status == 429:
+                    metrics.increment('api_rate_limited')
+                utils.save_rate_limit(fbuser.fitbit_user, response.headers)
+                if response.status >= 500:
+                    utils.record_circuit_failure()
+                else:
+                    utils.record_circuit_success()
+                if response.status == 200:
+                    data = await response.json(content_type=None)
+                    return data[resource_path.replace('/', '-')]
+                if response.status == 429 and retry < MAX_RETRIES:
+                    await asyncio.sleep(
+                        int(response.headers.get('Retry-After', 1)))
+                    continue
+                if response.status == 400 and (
+                        'elevation' in resource_path or
+                        'floors' in resource_path):
+                    # The data doesn't exist for this user
+                    return None
+                raise FetchError(response.status)
+
+    def parse_date(self, date):
+        if date and not hasattr(date, 'strftime'):
+            date = parser.parse(date)
+        return date.strftime('%Y-%m-%d') if date else None
+
+
+def _call_and_close(func, args):
+    try:
+        return func(*args)
+    finally:
+        # Each thread has its own database connection, which is closed like
+        # at the end of a request
+        close_old_connections()
+
+
+class FetchError(Exception):
+    """An error status from the Fitbit API"""
+
+    def __init__(self, status):
+        super(FetchError, self).__init__(status)
+        self.status = status
+        self.name = HTTP_ERRORS.get(status, 'HTTPServerError' if (
+            status >= 500) else 'HTTPBadRequest')
@@ -1,6 +1,7 @@
 from django import forms
 
 from . import utils
+from .models import IntradayTimeSeriesData
 
 
 INPUT_FORMATS = ['%Y-%m-%d']
@@ -35,3 +36,70 @@ class RangeForm(forms.Form):
                 'base_date': self.cleaned_data['base_date'],
                 'end_date': self.cleaned_data['end_date'],
             }
+
+
+class PageForm(forms.Form):
+    """Optional keyset pagination parameters for stored Fitbit data."""
+    limit = forms.IntegerField(min_value=1, required=False)
+    cursor = forms.CharField(required=False)
+
+    def clean_limit(self):
+        limit = self.cleaned_data['limit']
+        max_limit = utils.get_setting('FITAPP_MAX_PAGE_SIZE')
+        if max_limit is not None:
+            limit = min(limit or max_limit, max_limit)
+        return limit
+
+    def clean_cursor(self):
+        cursor = self.cleaned_data['cursor']
+        if not cursor:
+            return None
+        try:
+            return utils.decode_cursor(cursor)
+        except ValueError:
+            raise forms.ValidationError('Invalid cursor')
+
+    def get_page(self):
+        if self.is_valid():
+            return {
+                'limit': self.cleaned_data['limit'],
+                'cursor': self.cleaned_data['cursor'],
+            }
+
+
+class IntradayForm(forms.Form):
+    """Data necessary to request stored intraday data from a day."""
+    date = forms.DateField(input_formats=INPUT_FORMATS)
+    detail_level = forms.ChoiceField(
+        choices=IntradayTimeSeriesData.DETAIL_LEVEL_CHOICES, required=False)
+    start_time = forms.TimeField(input_formats=['%H:%M'], required=False)
+    end_time = forms.TimeField(input_formats=['%H:%M'], required=False)
+
+    def clean(self):
+        cleaned_data = super(IntradayForm, self).clean()
+        start_time = cleaned_data.get('start_time')
+        end_time = cleaned_data.get('end_time')
+        # time(0, 0) is falsy on Python 2, so compare with None
+        if start_time is not None and end_time is not None and \
+                start_time > end_time:
+            raise forms.ValidationError('The start time is after the end time')
+        return cleaned_data
+
+    def get_slice(self, detail_level):
+        """Returns the date, detail level, and first and last interval of the
+        requested data, defaulting to ``detail_level`` and the whole day.
+        """
+        if self.is_valid():
+            detail_level = self.cleaned_data['detail_level'] or detail_level
+            minutes = IntradayTimeSeriesData.DETAIL_LEVELS[detail_level]
+            start_time = self.cleaned_data['start_time']
+            end_time = self.cleaned_data['end_time']
+            return {
+                'date': self.cleaned_data['date'],
+                'detail_level': detail_level,
+                'start': (start_time.hour * 60 + start_time.minute) // minutes
+                if start_time is not None else 0,
+                'end': (end_time.hour * 60 + end_time.minute) // minutes
+                if end_time is not None else
+                IntradayTimeSeriesData.intervals(detail_level) - 1,
+            }
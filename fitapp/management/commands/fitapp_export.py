@@ -0,0 +1,175 @@
+"""
+This django management command exports stored time series data as CSV or
+newline delimited JSON (NDJSON), one row per user, data type and date, to
+stdout or to the file given with the ``--output`` option.
+
+Rows are streamed from the database, using a server-side cursor where the
+database supports it, so the command runs in constant memory regardless of
+the amount of data. The ``--chunk-size`` option controls how many rows are
+fetched from the database at a time (Django 2.0 and later). Months that have
+been archived are read one at a time and merged into the stream, with live
+rows taking precedence, as in the ``get_data`` view.
+
+The export can be narrowed with the ``--user`` (Django user ID), ``--type``
+(data type path, e.g. ``activities/steps``), ``--start-date`` and
+``--end-date`` options. ``--user`` and ``--type`` may be given more than
+once.
+"""
+
+import csv
+import django
+import heapq
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from six import string_types
+
+from fitapp.management.helpers import parse_date
+from fitapp.models import (
+    TimeSeriesData, TimeSeriesDataArchive, TimeSeriesDataType)
+
+
+FIELDS = ('user_id', 'type', 'date', 'value')
+
+
+class Command(BaseCommand):
+    help = """
+        Exports stored time series data as CSV or NDJSON
+    """
+
+    def add_arguments(self, parser):
+        # Named (optional) arguments
+        parser.add_argument(
+            '--format',
+            dest='format',
+            choices=['csv', 'ndjson'],
+            default='csv',
+            help='The output format, csv (the default) or ndjson',
+        )
+        parser.add_argument(
+            '--output',
+            dest='output',
+            default=None,
+            help='The file to write to, instead of stdout',
+        )
+        parser.add_argument(
+            '--user',
+            action='append',
+            dest='users',
+            type=int,
+            default=[],
+            help='Only export data for the user with this ID',
+        )
+        parser.add_argument(
+            '--type',
+            action='append',
+            dest='types',
+            default=[],
+            help='Only export data of this type, e.g. activities/steps',
+        )
+        parser.add_argument(
+            '--start-date',
+            dest='start_date',
+            type=parse_date,
+            default=None,
+            help='Only export data on or after this date (YYYY-MM-DD)',
+        )
+        parser.add_argument(
+            '--end-date',
+            dest='end_date',
+            type=parse_date,
+            default=None,
+            help='Only export data on or before this date (YYYY-MM-DD)',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            dest='chunk_size',
+            type=int,
+            default=2000,
+            help='The number of rows to fetch from the database at a time',
+        )
+
+    def handle(self, *args, **options):
+        # call_command passes the dates through as given
+        start_date, end_date = [
+            parse_date(d) if isinstance(d, string_types) else d
+            for d in (options['start_date'], options['end_date'])]
+        paths = dict(
+            (t.pk, t.path()) for t in TimeSeriesDataType.objects.all())
+        data = TimeSeriesData.objects.all()
+        archives = TimeSeriesDataArchive.objects.all()
+        if options['users']:
+            data = data.filter(user_id__in=options['users'])
+            archives = archives.filter(user_id__in=options['users'])
+        if options['types']:
+            type_ids = [pk for pk, path in paths.items()
+                        if path in options['types']]
+            unknown = set(options['types']) - set(paths.values())
+            if unknown:
+                raise CommandError('Unknown data types: {}'.format(
+                    ', '.join(sorted(unknown))))
+            data = data.filter(resource_type_id__in=type_ids)
+            archives = archives.filter(resource_type_id__in=type_ids)
+        if start_date:
+            data = data.filter(date__gte=start_date)
+            archives = archives.filter(month__gte=start_date.replace(day=1))
+        if end_date:
+            data = data.filter(date__lte=end_date)
+            archives = archives.filter(month__lte=end_date)
+        rows = data.order_by(
+            'user_id', 'resource_type_id', 'date'
+        ).values_list('user_id', 'resource_type_id', 'date', 'value')
+        archives = archives.order_by('user_id', 'resource_type_id', 'month')
+        # Only fetch the columns we need, in chunks, without caching
+        if django.VERSION >= (2, 0):
+            rows = rows.iterator(chunk_size=options['chunk_size'])
+        else:
+            rows = rows.iterator()
+        rows = merge_archived(rows, archives.iterator(), start_date, end_date)
+
+        output = open(options['output'], 'w') if options['output'] else None
+        try:
+            count = self.write(
+                output or self.stdout, options['format'], paths, rows)
+        finally:
+            if output:
+                output.close()
+        self.stderr.write('Exported {} rows'.format(count))
+
+    def write(self, output, fmt, paths, rows):
+        count = 0
+        if fmt == 'csv':
+            writer = csv.writer(output, lineterminator='\n')
+            writer.writerow(FIELDS)
+            for user_id, type_id, date, value in rows:
+                writer.writerow(
+                    (user_id, paths[type_id], date.isoformat(), value))
+                count += 1
+        else:
+            encoder = json.JSONEncoder(separators=(',', ':'))
+            for user_id, type_id, date, value in rows:
+                output.write(encoder.encode(dict(zip(FIELDS, (
+                    user_id, paths[type_id], date.isoformat(), value
+                )))) + '\n')
+                count += 1
+        return count
+
+
+def merge_archived(rows, archives, start=None, end=None):
+    """Merges the days of the archived months between ``start`` and ``end``
+    into the ordered rows of live data. Live rows take precedence over
+    archived days of the same date.
+    """
+    # Tag the rows so that a live row comes before an archived day of the
+    # same date, and both are never compared by value
+    live = ((user_id, type_id, date, 0, value)
+            for user_id, type_id, date, value in rows)
+    archived = (
+        (archive.user_id, archive.resource_type_id, date, 1, value)
+        for archive in archives for date, value in archive.days()
+        if (not start or date >= start) and (not end or date <= end))
+    last = None
+    for user_id, type_id, date, _, value in heapq.merge(live, archived):
+        if (user_id, type_id, date) != last:
+            last = (user_id, type_id, date)
+            yield user_id, type_id, date, value
@@ -0,0 +1,108 @@
+"""
+This django management command retrieves time series data from Fitbit for
+many users at once, with the asyncio fetch engine (see
+:mod:`fitapp.engine`), which requires Python 3.5 or later and aiohttp.
+
+By default all of the data of every type is retrieved for all users. This can
+be narrowed with the ``--user`` (Django user ID), ``--type`` (data type path,
+e.g. ``activities/steps``), ``--start-date`` and ``--end-date`` options.
+``--user`` and ``--type`` may be given more than once. The ``--concurrency``
+option sets the number of connections to the Fitbit API, by default
+:ref:`FITAPP_FETCH_CONCURRENCY`.
+"""
+
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from fitapp.management.helpers import parse_date, write_failures
+from fitapp.models import TimeSeriesDataType, UserFitbit
+
+
+class Command(BaseCommand):
+    help = """
+        Retrieves time series data from Fitbit for many users at once
+    """
+
+    def add_arguments(self, parser):
+        # Named (optional) arguments
+        parser.add_argument(
+            '--user',
+            action='append',
+            dest='users',
+            type=int,
+            default=[],
+            help='Only retrieve data for the user with this ID',
+        )
+        parser.add_argument(
+            '--type',
+            action='append',
+            dest='types',
+            default=[],
+            help='Only retrieve data of this type, e.g. activities/steps',
+        )
+        parser.add_argument(
+            '--start-date',
+            dest='start_date',
+            type=parse_date,
+            default=None,
+            help='Retrieve data from this date (YYYY-MM-DD)',
+        )
+        parser.add_argument(
+            '--end-date',
+            dest='end_date',
+            type=parse_date,
+            default=None,
+            help='Retrieve data through this date (YYYY-MM-DD)',
+        )
+        parser.add_argument(
+            '--concurrency',
+            dest='concurrency',
+            type=int,
+            default=None,
+            help='The number of connections to the Fitbit API',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            from fitapp.engine import FetchEngine
+        except SyntaxError:
+            raise CommandError('The fetch engine requires Python 3.5+')
+        if options['concurrency'] is not None and options['concurrency'] < 1:
+            raise CommandError('--concurrency must be >= 1')
+        try:
+            engine = FetchEngine(options['concurrency'])
+        except ImproperlyConfigured as e:
+            raise CommandError(str(e))
+        if options['end_date'] and not options['start_date']:
+            raise CommandError('--end-date requires --start-date')
+
+        types = TimeSeriesDataType.objects.all()
+        if options['types']:
+            types = [t for t in types if t.path() in options['types']]
+            unknown = set(options['types']) - set(t.path() for t in types)
+            if unknown:
+                raise CommandError('Unknown data types: {}'.format(
+                    ', '.join(sorted(unknown))))
+        fbusers = UserFitbit.objects.all()
+        if options['users']:
+            fbusers = fbusers.filter(user_id__in=options['users'])
+        requests = [
+            (fitbit_user, t.category, t.resource, options['start_date'],
+             options['end_date'])
+            for fitbit_user in fbusers.values_list('fitbit_user', flat=True)
+            for t in types
+        ]
+
+        start = time.time()
+        outcomes = engine.run(requests)
+        elapsed = time.time() - start
+
+        msg = 'Retrieved {}/{} time series in {:.1f}s ({:.1f}/s)'.format(
+            outcomes.pop('success', 0), len(requests), elapsed,
+            len(requests) / max(elapsed, 1e-6))
+        # Django 1.8 doesn't have the SUCCESS style, fallback to WARNING
+        success_style = getattr(self.style, 'SUCCESS', self.style.WARNING)
+        self.stdout.write(success_style(msg))
+        write_failures(self, 'Failed to retrieve {} time series', outcomes)
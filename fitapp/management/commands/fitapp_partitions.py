@@ -0,0 +1,97 @@
+"""
+This django management command manages the native range partitioning of the
+time series data table by date, on PostgreSQL 12 and later. It takes one of
+these actions:
+
+``list``
+    List the partitions of the table and their date ranges.
+
+``convert``
+    Convert the table into a partitioned table, with partitions for the
+    existing data and :ref:`FITAPP_PARTITIONS_AHEAD` intervals in the future.
+    The data is copied in a single transaction, which locks the table until
+    it is done. This is the way to partition the table once the ``fitapp``
+    migrations have been applied, see :ref:`FITAPP_PARTITION_TIME_SERIES`.
+
+``create``
+    Create the partitions for the next :ref:`FITAPP_PARTITIONS_AHEAD`
+    intervals. The ``fitapp.tasks.create_time_series_partitions`` celery task
+    does the same, to run periodically with celery beat.
+
+``detach``
+    Detach the partitions with data before the ``--before`` date from the
+    table, so that they can be archived or dropped without touching the rest
+    of the data. Use ``--drop`` to drop them too.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import NotSupportedError
+
+from fitapp import partitions
+from fitapp.management.helpers import parse_date
+
+
+class Command(BaseCommand):
+    help = """
+        Manages the partitioning of the time series data table on PostgreSQL
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'action',
+            choices=['list', 'convert', 'create', 'detach'],
+            help='The action to take',
+        )
+        # Named (optional) arguments
+        parser.add_argument(
+            '--before',
+            dest='before',
+            type=parse_date,
+            default=None,
+            help='Detach partitions with data before this date (YYYY-MM-DD)',
+        )
+        parser.add_argument(
+            '--drop',
+            action='store_true',
+            dest='drop',
+            default=False,
+            help='Drop the detached partitions',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            partitions.check_support()
+        except NotSupportedError as e:
+            raise CommandError(str(e))
+        action = options['action']
+        is_partitioned = partitions.is_partitioned()
+        if action == 'convert':
+            if is_partitioned:
+                raise CommandError('The table is already partitioned')
+            self.write_names('Created', partitions.convert())
+            return
+        if not is_partitioned:
+            raise CommandError(
+                'The table is not partitioned, use the convert action first')
+        if action == 'list':
+            for name, from_date, to_date in partitions.list_partitions():
+                if from_date is None:
+                    self.stdout.write('{} (default)'.format(name))
+                else:
+                    self.stdout.write('{} ({} - {})'.format(
+                        name, from_date, to_date))
+        elif action == 'create':
+            self.write_names('Created', partitions.create_partitions())
+        else:
+            if options['before'] is None:
+                raise CommandError('The detach action requires --before')
+            self.write_names('Detached', partitions.detach_partitions(
+                options['before'], drop=options['drop']))
+
+    def write_names(self, verb, names):
+        # Django 1.8 doesn't have the SUCCESS style, fallback to WARNING
+        success_style = getattr(self.style, 'SUCCESS', self.style.WARNING)
+        self.stdout.write(success_style('{} {} partitions'.format(
+            verb, len(names))))
+        for name in names:
+            self.stdout.write('    {}'.format(name))
@@ -0,0 +1,197 @@
+"""
+This django management command checks that every ``UserFitbit`` has exactly
+the Fitbit subscription that fitapp makes when a user integrates: to all
+collections, with the Django user ID as the subscription ID and
+:ref:`FITAPP_SUBSCRIBER_ID` as the subscriber. It takes one of these actions:
+
+``audit``
+    Report how many users are missing their subscription and how many have
+    stale subscriptions, e.g. for an old subscriber ID, without changing
+    anything. This is the default.
+
+``apply``
+    Create the missing subscriptions and delete the stale ones, which is
+    handy after changing the subscriber ID.
+
+Each user's subscriptions are listed once, from a listing cached for an hour
+(see :func:`fitapp.utils.get_subscriptions`), and only the calls needed to
+reach the desired state are made. Use ``--refresh`` to ignore the cached
+listings.
+
+Using the ``--concurrency`` option checks that many users at the same time,
+in a pool of threads, and the ``--rate`` option limits the number of Fitbit
+API calls per second across all of them.
+"""
+
+import threading
+import time
+
+from collections import Counter
+
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from fitapp import utils
+from fitapp.management.helpers import iter_pks, run_threaded, write_failures
+from fitapp.models import UserFitbit
+
+
+CHUNK_SIZE = 500
+OK = 'ok'
+CREATED = 'created'
+DELETED = 'deleted'
+
+
+class RateLimiter(object):
+    """Spaces out calls to at most ``rate`` per second, across threads"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_call = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Command(BaseCommand):
+    help = """
+        Audits or applies the Fitbit subscriptions of all users
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'action',
+            nargs='?',
+            choices=['audit', 'apply'],
+            default='audit',
+            help='Only report (audit, the default) or fix (apply) problems',
+        )
+        # Named (optional) arguments
+        parser.add_argument(
+            '--concurrency',
+            dest='concurrency',
+            type=int,
+            default=1,
+            help='The number of users to check at the same time',
+        )
+        parser.add_argument(
+            '--rate',
+            dest='rate',
+            type=float,
+            default=None,
+            help='The maximum number of Fitbit API calls per second',
+        )
+        parser.add_argument(
+            '--refresh',
+            action='store_true',
+            dest='refresh',
+            default=False,
+            help='List subscriptions from Fitbit instead of the cache',
+        )
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1:
+            raise CommandError('--concurrency must be >= 1')
+        if options['rate'] is not None and options['rate'] <= 0:
+            raise CommandError('--rate must be > 0')
+        self.apply = options['action'] == 'apply'
+        self.refresh = options['refresh']
+        try:
+            self.subscriber_id = utils.get_setting('FITAPP_SUBSCRIBER_ID')
+        except ImproperlyConfigured:
+            raise CommandError(
+                'FITAPP_SUBSCRIBER_ID must be set to check subscriptions')
+        self.limiter = RateLimiter(options['rate'])
+
+        outcomes = run_threaded(
+            self.sync, iter_pks(UserFitbit.objects.all(), CHUNK_SIZE),
+            options['concurrency'])
+
+        results = Counter()
+        checked = 0
+        start = time.time()
+        for outcome in outcomes:
+            checked += 1
+            if isinstance(outcome, tuple):
+                created, deleted = outcome
+                results[OK] += not created and not deleted
+                results[CREATED] += created
+                results[DELETED] += deleted
+            else:
+                results[outcome] += 1
+        elapsed = time.time() - start
+
+        msg = 'Checked {} users in {:.1f}s ({:.1f}/s)'.format(
+            checked, elapsed, checked / max(elapsed, 1e-6))
+        # Django 1.8 doesn't have the SUCCESS style, fallback to WARNING
+        success_style = getattr(self.style, 'SUCCESS', self.style.WARNING)
+        self.stdout.write(success_style(msg))
+        self.stdout.write('    Subscribed: {}'.format(results.pop(OK, 0)))
+        created = results.pop(CREATED, 0)
+        deleted = results.pop(DELETED, 0)
+        if self.apply:
+            self.stdout.write('    Created subscriptions: {}'.format(created))
+            self.stdout.write('    Deleted subscriptions: {}'.format(deleted))
+        else:
+            self.stdout.write('    Missing subscriptions: {}'.format(created))
+            self.stdout.write('    Stale subscriptions: {}'.format(deleted))
+        write_failures(self, 'Failed to check {} users', results)
+
+    def sync(self, pk):
+        """Check (and fix) one user's subscriptions, returning the number of
+        subscriptions created and deleted, or the name of the error
+        """
+        try:
+            fbuser = UserFitbit.objects.get(pk=pk)
+            if fbuser.expires_at < time.time():
+                utils.refresh_access_token(fbuser)
+            fb = utils.create_fitbit(**fbuser.get_user_data())
+            key = utils.SUBSCRIPTIONS_CACHE_KEY.format(fbuser.fitbit_user)
+            if self.refresh or cache.get(key) is None:
+                self.limiter.wait()
+            subscriptions = utils.get_subscriptions(
+                fb, fbuser.fitbit_user, refresh=self.refresh)
+            wanted, stale = self.diff(fbuser, subscriptions)
+            created = 0 if wanted else 1
+            if self.apply and (stale or created):
+                try:
+                    for sub in stale:
+                        self.limiter.wait()
+                        fb.subscription(sub['subscriptionId'],
+                                        sub['subscriberId'], method='DELETE')
+                    if created:
+                        self.limiter.wait()
+                        fb.subscription(fbuser.user_id, self.subscriber_id)
+                finally:
+                    utils.forget_subscriptions(fbuser.fitbit_user)
+            return created, len(stale)
+        except Exception as e:
+            return type(e).__name__
+
+    def diff(self, fbuser, subscriptions):
+        """Returns whether the user has the wanted subscription, and a list
+        of the user's other subscriptions
+        """
+        wanted, stale = False, []
+        for sub in subscriptions:
+            if not wanted and self.is_wanted(fbuser, sub):
+                wanted = True
+            else:
+                stale.append(sub)
+        return wanted, stale
+
+    def is_wanted(self, fbuser, sub):
+        if sub.get('collectionType', 'user') != 'user':
+            return False
+        if str(sub['subscriptionId']) != str(fbuser.user_id):
+            return False
+        # Without a subscriber ID, Fitbit uses the app's default subscriber
+        return self.subscriber_id is None or \
+            str(sub['subscriberId']) == str(self.subscriber_id)
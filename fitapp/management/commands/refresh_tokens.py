@@ -9,15 +9,29 @@ Using the ``--deauth`` option tells the command to remove the ``UserFitbit``
 object for any tokens that fail to refresh for whatever reason. This can be
 handy to prune ``UserFitbit`` objects that have somehow managed to get an
 invalid refresh token (an unrecoverable state).
+
+Using the ``--concurrency`` option runs that many refreshes at the same time,
+in a pool of threads, which greatly speeds up refreshing a large number of
+tokens. Each ``UserFitbit`` row is locked while its token is refreshed, so the
+refresh doesn't race with the fitapp celery tasks. Users are read from the
+database ``--chunk-size`` at a time, and progress is reported after each
+chunk.
 """
 
 import time
 
+from collections import Counter
+
 from django.core.management.base import BaseCommand, CommandError
 from oauthlib.oauth2.rfc6749.errors import InvalidGrantError
 
+from fitapp.management.helpers import iter_pks, run_threaded, write_failures
 from fitapp.models import UserFitbit
-from fitapp.utils import create_fitbit
+from fitapp.utils import refresh_access_token
+
+
+SUCCESS = 'success'
+DEAUTHED = 'deauthed'
 
 
 class Command(BaseCommand):
@@ -42,28 +56,67 @@ class Command(BaseCommand):
             default=False,
             help='Deauth (remove UserFitbit) when refresh token is invalid',
         )
+        parser.add_argument(
+            '--concurrency',
+            dest='concurrency',
+            type=int,
+            default=1,
+            help='The number of tokens to refresh at the same time',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            dest='chunk_size',
+            type=int,
+            default=500,
+            help='The number of users to read from the database at a time',
+        )
 
     def handle(self, *args, **options):
+        if options['concurrency'] < 1 or options['chunk_size'] < 1:
+            raise CommandError('--concurrency and --chunk-size must be >= 1')
+        self.deauth = options['deauth']
         user_fitbits = UserFitbit.objects.all()
         if not options['all']:
             user_fitbits = user_fitbits.filter(expires_at__lt=time.time())
-        success, failed = 0, 0
-        for user_fitbit in user_fitbits:
-            fitbit = create_fitbit(**user_fitbit.get_user_data())
-            try:
-                fitbit.client.refresh_token()
-                success += 1
-            except InvalidGrantError:
-                if options['deauth']:
-                    user_fitbit.delete()
-                failed += 1
-        msg = 'Successfully refreshed {} tokens'.format(success)
+
+        total = user_fitbits.count()
+        outcomes = run_threaded(
+            self.refresh, iter_pks(user_fitbits, options['chunk_size']),
+            options['concurrency'])
+
+        results = Counter()
+        start = time.time()
+        for done, outcome in enumerate(outcomes, 1):
+            results[outcome] += 1
+            if done % options['chunk_size'] == 0 or done == total:
+                self.stdout.write('Refreshed {}/{} tokens ({:.1f}/s)'.format(
+                    done, total, done / max(time.time() - start, 1e-6)))
+        elapsed = time.time() - start
+
+        refreshed = sum(results.values())
+        success = results.pop(SUCCESS, 0)
+        msg = 'Successfully refreshed {} tokens in {:.1f}s ({:.1f}/s)'.format(
+            success, elapsed, refreshed / max(elapsed, 1e-6))
         # Django 1.8 doesn't have the SUCCESS style, fallback to WARNING
         success_style = getattr(self.style, 'SUCCESS', self.style.WARNING)
         self.stdout.write(success_style(msg))
-        if failed > 0:
-            msg = 'Failed to refresh {} tokens'.format(failed)
-            self.stdout.write(self.style.ERROR(msg))
+        failures = Counter(dict(
+            (InvalidGrantError.__name__ if reason == DEAUTHED else reason,
+             count) for reason, count in results.items()))
+        write_failures(self, 'Failed to refresh {} tokens', failures)
         if options['deauth']:
-            msg = 'Deauthenticated {} users'.format(failed)
+            msg = 'Deauthenticated {} users'.format(results[DEAUTHED])
             self.stdout.write(self.style.NOTICE(msg))
+
+    def refresh(self, pk):
+        """Refresh one user's token, returning the outcome"""
+        try:
+            refresh_access_token(UserFitbit.objects.get(pk=pk))
+        except InvalidGrantError as e:
+            if self.deauth:
+                UserFitbit.objects.filter(pk=pk).delete()
+                return DEAUTHED
+            return type(e).__name__
+        except Exception as e:
+            return type(e).__name__
+        return SUCCESS
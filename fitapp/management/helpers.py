@@ -0,0 +1,78 @@
+"""
+Helpers shared by fitapp's management commands.
+"""
+
+import threading
+
+from datetime import datetime
+
+from django.db import connection
+from six.moves import queue
+
+
+def iter_pks(queryset, chunk_size):
+    """Yields the primary keys of a queryset in order, reading them from the
+    database ``chunk_size`` at a time
+    """
+    pks = queryset.order_by('pk').values_list('pk', flat=True)
+    chunk = list(pks[:chunk_size])
+    while chunk:
+        for pk in chunk:
+            yield pk
+        chunk = list(pks.filter(pk__gt=chunk[-1])[:chunk_size])
+
+
+def run_threaded(func, items, concurrency):
+    """Calls ``func`` with each of ``items``, in a pool of ``concurrency``
+    threads, yielding the results as they come in. Only a few items are
+    queued ahead of the threads, so ``items`` can be a long generator.
+    """
+    if concurrency <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    pending = queue.Queue(maxsize=concurrency * 2)
+    results = queue.Queue()
+
+    def worker():
+        try:
+            for item in iter(pending.get, None):
+                results.put(func(item))
+        finally:
+            # Each thread has its own database connection
+            connection.close()
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for item in items:
+        pending.put(item)
+        while not results.empty():
+            yield results.get()
+    for thread in threads:
+        pending.put(None)
+    for thread in threads:
+        thread.join()
+    while not results.empty():
+        yield results.get()
+
+
+def parse_date(value):
+    """Parses a YYYY-MM-DD command line option into a date"""
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def write_failures(command, message, failures):
+    """Writes ``message``, formatted with the number of failures, and the
+    count of each reason in ``failures``, a Counter, to the command's output.
+    Nothing is written if there are no failures.
+    """
+    failed = sum(failures.values())
+    if failed > 0:
+        command.stdout.write(command.style.ERROR(message.format(failed)))
+        for reason, count in sorted(failures.items()):
+            msg = '    {}: {}'.format(reason, count)
+            command.stdout.write(command.style.ERROR(msg))
+    return failed
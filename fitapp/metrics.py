@@ -0,0 +1,202 @@
+"""
+Counters and timers for fitapp's hot paths.
+
+The metrics are sent to the backend configured with
+:ref:`FITAPP_METRICS_BACKEND`, and aren't collected at all when no backend is
+configured. Each metric has a name and optional tags:
+
+    :api_calls: Counter of Fitbit API responses, tagged with their HTTP
+        ``status``.
+    :api_rate_limited: Counter of Fitbit API responses with status 429.
+    :api_latency: Timer of Fitbit API calls.
+    :token_refreshes: Counter of refreshed Fitbit tokens.
+    :rows_written: Counter of created or changed time series data rows,
+        tagged with the ``resource`` of the data. Rows that are retrieved
+        again without changes aren't counted.
+    :db_write: Timer of storing the data of an API call, tagged with the
+        ``resource`` of the data.
+    :notifications: Counter of subscription notifications received.
+    :tasks_dispatched: Counter of celery tasks sent for notifications, tagged
+        with the ``task`` name.
+    :get_data: Timer of the :func:`~fitapp.views.get_data` view.
+"""
+
+import threading
+import time
+
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from . import defaults
+
+
+timer = getattr(time, 'perf_counter', time.time)
+_backend = None
+_backend_loaded = False
+
+
+def get_backend():
+    """Returns the configured metrics backend, or ``None``"""
+    global _backend, _backend_loaded
+    if not _backend_loaded:
+        path = getattr(settings, 'FITAPP_METRICS_BACKEND',
+                       defaults.FITAPP_METRICS_BACKEND)
+        options = getattr(settings, 'FITAPP_METRICS_OPTIONS',
+                          defaults.FITAPP_METRICS_OPTIONS)
+        _backend = import_string(path)(**options) if path else None
+        _backend_loaded = True
+    return _backend
+
+
+@receiver(setting_changed)
+def reset_backend(setting, **kwargs):
+    """Loads the backend again when its settings change, in tests"""
+    global _backend, _backend_loaded
+    if setting in ('FITAPP_METRICS_BACKEND', 'FITAPP_METRICS_OPTIONS'):
+        _backend, _backend_loaded = None, False
+
+
+def increment(name, value=1, **tags):
+    """Adds ``value`` to a counter"""
+    backend = get_backend()
+    if backend is not None:
+        backend.increment(name, value, tags)
+
+
+def timing(name, seconds, **tags):
+    """Records a duration, in seconds"""
+    backend = get_backend()
+    if backend is not None:
+        backend.timing(name, seconds, tags)
+
+
+@contextmanager
+def timed(name, **tags):
+    """Records the duration of the block, even if it raises an exception"""
+    backend = get_backend()
+    if backend is None:
+        yield
+        return
+    start = timer()
+    try:
+        yield
+    finally:
+        backend.timing(name, timer() - start, tags)
+
+
+def timed_view(name):
+    """Decorator that records the duration of each call of a view"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            with timed(name):
+                return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class MemoryBackend(object):
+    """Keeps the metrics in memory, for tests"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forgets all of the metrics"""
+        self.counters = Counter()
+        self.timings = defaultdict(list)
+
+    def increment(self, name, value, tags):
+        self.counters[name, tuple(sorted(tags.items()))] += value
+
+    def timing(self, name, seconds, tags):
+        self.timings[name, tuple(sorted(tags.items()))].append(seconds)
+
+    def count(self, name, **tags):
+        """Returns the total of a counter over the tags that include
+        ``tags``
+        """
+        return sum(value for key, value in self.counters.items()
+                   if self._matches(key, name, tags))
+
+    def times(self, name, **tags):
+        """Returns the durations recorded for a timer with tags that include
+        ``tags``
+        """
+        return [seconds for key, durations in sorted(self.timings.items())
+                if self._matches(key, name, tags) for seconds in durations]
+
+    def _matches(self, key, name, tags):
+        return key[0] == name and set(tags.items()) <= set(key[1])
+
+
+class StatsdBackend(object):
+    """Sends the metrics to statsd, with the tags appended to their names,
+    e.g. ``fitapp.api_calls.200``. Requires the statsd package.
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='fitapp'):
+        try:
+            import statsd
+        except ImportError:
+            raise ImproperlyConfigured(
+                'The statsd metrics backend requires the statsd package')
+        self.client = statsd.StatsClient(host, port, prefix=prefix)
+
+    def increment(self, name, value, tags):
+        self.client.incr(self._stat(name, tags), value)
+
+    def timing(self, name, seconds, tags):
+        self.client.timing(self._stat(name, tags), seconds * 1000)
+
+    def _stat(self, name, tags):
+        return '.'.join([name] + [
+            str(value).replace('.', '_').replace('/', '_')
+            for _, value in sorted(tags.items())])
+
+
+class PrometheusBackend(object):
+    """Exports the metrics to Prometheus, as counters and histograms with the
+    tags as labels. Requires the prometheus_client package, whose registry
+    should be exposed by the project.
+    """
+
+    def __init__(self, namespace='fitapp', registry=None):
+        try:
+            import prometheus_client
+        except ImportError:
+            raise ImproperlyConfigured(
+                'The Prometheus metrics backend requires the '
+                'prometheus_client package')
+        self.prometheus_client = prometheus_client
+        self.namespace = namespace
+        self.registry = registry or prometheus_client.REGISTRY
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name, value, tags):
+        self._metric(self.prometheus_client.Counter, name, tags).inc(value)
+
+    def timing(self, name, seconds, tags):
+        self._metric(self.prometheus_client.Histogram, name + '_seconds',
+                     tags).observe(seconds)
+
+    def _metric(self, metric_class, name, tags):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metric_class(
+                    name, 'fitapp {}'.format(name.replace('_', ' ')),
+                    sorted(tags), namespace=self.namespace,
+                    registry=self.registry)
+        if tags:
+            return metric.labels(**dict(
+                (key, str(value)) for key, value in tags.items()))
+        return metric
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import date
+
+from django.conf import settings
+from django.db import NotSupportedError, migrations
+from django.utils import timezone
+
+
+# The SQL of the conversion is frozen here, instead of using fitapp.partitions,
+# so that this migration does the same thing however the app changes later.
+# To partition the table after this migration has been applied, use the
+# convert action of the fitapp_partitions management command.
+
+
+def partition_ranges(table, start, end, interval):
+    if interval not in ('year', 'month'):
+        raise ValueError('Invalid partition interval: {}'.format(interval))
+    ranges = []
+    if interval == 'year':
+        from_date = date(start.year, 1, 1)
+    else:
+        from_date = date(start.year, start.month, 1)
+    while from_date <= end:
+        if interval == 'year':
+            name = '{}_y{:%Y}'.format(table, from_date)
+            to_date = date(from_date.year + 1, 1, 1)
+        else:
+            name = '{}_m{:%Y_%m}'.format(table, from_date)
+            to_date = date(from_date.year + from_date.month // 12,
+                           from_date.month % 12 + 1, 1)
+        ranges.append((name, from_date, to_date))
+        from_date = to_date
+    return ranges
+
+
+def future_end(interval, ahead):
+    today = timezone.now().date()
+    if interval == 'year':
+        return date(today.year + ahead, 1, 1)
+    month = today.month - 1 + ahead
+    return date(today.year + month // 12, month % 12 + 1, 1)
+
+
+def forwards(apps, schema_editor):
+    # Partitioning is optional, and only supported on PostgreSQL
+    connection = schema_editor.connection
+    if not getattr(settings, 'FITAPP_PARTITION_TIME_SERIES', False) or \
+            connection.vendor != 'postgresql':
+        return
+    connection.ensure_connection()
+    if connection.pg_version < 120000:
+        raise NotSupportedError(
+            'Partitioning requires PostgreSQL 12 or later')
+    interval = getattr(settings, 'FITAPP_PARTITION_INTERVAL', 'year')
+    ahead = getattr(settings, 'FITAPP_PARTITIONS_AHEAD', 2)
+
+    TimeSeriesData = apps.get_model('fitapp', 'TimeSeriesData')
+    table = TimeSeriesData._meta.db_table
+    new_table = '{}_new'.format(table)
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT 1 FROM pg_partitioned_table p
+            JOIN pg_class c ON c.oid = p.partrelid
+            WHERE c.relname = %s
+        """, [table])
+        if cursor.fetchone() is not None:
+            return
+        cursor.execute('LOCK TABLE {} IN EXCLUSIVE MODE'.format(qn(table)))
+        cursor.execute('SELECT MIN(date) FROM {}'.format(qn(table)))
+        start = cursor.fetchone()[0] or timezone.now().date()
+        cursor.execute(
+            'CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS) '
+            'PARTITION BY RANGE (date)'.format(qn(new_table), qn(table)))
+        for name, from_date, to_date in partition_ranges(
+                table, start, future_end(interval, ahead), interval):
+            cursor.execute(
+                'CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)'
+                .format(qn(name), qn(new_table)), [from_date, to_date])
+        cursor.execute('CREATE TABLE {} PARTITION OF {} DEFAULT'.format(
+            qn('{}_default'.format(table)), qn(new_table)))
+        cursor.execute('INSERT INTO {} SELECT * FROM {}'.format(
+            qn(new_table), qn(table)))
+        # Keep the ID sequence when the old table is dropped
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+        cursor.execute('ALTER SEQUENCE {} OWNED BY {}.id'.format(
+            cursor.fetchone()[0], qn(new_table)))
+        cursor.execute('DROP TABLE {}'.format(qn(table)))
+        cursor.execute('ALTER TABLE {} RENAME TO {}'.format(
+            qn(new_table), qn(table)))
+        # The partition key must be part of the primary key
+        cursor.execute('ALTER TABLE {} ADD PRIMARY KEY (id, date)'.format(
+            qn(table)))
+        cursor.execute(
+            'ALTER TABLE {} ADD UNIQUE (user_id, resource_type_id, date)'
+            .format(qn(table)))
+        cursor.execute('CREATE INDEX ON {} (resource_type_id)'.format(
+            qn(table)))
+        for field in ('user', 'resource_type'):
+            related = TimeSeriesData._meta.get_field(field).related_model
+            cursor.execute(
+                'ALTER TABLE {} ADD FOREIGN KEY ({}_id) REFERENCES {} (id) '
+                'DEFERRABLE INITIALLY DEFERRED'.format(
+                    qn(table), field, qn(related._meta.db_table)))
+
+
+def backwards(apps, schema_editor):
+    # Leave the table partitioned, it works the same either way
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fitapp', '0008_remove_userfitbit_auth_secret'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('fitapp', '0009_partition_timeseriesdata'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimeSeriesDataArchive',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(help_text='The first day of the month')),
+                ('values', models.TextField(help_text='A JSON array of the values of each day of the month, with null for the days without data')),
+                ('resource_type', models.ForeignKey(help_text='The type of time series data', on_delete=django.db.models.deletion.CASCADE, to='fitapp.TimeSeriesDataType')),
+                ('user', models.ForeignKey(help_text="The data's user", on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='timeseriesdataarchive',
+            unique_together=set([('user', 'resource_type', 'month')]),
+        ),
+    ]
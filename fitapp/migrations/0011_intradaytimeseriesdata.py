@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('fitapp', '0010_timeseriesdataarchive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IntradayTimeSeriesData',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource', models.CharField(help_text='The path of the intraday time series resource, for example "activities/steps" or "activities/heart"', max_length=128)),
+                ('date', models.DateField(help_text='The date the data was recorded')),
+                ('detail_level', models.CharField(choices=[('1min', '1min'), ('15min', '15min')], help_text='The length of each interval of the day', max_length=8)),
+                ('values', models.BinaryField(help_text='The value of each interval of the day, packed as little-endian 32-bit floats, with NaN for intervals without data')),
+                ('user', models.ForeignKey(help_text="The data's user", on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='intradaytimeseriesdata',
+            unique_together=set([('user', 'resource', 'date', 'detail_level')]),
+        ),
+    ]
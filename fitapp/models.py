@@ -1,9 +1,23 @@
+import calendar
+import json
+import math
+import struct
+
+from datetime import timedelta
+
 from django.conf import settings
+from django.core.cache import cache
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils.encoding import python_2_unicode_compatible
 
+from . import metrics
+
 
 UserModel = getattr(settings, 'AUTH_USER_MODEL', 'auth.User')
+# The cache key for whether a user is integrated, see utils.is_integrated
+INTEGRATED_CACHE_KEY = 'fitapp-integrated-{0}'
 
 
 @python_2_unicode_compatible
@@ -18,15 +32,27 @@ class UserFitbit(models.Model):
     expires_at = models.FloatField(
         help_text='The timestamp when the access token expires')
 
+    TOKEN_FIELDS = ('access_token', 'refresh_token', 'expires_at')
+
     def __str__(self):
         return self.user.__str__()
 
     def refresh_cb(self, token):
-        """ Called when the OAuth token has been refreshed """
-        self.access_token = token['access_token']
-        self.refresh_token = token['refresh_token']
-        self.expires_at = token['expires_at']
-        self.save()
+        """ Called when the OAuth token has been refreshed
+
+        Only the token fields are saved, and only if the refresh token that
+        was used is still the current one. Otherwise another process has
+        already saved a newer token, which is loaded instead.
+        """
+        metrics.increment('token_refreshes')
+        updated = UserFitbit.objects.filter(
+            pk=self.pk, refresh_token=self.refresh_token
+        ).update(**dict((f, token[f]) for f in self.TOKEN_FIELDS))
+        if updated:
+            for field in self.TOKEN_FIELDS:
+                setattr(self, field, token[field])
+        else:
+            self.refresh_from_db(fields=self.TOKEN_FIELDS)
 
     def get_user_data(self):
         return {
@@ -38,6 +64,13 @@ class UserFitbit(models.Model):
         }
 
 
+@receiver(post_save, sender=UserFitbit)
+@receiver(post_delete, sender=UserFitbit)
+def clear_integrated_cache(sender, instance, **kwargs):
+    """ Forget the cached integration status of the UserFitbit's user """
+    cache.delete(INTEGRATED_CACHE_KEY.format(instance.user_id))
+
+
 class TimeSeriesDataType(models.Model):
     """
     This model is intended to store information about Fitbit's time series
@@ -112,3 +145,104 @@ class TimeSeriesData(models.Model):
 
     def string_date(self):
         return self.date.strftime('%Y-%m-%d')
+
+
+class TimeSeriesDataArchive(models.Model):
+    """
+    A month of a user's old time series data, compacted into a single record.
+    Data is moved here from :class:`TimeSeriesData` by the
+    ``fitapp.tasks.archive_time_series_data`` task, see
+    :ref:`FITAPP_ARCHIVE_AFTER_DAYS`.
+    """
+
+    user = models.ForeignKey(UserModel, help_text="The data's user")
+    resource_type = models.ForeignKey(
+        TimeSeriesDataType, help_text='The type of time series data')
+    month = models.DateField(help_text='The first day of the month')
+    values = models.TextField(
+        help_text=(
+            'A JSON array of the values of each day of the month, with null '
+            'for the days without data'
+        ))
+
+    class Meta:
+        unique_together = ('user', 'resource_type', 'month')
+
+    def days(self):
+        """Returns the (date, value) pairs of the days with data"""
+        return [(self.month + timedelta(days=i), value)
+                for i, value in enumerate(json.loads(self.values))
+                if value is not None]
+
+    def set_days(self, days):
+        """Packs a dict of the values of the month, by date"""
+        length = calendar.monthrange(self.month.year, self.month.month)[1]
+        values = [days.get(self.month + timedelta(days=i))
+                  for i in range(length)]
+        self.values = json.dumps(values, separators=(',', ':'))
+
+
+class IntradayTimeSeriesData(models.Model):
+    """
+    A day of a user's data from the Fitbit intraday time series API:
+    https://dev.fitbit.com/docs/activity/#get-activity-intraday-time-series
+    https://dev.fitbit.com/docs/heart-rate/#get-heart-rate-intraday-time-series
+
+    The values of the day are packed into a binary array of little-endian
+    32-bit floats, one for each interval of the day, with NaN for intervals
+    without data. Ranges of the day can be read without unpacking the rest.
+    """
+
+    # The minutes per interval of each detail level
+    DETAIL_LEVELS = {'1min': 1, '15min': 15}
+    DETAIL_LEVEL_CHOICES = (('1min', '1min'), ('15min', '15min'))
+    VALUE_FORMAT = '<{}f'
+    VALUE_SIZE = 4
+
+    user = models.ForeignKey(UserModel, help_text="The data's user")
+    resource = models.CharField(
+        max_length=128,
+        help_text=(
+            'The path of the intraday time series resource, for example '
+            '"activities/steps" or "activities/heart"'
+        ))
+    date = models.DateField(help_text='The date the data was recorded')
+    detail_level = models.CharField(
+        max_length=8, choices=DETAIL_LEVEL_CHOICES,
+        help_text='The length of each interval of the day')
+    values = models.BinaryField(
+        help_text=(
+            'The value of each interval of the day, packed as little-endian '
+            '32-bit floats, with NaN for intervals without data'
+        ))
+
+    class Meta:
+        unique_together = ('user', 'resource', 'date', 'detail_level')
+
+    @classmethod
+    def intervals(cls, detail_level):
+        """Returns the number of intervals in a day at a detail level"""
+        return 24 * 60 // cls.DETAIL_LEVELS[detail_level]
+
+    @classmethod
+    def pack(cls, dataset, detail_level):
+        """Packs an intraday dataset from the Fitbit API, a list of
+        ``{'time': 'HH:MM:SS', 'value': 123}`` dicts, into an array.
+        """
+        minutes = cls.DETAIL_LEVELS[detail_level]
+        values = [float('nan')] * cls.intervals(detail_level)
+        for datum in dataset:
+            hours, mins = datum['time'].split(':')[:2]
+            values[(int(hours) * 60 + int(mins)) // minutes] = float(
+                datum['value'])
+        return struct.pack(cls.VALUE_FORMAT.format(len(values)), *values)
+
+    @classmethod
+    def unpack(cls, data):
+        """Unpacks an array of values, with ``None`` for missing values"""
+        data = bytes(data)
+        values = struct.unpack(
+            cls.VALUE_FORMAT.format(len(data) // cls.VALUE_SIZE), data)
+        # Drop the noise of the 32-bit float conversion, e.g. 1.18 instead of
+        # 1.1799999475479126
+        return [None if math.isnan(v) else float('%.7g' % v) for v in values]
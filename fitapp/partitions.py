@@ -0,0 +1,239 @@
+"""
+Native range partitioning of the :class:`~fitapp.models.TimeSeriesData` table
+by date, on PostgreSQL 12 and later.
+
+Partitions span a year or a month, see :ref:`FITAPP_PARTITION_INTERVAL`, and
+are named after the table and the start of their range, e.g.
+``fitapp_timeseriesdata_y2017`` or ``fitapp_timeseriesdata_m2017_01``. Data
+outside of all partitions is stored in the ``fitapp_timeseriesdata_default``
+partition.
+"""
+
+import re
+
+from datetime import date
+
+from django.db import NotSupportedError, connections, transaction
+from django.utils import timezone
+
+from . import utils
+from .models import TimeSeriesData
+
+
+TABLE = TimeSeriesData._meta.db_table
+DEFAULT_PARTITION = '{}_default'.format(TABLE)
+BOUND_RE = re.compile(r"FROM \('([\d-]+)'\) TO \('([\d-]+)'\)")
+
+
+def check_support(using='default'):
+    """Raises NotSupportedError unless the database supports partitioning"""
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        raise NotSupportedError(
+            'Partitioning is only supported on PostgreSQL')
+    connection.ensure_connection()
+    if connection.pg_version < 120000:
+        raise NotSupportedError(
+            'Partitioning requires PostgreSQL 12 or later')
+
+
+def partition_start(day, interval=None):
+    """Returns the first date of the partition that contains ``day``"""
+    interval = interval or utils.get_setting('FITAPP_PARTITION_INTERVAL')
+    if interval == 'year':
+        return date(day.year, 1, 1)
+    return date(day.year, day.month, 1)
+
+
+def partition_ranges(start, end, interval=None):
+    """Returns the partitions needed to store data from ``start`` through
+    ``end``, as a list of ``(name, from_date, to_date)`` tuples. ``to_date``
+    is the first date after the partition.
+    """
+    interval = interval or utils.get_setting('FITAPP_PARTITION_INTERVAL')
+    if interval not in ('year', 'month'):
+        raise ValueError('Invalid partition interval: {}'.format(interval))
+    ranges = []
+    from_date = partition_start(start, interval)
+    while from_date <= end:
+        if interval == 'year':
+            name = '{}_y{:%Y}'.format(TABLE, from_date)
+            to_date = date(from_date.year + 1, 1, 1)
+        else:
+            name = '{}_m{:%Y_%m}'.format(TABLE, from_date)
+            to_date = date(from_date.year + from_date.month // 12,
+                           from_date.month % 12 + 1, 1)
+        ranges.append((name, from_date, to_date))
+        from_date = to_date
+    return ranges
+
+
+def future_end(interval=None):
+    """Returns the first date of the last partition that should exist
+    already, :ref:`FITAPP_PARTITIONS_AHEAD` intervals after the current one.
+    """
+    interval = interval or utils.get_setting('FITAPP_PARTITION_INTERVAL')
+    ahead = utils.get_setting('FITAPP_PARTITIONS_AHEAD')
+    today = timezone.now().date()
+    if interval == 'year':
+        return date(today.year + ahead, 1, 1)
+    month = today.month - 1 + ahead
+    return date(today.year + month // 12, month % 12 + 1, 1)
+
+
+def is_partitioned(using='default'):
+    """Returns ``True`` if the time series data table is partitioned"""
+    with connections[using].cursor() as cursor:
+        cursor.execute("""
+            SELECT 1 FROM pg_partitioned_table p
+            JOIN pg_class c ON c.oid = p.partrelid
+            WHERE c.relname = %s
+        """, [TABLE])
+        return cursor.fetchone() is not None
+
+
+def list_partitions(using='default'):
+    """Returns the partitions of the time series data table, as a list of
+    ``(name, from_date, to_date)`` tuples. The dates of the default partition
+    are ``None``.
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute("""
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            WHERE p.relname = %s
+            ORDER BY c.relname
+        """, [TABLE])
+        partitions = []
+        for name, bound in cursor.fetchall():
+            match = BOUND_RE.search(bound)
+            if match:
+                from_date, to_date = [
+                    date(*map(int, d.split('-'))) for d in match.groups()]
+                partitions.append((name, from_date, to_date))
+            else:
+                partitions.append((name, None, None))
+        return partitions
+
+
+def create_partitions(end=None, using='default'):
+    """Creates the missing partitions from the current one through ``end``,
+    by default :ref:`FITAPP_PARTITIONS_AHEAD` intervals in the future.
+    Returns the names of the created partitions.
+
+    PostgreSQL doesn't create a partition while the default partition holds
+    rows in its range, so those rows are moved into the new partition, with
+    the default partition detached in the meantime.
+    """
+    end = end or future_end()
+    existing = set(p[0] for p in list_partitions(using))
+    default = DEFAULT_PARTITION if DEFAULT_PARTITION in existing else None
+    return _create_partitions(
+        TABLE, timezone.now().date(), end, existing, using, default)
+
+
+def _create_partitions(table, start, end, existing, using, default=None):
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    created = []
+    for name, from_date, to_date in partition_ranges(start, end):
+        if name in existing:
+            continue
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            in_range = 'WHERE date >= %s AND date < %s'
+            moved = False
+            if default is not None:
+                cursor.execute('SELECT 1 FROM {} {} LIMIT 1'.format(
+                    qn(default), in_range), [from_date, to_date])
+                moved = cursor.fetchone() is not None
+            if moved:
+                cursor.execute('ALTER TABLE {} DETACH PARTITION {}'.format(
+                    qn(table), qn(default)))
+            cursor.execute(
+                'CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)'
+                .format(qn(name), qn(table)), [from_date, to_date])
+            if moved:
+                cursor.execute('INSERT INTO {} SELECT * FROM {} {}'.format(
+                    qn(name), qn(default), in_range), [from_date, to_date])
+                cursor.execute('DELETE FROM {} {}'.format(
+                    qn(default), in_range), [from_date, to_date])
+                cursor.execute('ALTER TABLE {} ATTACH PARTITION {} DEFAULT'
+                               .format(qn(table), qn(default)))
+        created.append(name)
+    return created
+
+
+def convert(using='default'):
+    """Converts the time series data table into a partitioned table.
+
+    The data is copied into a new, partitioned, table in a single
+    transaction, which locks the table until it is done. Partitions are
+    created for the dates of the existing data through
+    :ref:`FITAPP_PARTITIONS_AHEAD` intervals in the future. Returns the names
+    of the created partitions.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    new_table = '{}_new'.format(TABLE)
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        cursor.execute('LOCK TABLE {} IN EXCLUSIVE MODE'.format(qn(TABLE)))
+        cursor.execute('SELECT MIN(date) FROM {}'.format(qn(TABLE)))
+        start = cursor.fetchone()[0] or timezone.now().date()
+        cursor.execute(
+            'CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS) '
+            'PARTITION BY RANGE (date)'.format(qn(new_table), qn(TABLE)))
+        created = _create_partitions(
+            new_table, start, future_end(), set(), using)
+        cursor.execute('CREATE TABLE {} PARTITION OF {} DEFAULT'.format(
+            qn(DEFAULT_PARTITION), qn(new_table)))
+        cursor.execute('INSERT INTO {} SELECT * FROM {}'.format(
+            qn(new_table), qn(TABLE)))
+        # Keep the ID sequence when the old table is dropped
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [TABLE])
+        cursor.execute('ALTER SEQUENCE {} OWNED BY {}.id'.format(
+            cursor.fetchone()[0], qn(new_table)))
+        cursor.execute('DROP TABLE {}'.format(qn(TABLE)))
+        cursor.execute('ALTER TABLE {} RENAME TO {}'.format(
+            qn(new_table), qn(TABLE)))
+        # The partition key must be part of the primary key
+        cursor.execute('ALTER TABLE {} ADD PRIMARY KEY (id, date)'.format(
+            qn(TABLE)))
+        cursor.execute(
+            'ALTER TABLE {} ADD UNIQUE (user_id, resource_type_id, date)'
+            .format(qn(TABLE)))
+        cursor.execute('CREATE INDEX ON {} (resource_type_id)'.format(
+            qn(TABLE)))
+        for field in ('user', 'resource_type'):
+            related = TimeSeriesData._meta.get_field(field).related_model
+            cursor.execute(
+                'ALTER TABLE {} ADD FOREIGN KEY ({}_id) REFERENCES {} (id) '
+                'DEFERRABLE INITIALLY DEFERRED'.format(
+                    qn(TABLE), field, qn(related._meta.db_table)))
+    return created + [DEFAULT_PARTITION]
+
+
+def detach_partitions(before, drop=False, using='default'):
+    """Detaches the partitions with data before ``before`` from the time
+    series data table, so that they can be archived or dropped without
+    touching the rest of the data. The partitions are dropped too if ``drop``
+    is true. Returns the names of the detached partitions.
+
+    The partitions are detached with a brief lock on the table. PostgreSQL's
+    ``DETACH PARTITION ... CONCURRENTLY`` isn't used, because it isn't allowed
+    on a table with a default partition, which :func:`convert` creates.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    detached = []
+    for name, from_date, to_date in list_partitions(using):
+        if to_date is None or to_date > before:
+            continue
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            cursor.execute('ALTER TABLE {} DETACH PARTITION {}'.format(
+                qn(TABLE), qn(name)))
+            if drop:
+                cursor.execute('DROP TABLE {}'.format(qn(name)))
+        detached.append(name)
+    return detached
@@ -0,0 +1,97 @@
+"""
+Sampled profiling of fitapp's celery tasks.
+
+When :ref:`FITAPP_PROFILE_RATE` is set, that fraction of the executions of
+fitapp's tasks are run under cProfile, and the stats of each are written to
+:ref:`FITAPP_PROFILE_DIR` as a pstats file named after the task, the Fitbit
+user and the resource of the data, e.g.
+``get_time_series_data-ABC123-activities-steps-20170101T120000-1a2b3c4d.prof``.
+"""
+
+import cProfile
+import inspect
+import logging
+import os
+import random
+import re
+import tempfile
+import threading
+
+from celery.signals import task_postrun, task_prerun
+from django.utils import timezone
+
+from . import utils
+from .models import TimeSeriesDataType
+
+
+logger = logging.getLogger(__name__)
+CATEGORIES = dict(TimeSeriesDataType.CATEGORY_CHOICES)
+UNSAFE_CHARACTERS = re.compile(r'[^\w.]+')
+_local = threading.local()
+
+
+def get_profile_dir():
+    """Returns the directory to write profiles to, creating it if needed"""
+    profile_dir = utils.get_setting('FITAPP_PROFILE_DIR') or os.path.join(
+        tempfile.gettempdir(), 'fitapp-profiles')
+    if not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    return profile_dir
+
+
+def get_profile_tags(task, args, kwargs):
+    """Returns the Fitbit user and the resource of a task's execution, as far
+    as the task has them
+    """
+    try:
+        callargs = inspect.getcallargs(task.run, *args, **kwargs)
+    except TypeError:
+        return []
+    tags = [callargs.get('fitbit_user'), callargs.get('resource')]
+    if 'cat' in callargs and callargs['cat'] in CATEGORIES:
+        tags[1] = '{}/{}'.format(CATEGORIES[callargs['cat']], tags[1])
+    return [str(tag) for tag in tags if tag is not None]
+
+
+def get_profile_path(task, task_id, args, kwargs):
+    name = '-'.join(
+        [task.name.rsplit('.', 1)[-1]] +
+        get_profile_tags(task, args, kwargs) +
+        [timezone.now().strftime('%Y%m%dT%H%M%S'), task_id[:8]])
+    return os.path.join(
+        get_profile_dir(), UNSAFE_CHARACTERS.sub('-', name) + '.prof')
+
+
+@task_prerun.connect
+def start_profile(sender=None, task_id=None, args=None, kwargs=None,
+                  **extra):
+    """Profiles a sample of the executions of fitapp's tasks"""
+    if not sender.name.startswith('fitapp.') or \
+            getattr(_local, 'profile', None) is not None:
+        # Tasks run eagerly by another task are profiled as part of it
+        return
+    rate = utils.get_setting('FITAPP_PROFILE_RATE')
+    if rate and random.random() < rate:
+        profile = cProfile.Profile()
+        _local.profile = (task_id, profile)
+        profile.enable()
+
+
+@task_postrun.connect
+def stop_profile(sender=None, task_id=None, args=None, kwargs=None,
+                 **extra):
+    """Writes the stats of a profiled execution"""
+    task_id_and_profile = getattr(_local, 'profile', None)
+    if task_id_and_profile is None or task_id_and_profile[0] != task_id:
+        return
+    profile = task_id_and_profile[1]
+    profile.disable()
+    _local.profile = None
+    try:
+        path = get_profile_path(sender, task_id, args or [], kwargs or {})
+        profile.dump_stats(path)
+    except (EnvironmentError, ValueError) as e:
+        logger.warning('Could not write the profile of %s: %s',
+                       sender.name, e)
+    else:
+        logger.debug('Wrote the profile of %s to %s', sender.name, path)
@@ -1,19 +1,29 @@
 import logging
 import random
+import time
+
+from collections import Counter, defaultdict
+from datetime import timedelta
 
 from celery import shared_task
 from celery.exceptions import Ignore, Reject
-from dateutil import parser
 from django.core.cache import cache
-from django.db import transaction
-from fitbit.exceptions import HTTPBadRequest, HTTPTooManyRequests
+from django.db import NotSupportedError, transaction
+from django.db.models import Count
+from django.utils import timezone
+from fitbit.exceptions import (HTTPBadRequest, HTTPServerError,
+                               HTTPTooManyRequests, Timeout)
 
-from . import utils
-from .models import UserFitbit, TimeSeriesData, TimeSeriesDataType
+from . import metrics, partitions, utils
+# Connects the receivers that profile a sample of the tasks
+from . import profiling  # noqa
+from .models import (UserFitbit, IntradayTimeSeriesData, TimeSeriesData,
+                     TimeSeriesDataArchive, TimeSeriesDataType)
 
 
 logger = logging.getLogger(__name__)
 LOCK_EXPIRE = 60 * 5 # Lock expires in 5 minutes
+ARCHIVE_CHUNK_SIZE = 500
 
 
 @shared_task
@@ -28,6 +38,8 @@ def subscribe(fitbit_user, subscriber_id):
         except Exception as e:
             logger.exception("Error subscribing user: %s" % e)
             raise Reject(e, requeue=False)
+        finally:
+            utils.forget_subscriptions(fitbit_user)
 
 
 @shared_task
@@ -38,18 +50,29 @@ def unsubscribe(*args, **kwargs):
     # automatically
     fb = utils.create_fitbit(refresh_cb=lambda token: None, **kwargs)
     try:
-        for sub in fb.list_subscriptions()['apiSubscriptions']:
-            if sub['ownerId'] == kwargs['user_id']:
-                fb.subscription(sub['subscriptionId'], sub['subscriberId'],
-                                method="DELETE")
+        for sub in utils.get_subscriptions(fb, kwargs['user_id']):
+            fb.subscription(sub['subscriptionId'], sub['subscriberId'],
+                            method="DELETE")
     except Exception as e:
         logger.exception("Error unsubscribing user: %s" % e)
         raise Reject(e, requeue=False)
+    finally:
+        utils.forget_subscriptions(kwargs['user_id'])
 
 
 @shared_task(bind=True)
-def get_time_series_data(self, fitbit_user, cat, resource, date=None):
-    """ Get the user's time series data """
+def get_time_series_data(self, fitbit_user, cat, resource, date=None,
+                         end_date=None, queue=None, priority=None):
+    """ Get the user's time series data
+
+    Data is retrieved for ``date``, or from ``date`` through ``end_date`` if
+    it is given, or for all dates if no date is given.
+
+    ``queue`` and ``priority`` are the FITAPP_QUEUES queue and the priority
+    the task was sent with, which are used again if the task is deferred. By
+    default, data for a date is retrieved in real time and all dates are
+    backfilled, with the priority for the date.
+    """
 
     try:
         _type = TimeSeriesDataType.objects.get(category=cat, resource=resource)
@@ -58,8 +81,34 @@ def get_time_series_data(self, fitbit_user, cat, resource, date=None):
             resource, cat))
         raise Reject(e, requeue=False)
 
+    if queue is None:
+        queue = 'realtime' if date else 'backfill'
+    if priority is None:
+        priority = utils.get_fetch_priority(date)
+
+    def defer(countdown):
+        # Send the task again as it was sent, so that deferred backfills
+        # don't compete with real time updates
+        get_time_series_data.apply_async(
+            (fitbit_user, cat, resource), {
+                'date': date, 'end_date': end_date, 'queue': queue,
+                'priority': priority,
+            }, countdown=countdown, priority=priority,
+            **utils.get_queue_options(queue))
+
+    # Spread out the API calls as the user's quota runs low, rather than
+    # running into the rate limit, and wait for Fitbit to recover from errors
+    delay = max(utils.get_rate_limit_delay(fitbit_user),
+                utils.get_circuit_delay())
+    if delay > 0:
+        logger.debug('Deferring data retrieval for {} seconds'.format(delay))
+        defer(delay)
+        raise Ignore()
+
     # Create a lock so we don't try to run the same task multiple times
     sdat = date.strftime('%Y-%m-%d') if date else 'ALL'
+    if end_date:
+        sdat += end_date.strftime('-%Y-%m-%d')
     lock_id = '{0}-lock-{1}-{2}-{3}'.format(__name__, fitbit_user, _type, sdat)
     if not cache.add(lock_id, 'true', LOCK_EXPIRE):
         logger.debug('Already retrieving %s data for date %s, user %s' % (
@@ -67,24 +116,19 @@ def get_time_series_data(self, fitbit_user, cat, resource, date=None):
         raise Ignore()
 
     try:
-        with transaction.atomic():
-            # Block until we have exclusive update access to this UserFitbit, so
-            # that another process cannot step on us when we update tokens
-            fbusers = UserFitbit.objects.select_for_update().filter(
-                fitbit_user=fitbit_user)
+        with utils.query_budget('get_time_series_data') as budget, \
+                transaction.atomic():
+            # Token refreshes are committed on their own, see
+            # utils.refresh_access_token, so the row isn't locked for them
+            fbusers = UserFitbit.objects.filter(fitbit_user=fitbit_user)
             dates = {'base_date': 'today', 'period': 'max'}
             if date:
-                dates = {'base_date': date, 'end_date': date}
+                dates = {'base_date': date, 'end_date': end_date or date}
 
             for fbuser in fbusers:
                 data = utils.get_fitbit_data(fbuser, _type, **dates)
-                for datum in data:
-                    # Create new record or update existing record
-                    date = parser.parse(datum['dateTime'])
-                    tsd, created = TimeSeriesData.objects.get_or_create(
-                        user=fbuser.user, resource_type=_type, date=date)
-                    tsd.value = datum['value']
-                    tsd.save()
+                utils.save_time_series_data(fbuser.user, _type, data)
+                budget.rows += len(data)
             # Release the lock
             cache.delete(lock_id)
     except HTTPTooManyRequests as e:
@@ -97,6 +141,18 @@ def get_time_series_data(self, fitbit_user, cat, resource, date=None):
         logger.debug('Rate limit reached, will try again in {} seconds'.format(
             countdown))
         raise get_time_series_data.retry(exc=e, countdown=countdown)
+    except (utils.CircuitOpenError, HTTPServerError, Timeout) as e:
+        # Fitbit is down, try again when the circuit breaker lets us through
+        # rather than losing the work
+        delay = _get_circuit_delay(e)
+        if not delay:
+            logger.exception("Exception updating data: %s" % e)
+            raise Reject(e, requeue=False)
+        logger.warning('Fitbit is failing, will try again in {} '
+                       'seconds'.format(delay))
+        cache.delete(lock_id)
+        defer(delay)
+        raise Ignore()
     except HTTPBadRequest as e:
         # If the resource is elevation or floors, we are just getting this
         # error because the data doesn't exist for this user, so we can ignore
@@ -107,3 +163,336 @@ def get_time_series_data(self, fitbit_user, cat, resource, date=None):
     except Exception as e:
         logger.exception("Exception updating data: %s" % e)
         raise Reject(e, requeue=False)
+
+
+@shared_task(bind=True)
+def get_intraday_time_series_data(self, fitbit_user, resource, date,
+                                  detail_level):
+    """ Get a day of the user's intraday time series data """
+
+    # Spread out the API calls as the user's quota runs low, rather than
+    # running into the rate limit, and wait for Fitbit to recover from errors
+    delay = max(utils.get_rate_limit_delay(fitbit_user),
+                utils.get_circuit_delay())
+    if delay > 0:
+        logger.debug('Deferring intraday data retrieval for {} seconds'.format(
+            delay))
+        get_intraday_time_series_data.apply_async(
+            (fitbit_user, resource, date, detail_level), countdown=delay,
+            priority=utils.get_fetch_priority(date),
+            **utils.get_queue_options('realtime'))
+        raise Ignore()
+
+    # Create a lock so we don't try to run the same task multiple times
+    lock_id = '{0}-intraday-lock-{1}-{2}-{3}-{4}'.format(
+        __name__, fitbit_user, resource, date.strftime('%Y-%m-%d'),
+        detail_level)
+    if not cache.add(lock_id, 'true', LOCK_EXPIRE):
+        logger.debug('Already retrieving %s intraday data for date %s, '
+                     'user %s' % (resource, date, fitbit_user))
+        raise Ignore()
+
+    try:
+        with transaction.atomic():
+            fbusers = UserFitbit.objects.filter(fitbit_user=fitbit_user)
+            for fbuser in fbusers:
+                dataset = utils.get_fitbit_intraday_data(
+                    fbuser, resource, date, detail_level)
+                with metrics.timed('db_write', resource=resource):
+                    IntradayTimeSeriesData.objects.update_or_create(
+                        user=fbuser.user, resource=resource, date=date,
+                        detail_level=detail_level, defaults={
+                            'values': IntradayTimeSeriesData.pack(
+                                dataset, detail_level)
+                        })
+                metrics.increment('rows_written', resource=resource)
+            # Release the lock
+            cache.delete(lock_id)
+    except HTTPTooManyRequests as e:
+        # We have hit the rate limit for the user, retry when it's reset,
+        # according to the reply from the failing API call
+        countdown = e.retry_after_secs + int(
+            # Add exponential back-off + random jitter
+            random.uniform(2, 4) ** self.request.retries
+        )
+        logger.debug('Rate limit reached, will try again in {} seconds'.format(
+            countdown))
+        raise get_intraday_time_series_data.retry(exc=e, countdown=countdown)
+    except (utils.CircuitOpenError, HTTPServerError, Timeout) as e:
+        # Fitbit is down, try again when the circuit breaker lets us through
+        # rather than losing the work
+        delay = _get_circuit_delay(e)
+        if not delay:
+            logger.exception("Exception updating intraday data: %s" % e)
+            raise Reject(e, requeue=False)
+        logger.warning('Fitbit is failing, will try again in {} '
+                       'seconds'.format(delay))
+        cache.delete(lock_id)
+        get_intraday_time_series_data.apply_async(
+            (fitbit_user, resource, date, detail_level), countdown=delay,
+            priority=utils.get_fetch_priority(date),
+            **utils.get_queue_options('realtime'))
+        raise Ignore()
+    except Exception as e:
+        logger.exception("Exception updating intraday data: %s" % e)
+        raise Reject(e, requeue=False)
+
+
+def _get_circuit_delay(exc):
+    """Returns how long to defer a task that failed with ``exc`` because
+    Fitbit is failing, or 0 if the circuit breaker isn't open
+    """
+    if isinstance(exc, utils.CircuitOpenError):
+        return exc.retry_after_secs
+    return utils.get_circuit_delay()
+
+
+@shared_task
+def get_time_series_data_batch(requests):
+    """ Get time series data for many users at once
+
+    ``requests`` is a list of ``[fitbit_user, category, resource, date,
+    end_date]`` lists, with the arguments of get_time_series_data. All of the
+    data is retrieved concurrently on one event loop by the fetch engine,
+    which requires Python 3.5+ and aiohttp. Returns the number of requests by
+    outcome.
+    """
+    from .engine import FetchEngine
+
+    outcomes = FetchEngine().run(requests)
+    failed = sum(n for outcome, n in outcomes.items() if outcome != 'success')
+    if failed:
+        logger.warning('Failed to retrieve {} of {} time series: {}'.format(
+            failed, sum(outcomes.values()), dict(outcomes)))
+    return dict(outcomes)
+
+
+@shared_task
+def reconcile_time_series_data():
+    """ Find and retrieve missing time series data
+
+    This is meant to be run periodically by celery beat. Gaps in the stored
+    data of the last FITAPP_RECONCILE_DAYS days, up to yesterday, are found
+    with a single query, and only the missing date ranges are retrieved,
+    spread out by each user's remaining rate limit quota.
+
+    Returns the completeness of each user's data in that period, as the
+    fraction of expected data points that are stored, by user ID.
+    """
+
+    until = timezone.now().date() - timedelta(days=1)
+    since = until - timedelta(
+        days=utils.get_setting('FITAPP_RECONCILE_DAYS') - 1)
+    gaps = utils.find_time_series_gaps(since, until)
+
+    stored = dict(TimeSeriesData.objects.filter(
+        date__gte=since, date__lte=until
+    ).order_by().values_list('user_id').annotate(Count('id')))
+    missing = Counter()
+    user_gaps = defaultdict(list)
+    for user_id, type_id, start, end in gaps:
+        missing[user_id] += (end - start).days + 1
+        user_gaps[user_id].append((type_id, start, end))
+
+    types = TimeSeriesDataType.objects.in_bulk()
+    fitbit_users = dict(UserFitbit.objects.filter(
+        user_id__in=user_gaps.keys()).values_list('user_id', 'fitbit_user'))
+    options = utils.get_queue_options('backfill')
+    for user_id, ranges in user_gaps.items():
+        fitbit_user = fitbit_users.get(user_id)
+        if fitbit_user is None:
+            continue
+        delay = utils.get_rate_limit_delay(fitbit_user)
+        for i, (type_id, start, end) in enumerate(ranges):
+            priority = utils.get_fetch_priority(end)
+            get_time_series_data.apply_async(
+                (fitbit_user, types[type_id].category,
+                 types[type_id].resource), {
+                    'date': start, 'end_date': end, 'queue': 'backfill',
+                    'priority': priority,
+                }, countdown=i * delay, priority=priority, **options)
+
+    completeness = {}
+    for user_id in set(stored) | set(missing):
+        count = stored.get(user_id, 0)
+        completeness[user_id] = count / float(count + missing[user_id])
+        logger.debug('Data for user {} is {:.1%} complete'.format(
+            user_id, completeness[user_id]))
+    logger.debug('Scheduled retrieval of {} missing date ranges'.format(
+        len(gaps)))
+    return completeness
+
+
+@shared_task
+def archive_time_series_data():
+    """ Compact old time series data into monthly archives
+
+    This is meant to be run periodically by celery beat. Data from the months
+    that ended more than FITAPP_ARCHIVE_AFTER_DAYS days ago is moved into one
+    TimeSeriesDataArchive per user, type of data and month, one user at a
+    time. Data saved for an archived month later on is merged into the
+    archive by the next run.
+    """
+
+    days = utils.get_setting('FITAPP_ARCHIVE_AFTER_DAYS')
+    if days is None:
+        return
+    cutoff = (timezone.now().date() - timedelta(days=days)).replace(day=1)
+    user_ids = TimeSeriesData.objects.filter(
+        date__lt=cutoff).order_by('user_id').values_list(
+        'user_id', flat=True).distinct()
+    archived = 0
+    for user_id in list(user_ids):
+        with transaction.atomic():
+            archived += _archive_user_data(user_id, cutoff)
+    logger.debug('Archived {} time series data points'.format(archived))
+
+
+def _archive_user_data(user_id, cutoff):
+    rows = TimeSeriesData.objects.filter(
+        user_id=user_id, date__lt=cutoff
+    ).values_list('pk', 'resource_type_id', 'date', 'value')
+    pks = []
+    months = defaultdict(dict)
+    for pk, type_id, date, value in rows:
+        pks.append(pk)
+        months[(type_id, date.replace(day=1))][date] = value
+
+    archives = TimeSeriesDataArchive.objects.select_for_update().filter(
+        user_id=user_id, month__in=set(month for _, month in months))
+    archives = dict(((a.resource_type_id, a.month), a) for a in archives)
+    new_archives = []
+    for (type_id, month), days in months.items():
+        archive = archives.get((type_id, month))
+        if archive is None:
+            archive = TimeSeriesDataArchive(
+                user_id=user_id, resource_type_id=type_id, month=month)
+            archive.set_days(days)
+            new_archives.append(archive)
+        else:
+            # Newer data takes precedence over the archived data
+            merged = dict(archive.days())
+            merged.update(days)
+            archive.set_days(merged)
+            archive.save()
+    TimeSeriesDataArchive.objects.bulk_create(new_archives)
+
+    # Only delete the rows we archived, in chunks to keep the queries small
+    for i in range(0, len(pks), ARCHIVE_CHUNK_SIZE):
+        TimeSeriesData.objects.filter(
+            pk__in=pks[i:i + ARCHIVE_CHUNK_SIZE]).delete()
+    return len(pks)
+
+
+@shared_task
+def create_time_series_partitions():
+    """ Create the upcoming partitions of the time series data table
+
+    This is meant to be run periodically by celery beat when the table is
+    partitioned, see the fitapp_partitions management command.
+    """
+
+    try:
+        partitions.check_support()
+    except NotSupportedError as e:
+        logger.exception("Error creating partitions: %s" % e)
+        raise Reject(e, requeue=False)
+    if not partitions.is_partitioned():
+        if utils.get_setting('FITAPP_PARTITION_TIME_SERIES'):
+            # The setting only takes effect in the migration
+            logger.warning(
+                'FITAPP_PARTITION_TIME_SERIES is set, but the time series '
+                'data table is not partitioned, use the convert action of '
+                'the fitapp_partitions command')
+        else:
+            logger.debug('The time series data table is not partitioned')
+        return
+    created = partitions.create_partitions()
+    logger.debug('Created {} partitions'.format(len(created)))
+
+
+@shared_task
+def refresh_expiring_tokens():
+    """ Schedule refreshes of the access tokens that will soon expire
+
+    This is meant to be run periodically by celery beat. Tokens that expire
+    within FITAPP_TOKEN_REFRESH_WINDOW seconds are refreshed in batches of
+    FITAPP_TOKEN_REFRESH_BATCH_SIZE, soonest to expire first, spread over the
+    first half of the window.
+    """
+
+    window = utils.get_setting('FITAPP_TOKEN_REFRESH_WINDOW')
+    batch_size = utils.get_setting('FITAPP_TOKEN_REFRESH_BATCH_SIZE')
+    fitbit_users = list(UserFitbit.objects.filter(
+        expires_at__lt=time.time() + window
+    ).order_by('expires_at').values_list('fitbit_user', flat=True))
+    batches = (len(fitbit_users) + batch_size - 1) // batch_size
+    options = utils.get_queue_options('subscriptions')
+    for i, fitbit_user in enumerate(fitbit_users):
+        countdown = (i // batch_size) * window / 2.0 / batches
+        refresh_token.apply_async(
+            (fitbit_user,), countdown=countdown, **options)
+    logger.debug('Scheduled refreshes of {} tokens in {} batches'.format(
+        len(fitbit_users), batches))
+
+
+@shared_task
+def refresh_token(fitbit_user):
+    """ Refresh the user's access token, unless it was refreshed already """
+
+    window = utils.get_setting('FITAPP_TOKEN_REFRESH_WINDOW')
+    try:
+        fbusers = UserFitbit.objects.filter(
+            fitbit_user=fitbit_user, expires_at__lt=time.time() + window)
+        for fbuser in fbusers:
+            utils.refresh_access_token(fbuser)
+    except Exception as e:
+        logger.exception("Error refreshing token: %s" % e)
+        raise Reject(e, requeue=False)
+
+
+@shared_task
+def purge_time_series_data(user_id, last_pk):
+    """ Delete all of the user's time series data, a chunk at a time
+
+    Only the data stored when the user logged out is deleted, up to the time
+    series data with primary key ``last_pk``. Each chunk of
+    FITAPP_PURGE_CHUNK_SIZE rows is deleted by primary key range in a short
+    transaction, pausing FITAPP_PURGE_DELAY seconds between chunks so the
+    database stays responsive. If the user integrates their Fitbit account
+    again before the purge is done, it stops, because their new data is saved
+    over their old rows.
+    """
+
+    chunk_size = utils.get_setting('FITAPP_PURGE_CHUNK_SIZE')
+    delay = utils.get_setting('FITAPP_PURGE_DELAY')
+    fbusers = UserFitbit.objects.filter(user_id=user_id)
+    with transaction.atomic():
+        if fbusers.exists():
+            logger.debug('User {} has integrated again, not purging their '
+                         'data'.format(user_id))
+            return
+        # Archives and intraday data hold a month or a day per row, so there
+        # are few enough to delete at once
+        TimeSeriesDataArchive.objects.filter(user_id=user_id).delete()
+        IntradayTimeSeriesData.objects.filter(user_id=user_id).delete()
+    if last_pk is None:
+        return
+    data = TimeSeriesData.objects.filter(user_id=user_id)
+    pks = data.filter(pk__lte=last_pk).order_by('pk').values_list(
+        'pk', flat=True)
+    chunk = list(pks[:chunk_size])
+    deleted = 0
+    while chunk:
+        with transaction.atomic():
+            if fbusers.exists():
+                logger.debug('User {} has integrated again, stopped purging '
+                             'their data'.format(user_id))
+                break
+            data.filter(pk__gte=chunk[0], pk__lte=chunk[-1]).delete()
+        deleted += len(chunk)
+        chunk = list(pks.filter(pk__gt=chunk[-1])[:chunk_size])
+        if chunk:
+            time.sleep(delay)
+    logger.debug('Purged {} time series data points for user {}'.format(
+        deleted, user_id))
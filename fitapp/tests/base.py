@@ -11,8 +11,9 @@ except:
     from string import letters as ascii_letters
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 
 from fitbit.api import Fitbit
 
@@ -55,10 +56,12 @@ class MockClient(object):
         return response
 
 
-class FitappTestBase(TestCase):
+class FitappTestMixin(object):
     TEST_SERVER = 'http://testserver'
 
     def setUp(self):
+        # User IDs can be reused between tests, so start with a clean cache
+        cache.clear()
         self.username = self.random_string(25)
         self.password = self.random_string(25)
         self.user = self.create_user(username=self.username,
@@ -148,3 +151,15 @@ class FitappTestBase(TestCase):
         elif response:
             utility.return_value = response
         return self._get(**kwargs)
+
+
+class FitappTestBase(FitappTestMixin, TestCase):
+    pass
+
+
+class FitappTransactionTestBase(FitappTestMixin, TransactionTestCase):
+    """For tests that use the database from other threads, which can't see
+    the data of a test run in a transaction
+    """
+    # Keep the data types loaded by the migrations
+    serialized_rollback = True
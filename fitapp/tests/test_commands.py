@@ -1,21 +1,37 @@
 import json
+import os
 import requests_mock
+import shutil
+import tempfile
 import time
 
+from datetime import date
+from importlib import import_module
+
+from django.conf import settings
 from django.core import management
+from django.db import connection
+from django.db.migrations.loader import MigrationLoader
+from django.test.utils import override_settings
 from django.utils.six import StringIO
 from fitbit.api import FitbitOauth2Client
-from mock import patch
+from freezegun import freeze_time
+from mock import MagicMock, patch
+from requests.exceptions import Timeout
 from requests_oauthlib import OAuth2Session
 
-from fitapp.models import UserFitbit
-from fitapp.management.commands import refresh_tokens
+from fitapp import partitions
+from fitapp.models import (
+    UserFitbit, TimeSeriesData, TimeSeriesDataArchive, TimeSeriesDataType)
+from fitapp.management.commands import fitapp_subscriptions, refresh_tokens
+from fitapp.tasks import create_time_series_partitions
 
-from .base import FitappTestBase
+from .base import FitappTestBase, FitappTransactionTestBase
 
 
-class TestCommands(FitappTestBase):
-    """Tests for Fitapp management commands."""
+class TestRefreshTokensCommand(FitappTransactionTestBase):
+    """Tests for the refresh_tokens command, which commits tokens right away.
+    """
 
     def test_refresh_tokens_command(self):
         """Test the refresh_tokens command."""
@@ -78,3 +94,446 @@ class TestCommands(FitappTestBase):
         self.assertIn('Failed to refresh 1 tokens', out.getvalue())
         self.assertIn('Deauthenticated 1 users', out.getvalue())
         self.assertEqual(0, UserFitbit.objects.count())
+
+
+class TestCommands(FitappTestBase):
+    """Tests for Fitapp management commands."""
+
+    @patch.object(refresh_tokens.Command, 'refresh')
+    def test_refresh_tokens_concurrency(self, refresh):
+        """Test the refresh_tokens command with a pool of threads."""
+        pks = [self.fbuser.pk] + [
+            self.create_userfitbit().pk for i in range(6)]
+        outcomes = dict(zip(pks, [
+            'success', 'success', 'success', 'deauthed', 'Timeout',
+            'Timeout', 'success']))
+        refresh.side_effect = lambda pk: outcomes[pk]
+
+        out = StringIO()
+        management.call_command(
+            'refresh_tokens', all=True, deauth=True, concurrency=3,
+            chunk_size=2, stdout=out)
+
+        self.assertEqual(
+            sorted(c[0][0] for c in refresh.call_args_list), sorted(pks))
+        output = out.getvalue()
+        self.assertIn('Refreshed 2/7 tokens', output)
+        self.assertIn('Refreshed 7/7 tokens', output)
+        self.assertIn('Successfully refreshed 4 tokens', output)
+        self.assertIn('Failed to refresh 3 tokens', output)
+        self.assertIn('InvalidGrantError: 1', output)
+        self.assertIn('Timeout: 2', output)
+        self.assertIn('Deauthenticated 1 users', output)
+
+    def test_refresh_tokens_other_error(self):
+        """Unexpected refresh errors are counted as failures."""
+        self.fbuser.expires_at -= 300
+        self.fbuser.save()
+        out = StringIO()
+        with requests_mock.mock() as m:
+            m.post(FitbitOauth2Client.refresh_token_url, status_code=500)
+            management.call_command('refresh_tokens', deauth=True, stdout=out)
+
+        self.assertIn('Successfully refreshed 0 tokens', out.getvalue())
+        self.assertIn('Failed to refresh 1 tokens', out.getvalue())
+        self.assertIn('Deauthenticated 0 users', out.getvalue())
+        self.assertEqual(1, UserFitbit.objects.count())
+
+    def _subscriptions(self, user2):
+        return {'apiSubscriptions': [
+            {'ownerId': self.fbuser.fitbit_user, 'collectionType': 'user',
+             'subscriptionId': str(self.user.id), 'subscriberId': '1'},
+            # Subscription for an old subscriber ID
+            {'ownerId': user2.fitbit_user, 'collectionType': 'user',
+             'subscriptionId': str(user2.user.id), 'subscriberId': '2'},
+        ]}
+
+    @patch('fitbit.Fitbit.subscription')
+    @patch('fitbit.Fitbit.list_subscriptions')
+    def test_subscriptions_command_audit(self, list_subscriptions,
+                                         subscription):
+        """The fitapp_subscriptions command reports subscription problems."""
+        user2 = self.create_userfitbit()
+        self.create_userfitbit()
+        list_subscriptions.return_value = self._subscriptions(user2)
+        out = StringIO()
+        management.call_command('fitapp_subscriptions', stdout=out)
+
+        output = out.getvalue()
+        self.assertIn('Checked 3 users', output)
+        self.assertIn('Subscribed: 1', output)
+        self.assertIn('Missing subscriptions: 2', output)
+        self.assertIn('Stale subscriptions: 1', output)
+        self.assertEqual(list_subscriptions.call_count, 3)
+        self.assertEqual(subscription.call_count, 0)
+
+        # The listings are cached
+        management.call_command('fitapp_subscriptions', stdout=StringIO())
+        self.assertEqual(list_subscriptions.call_count, 3)
+        management.call_command(
+            'fitapp_subscriptions', refresh=True, stdout=StringIO())
+        self.assertEqual(list_subscriptions.call_count, 6)
+
+    @patch('fitbit.Fitbit.subscription')
+    @patch('fitbit.Fitbit.list_subscriptions')
+    def test_subscriptions_command_apply(self, list_subscriptions,
+                                         subscription):
+        """The fitapp_subscriptions command fixes subscription problems."""
+        user2 = self.create_userfitbit()
+        list_subscriptions.return_value = self._subscriptions(user2)
+        out = StringIO()
+        management.call_command(
+            'fitapp_subscriptions', 'apply', rate=1000, stdout=out)
+
+        output = out.getvalue()
+        self.assertIn('Subscribed: 1', output)
+        self.assertIn('Created subscriptions: 1', output)
+        self.assertIn('Deleted subscriptions: 1', output)
+        self.assertEqual(subscription.call_args_list, [
+            ((str(user2.user.id), '2'), {'method': 'DELETE'}),
+            ((user2.user.id, 1),),
+        ])
+        # The changed listing is forgotten
+        management.call_command('fitapp_subscriptions', stdout=StringIO())
+        self.assertEqual(list_subscriptions.call_count, 3)
+
+    @patch('fitbit.Fitbit.list_subscriptions')
+    def test_subscriptions_command_error(self, list_subscriptions):
+        """Errors listing subscriptions are counted as failures."""
+        list_subscriptions.side_effect = Timeout
+        out = StringIO()
+        management.call_command('fitapp_subscriptions', stdout=out)
+
+        self.assertIn('Failed to check 1 users', out.getvalue())
+        self.assertIn('Timeout: 1', out.getvalue())
+        with self.assertRaises(management.CommandError):
+            management.call_command('fitapp_subscriptions', concurrency=0)
+
+    def test_subscriptions_command_no_subscriber_id(self):
+        """The fitapp_subscriptions command requires FITAPP_SUBSCRIBER_ID."""
+        with self.settings():
+            del settings.FITAPP_SUBSCRIBER_ID
+            with self.assertRaisesRegexp(management.CommandError,
+                                         'FITAPP_SUBSCRIBER_ID must be set'):
+                management.call_command(
+                    'fitapp_subscriptions', stdout=StringIO())
+
+    @patch.object(fitapp_subscriptions.Command, 'sync')
+    def test_subscriptions_command_concurrency(self, sync):
+        """Test the fitapp_subscriptions command with a pool of threads."""
+        pks = [self.fbuser.pk] + [
+            self.create_userfitbit().pk for i in range(4)]
+        outcomes = dict(zip(pks, [
+            (0, 0), (1, 0), (0, 2), (1, 1), 'Timeout']))
+        sync.side_effect = lambda pk: outcomes[pk]
+
+        out = StringIO()
+        management.call_command(
+            'fitapp_subscriptions', 'apply', concurrency=3, stdout=out)
+
+        self.assertEqual(
+            sorted(c[0][0] for c in sync.call_args_list), sorted(pks))
+        output = out.getvalue()
+        self.assertIn('Checked 5 users', output)
+        self.assertIn('Subscribed: 1', output)
+        self.assertIn('Created subscriptions: 2', output)
+        self.assertIn('Deleted subscriptions: 3', output)
+        self.assertIn('Timeout: 1', output)
+
+    def _create_data(self):
+        steps = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='steps')
+        water = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.foods, resource='log/water')
+        user2 = self.create_user()
+        for user, _type, day, value in (
+                (self.user, steps, '2017-01-02', '200'),
+                (self.user, steps, '2017-01-01', '100'),
+                (self.user, water, '2017-01-01', '1.5'),
+                (user2, steps, '2017-01-03', None)):
+            TimeSeriesData.objects.create(
+                user=user, resource_type=_type, date=day, value=value)
+        return user2
+
+    def test_export_command_csv(self):
+        """Test the fitapp_export command with CSV output."""
+        user2 = self._create_data()
+        out, err = StringIO(), StringIO()
+        management.call_command('fitapp_export', stdout=out, stderr=err)
+
+        self.assertEqual(out.getvalue().splitlines(), [
+            'user_id,type,date,value',
+            '{},activities/steps,2017-01-01,100'.format(self.user.id),
+            '{},activities/steps,2017-01-02,200'.format(self.user.id),
+            '{},foods/log/water,2017-01-01,1.5'.format(self.user.id),
+            '{},activities/steps,2017-01-03,'.format(user2.id),
+        ])
+        self.assertIn('Exported 4 rows', err.getvalue())
+
+    def test_export_command_ndjson_filters(self):
+        """Test the fitapp_export command with NDJSON output and filters."""
+        self._create_data()
+        out, err = StringIO(), StringIO()
+        management.call_command(
+            'fitapp_export', format='ndjson', users=[self.user.id],
+            types=['activities/steps'], start_date='2017-01-02',
+            end_date='2017-01-02', stdout=out, stderr=err)
+
+        self.assertEqual(
+            [json.loads(line) for line in out.getvalue().splitlines()],
+            [{'user_id': self.user.id, 'type': 'activities/steps',
+              'date': '2017-01-02', 'value': '200'}])
+        self.assertIn('Exported 1 rows', err.getvalue())
+
+    def test_export_command_archived(self):
+        """The fitapp_export command includes archived months of data."""
+        self._create_data()
+        steps = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='steps')
+        archive = TimeSeriesDataArchive(
+            user=self.user, resource_type=steps, month=date(2016, 12, 1))
+        archive.set_days({date(2016, 12, 31): '50'})
+        archive.save()
+        archive = TimeSeriesDataArchive(
+            user=self.user, resource_type=steps, month=date(2017, 1, 1))
+        archive.set_days({date(2017, 1, 2): '150', date(2017, 1, 3): '300'})
+        archive.save()
+        out, err = StringIO(), StringIO()
+        management.call_command(
+            'fitapp_export', users=[self.user.id], types=['activities/steps'],
+            start_date='2016-12-31', stdout=out, stderr=err)
+
+        # Live data takes precedence over the archived day of 2017-01-02
+        self.assertEqual(out.getvalue().splitlines(), [
+            'user_id,type,date,value',
+            '{},activities/steps,2016-12-31,50'.format(self.user.id),
+            '{},activities/steps,2017-01-01,100'.format(self.user.id),
+            '{},activities/steps,2017-01-02,200'.format(self.user.id),
+            '{},activities/steps,2017-01-03,300'.format(self.user.id),
+        ])
+        self.assertIn('Exported 4 rows', err.getvalue())
+
+    def test_export_command_file(self):
+        """Test the fitapp_export command writing to a file."""
+        self._create_data()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'export.csv')
+        out, err = StringIO(), StringIO()
+        management.call_command(
+            'fitapp_export', output=path, stdout=out, stderr=err)
+
+        self.assertEqual(out.getvalue(), '')
+        with open(path) as f:
+            self.assertEqual(len(f.read().splitlines()), 5)
+
+    def test_export_command_bad_type(self):
+        """The fitapp_export command rejects unknown data types."""
+        with self.assertRaises(management.CommandError):
+            management.call_command(
+                'fitapp_export', types=['activities/bogus'], stdout=StringIO(),
+                stderr=StringIO())
+
+    def test_partitions_command_unsupported(self):
+        """The fitapp_partitions command requires PostgreSQL."""
+        with self.assertRaises(management.CommandError) as cm:
+            management.call_command('fitapp_partitions', 'list')
+        self.assertIn('PostgreSQL', str(cm.exception))
+
+    @patch('fitapp.partitions.create_partitions')
+    @patch('fitapp.partitions.is_partitioned')
+    @patch('fitapp.partitions.check_support')
+    def test_partitions_command_create(self, check_support, is_partitioned,
+                                       create_partitions):
+        """The fitapp_partitions command creates upcoming partitions."""
+        is_partitioned.return_value = True
+        create_partitions.return_value = ['fitapp_timeseriesdata_y2019']
+        out = StringIO()
+        management.call_command('fitapp_partitions', 'create', stdout=out)
+
+        self.assertEqual(out.getvalue().splitlines(), [
+            'Created 1 partitions', '    fitapp_timeseriesdata_y2019'])
+
+        is_partitioned.return_value = False
+        with self.assertRaises(management.CommandError):
+            management.call_command('fitapp_partitions', 'create')
+
+    @patch('fitapp.partitions.detach_partitions')
+    @patch('fitapp.partitions.is_partitioned')
+    @patch('fitapp.partitions.check_support')
+    def test_partitions_command_detach(self, check_support, is_partitioned,
+                                       detach_partitions):
+        """The fitapp_partitions command detaches old partitions."""
+        is_partitioned.return_value = True
+        detach_partitions.return_value = ['fitapp_timeseriesdata_y2015']
+        with self.assertRaises(management.CommandError):
+            management.call_command('fitapp_partitions', 'detach')
+        out = StringIO()
+        management.call_command(
+            'fitapp_partitions', 'detach', '--before', '2016-01-01', '--drop',
+            stdout=out)
+
+        detach_partitions.assert_called_once_with(
+            date(2016, 1, 1), drop=True)
+        self.assertIn('Detached 1 partitions', out.getvalue())
+
+
+class TestPartitions(FitappTestBase):
+    """Tests for the partition date ranges."""
+
+    def test_yearly_partitions(self):
+        self.assertEqual(
+            partitions.partition_ranges(
+                date(2016, 6, 1), date(2018, 1, 1), 'year'),
+            [('fitapp_timeseriesdata_y2016', date(2016, 1, 1),
+              date(2017, 1, 1)),
+             ('fitapp_timeseriesdata_y2017', date(2017, 1, 1),
+              date(2018, 1, 1)),
+             ('fitapp_timeseriesdata_y2018', date(2018, 1, 1),
+              date(2019, 1, 1))])
+
+    def test_monthly_partitions(self):
+        self.assertEqual(
+            partitions.partition_ranges(
+                date(2016, 11, 15), date(2017, 1, 15), 'month'),
+            [('fitapp_timeseriesdata_m2016_11', date(2016, 11, 1),
+              date(2016, 12, 1)),
+             ('fitapp_timeseriesdata_m2016_12', date(2016, 12, 1),
+              date(2017, 1, 1)),
+             ('fitapp_timeseriesdata_m2017_01', date(2017, 1, 1),
+              date(2017, 2, 1))])
+
+    def test_invalid_interval(self):
+        self.assertRaises(ValueError, partitions.partition_ranges,
+                          date(2016, 1, 1), date(2017, 1, 1), 'week')
+
+    @freeze_time('2016-11-15')
+    @override_settings(FITAPP_PARTITIONS_AHEAD=3)
+    def test_future_end(self):
+        self.assertEqual(partitions.future_end('year'), date(2019, 1, 1))
+        self.assertEqual(partitions.future_end('month'), date(2017, 2, 1))
+
+    @patch('fitapp.partitions.list_partitions')
+    def test_detach_partitions(self, list_partitions):
+        """Old partitions are detached without CONCURRENTLY, which PostgreSQL
+        doesn't allow on a table with a default partition
+        """
+        list_partitions.return_value = [
+            (partitions.DEFAULT_PARTITION, None, None),
+            ('fitapp_timeseriesdata_y2015', date(2015, 1, 1),
+             date(2016, 1, 1)),
+            ('fitapp_timeseriesdata_y2016', date(2016, 1, 1),
+             date(2017, 1, 1)),
+        ]
+        with patch.object(connection, 'cursor') as cursor:
+            detached = partitions.detach_partitions(
+                date(2016, 6, 1), drop=True)
+
+        self.assertEqual(detached, ['fitapp_timeseriesdata_y2015'])
+        execute = cursor.return_value.__enter__.return_value.execute
+        # Leave out the savepoints of the test's transaction
+        self.assertEqual([args[0] for args, _ in execute.call_args_list
+                          if 'SAVEPOINT' not in args[0]], [
+            'ALTER TABLE "fitapp_timeseriesdata" '
+            'DETACH PARTITION "fitapp_timeseriesdata_y2015"',
+            'DROP TABLE "fitapp_timeseriesdata_y2015"',
+        ])
+
+    def _create_partitions(self, default_rows):
+        with patch.object(connection, 'cursor') as cursor, patch(
+                'fitapp.partitions.list_partitions') as list_partitions:
+            list_partitions.return_value = [
+                (partitions.DEFAULT_PARTITION, None, None),
+                ('fitapp_timeseriesdata_y2016', date(2016, 1, 1),
+                 date(2017, 1, 1)),
+            ]
+            execute = cursor.return_value.__enter__.return_value.execute
+            fetchone = cursor.return_value.__enter__.return_value.fetchone
+            fetchone.return_value = (1,) if default_rows else None
+            created = partitions.create_partitions()
+
+        self.assertEqual(created, ['fitapp_timeseriesdata_y2017'])
+        # Leave out the savepoints of the test's transaction
+        return [args for args, _ in execute.call_args_list
+                if 'SAVEPOINT' not in args[0]]
+
+    @freeze_time('2016-06-01')
+    @override_settings(FITAPP_PARTITIONS_AHEAD=1)
+    def test_create_partitions(self):
+        """The missing partitions are created"""
+        in_range = [date(2017, 1, 1), date(2018, 1, 1)]
+        self.assertEqual(self._create_partitions(default_rows=False), [
+            ('SELECT 1 FROM "fitapp_timeseriesdata_default" '
+             'WHERE date >= %s AND date < %s LIMIT 1', in_range),
+            ('CREATE TABLE "fitapp_timeseriesdata_y2017" PARTITION OF '
+             '"fitapp_timeseriesdata" FOR VALUES FROM (%s) TO (%s)',
+             in_range),
+        ])
+
+    @freeze_time('2016-06-01')
+    @override_settings(FITAPP_PARTITIONS_AHEAD=1)
+    def test_create_partitions_default_rows(self):
+        """Rows of the default partition are moved into new partitions"""
+        in_range = [date(2017, 1, 1), date(2018, 1, 1)]
+        self.assertEqual(self._create_partitions(default_rows=True), [
+            ('SELECT 1 FROM "fitapp_timeseriesdata_default" '
+             'WHERE date >= %s AND date < %s LIMIT 1', in_range),
+            ('ALTER TABLE "fitapp_timeseriesdata" DETACH PARTITION '
+             '"fitapp_timeseriesdata_default"',),
+            ('CREATE TABLE "fitapp_timeseriesdata_y2017" PARTITION OF '
+             '"fitapp_timeseriesdata" FOR VALUES FROM (%s) TO (%s)',
+             in_range),
+            ('INSERT INTO "fitapp_timeseriesdata_y2017" SELECT * FROM '
+             '"fitapp_timeseriesdata_default" WHERE date >= %s AND date < %s',
+             in_range),
+            ('DELETE FROM "fitapp_timeseriesdata_default" '
+             'WHERE date >= %s AND date < %s', in_range),
+            ('ALTER TABLE "fitapp_timeseriesdata" ATTACH PARTITION '
+             '"fitapp_timeseriesdata_default" DEFAULT',),
+        ])
+
+    def _migrate(self):
+        migration = import_module(
+            'fitapp.migrations.0009_partition_timeseriesdata')
+        apps = MigrationLoader(connection).project_state(
+            ('fitapp', '0009_partition_timeseriesdata')).apps
+        schema_editor = MagicMock()
+        schema_editor.connection.vendor = 'postgresql'
+        schema_editor.connection.pg_version = 120000
+        schema_editor.connection.ops = connection.ops
+        cursor = schema_editor.connection.cursor.return_value.__enter__
+        cursor.return_value.fetchone.side_effect = [
+            None, (date(2017, 6, 1),), ('fitapp_timeseriesdata_id_seq',)]
+        migration.forwards(apps, schema_editor)
+        return [args[0] for args, _ in
+                cursor.return_value.execute.call_args_list]
+
+    @freeze_time('2017-06-01')
+    @override_settings(FITAPP_PARTITION_TIME_SERIES=True,
+                       FITAPP_PARTITIONS_AHEAD=1)
+    def test_migration(self):
+        """The migration converts the table with its own SQL"""
+        statements = self._migrate()
+        self.assertEqual(len(statements), 17)
+        self.assertIn(
+            'CREATE TABLE "fitapp_timeseriesdata_y2018" PARTITION OF '
+            '"fitapp_timeseriesdata_new" FOR VALUES FROM (%s) TO (%s)',
+            statements)
+        self.assertIn(
+            'ALTER TABLE "fitapp_timeseriesdata" ADD FOREIGN KEY (user_id) '
+            'REFERENCES "auth_user" (id) DEFERRABLE INITIALLY DEFERRED',
+            statements)
+
+    def test_migration_disabled(self):
+        """The migration does nothing unless partitioning is enabled"""
+        self.assertEqual(self._migrate(), [])
+
+    @override_settings(FITAPP_PARTITION_TIME_SERIES=True)
+    @patch('fitapp.tasks.logger')
+    @patch('fitapp.partitions.is_partitioned', return_value=False)
+    @patch('fitapp.partitions.check_support')
+    def test_partitions_task_not_converted(self, check_support,
+                                           is_partitioned, logger):
+        """The partitions task warns when the table wasn't converted"""
+        create_time_series_partitions.apply_async()
+        self.assertEqual(logger.warning.call_count, 1)
@@ -0,0 +1,242 @@
+import json
+import sys
+import threading
+
+from datetime import date
+from unittest import skipIf
+
+from django.core import management
+from django.test.utils import override_settings
+from django.utils.six import StringIO
+from django.utils.six.moves import BaseHTTPServer
+from fitbit import Fitbit
+from mock import patch
+
+try:
+    import asyncio
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from fitapp import utils
+from fitapp.models import TimeSeriesData, TimeSeriesDataType, UserFitbit
+from fitapp.tasks import get_time_series_data_batch
+
+from .base import FitappTransactionTestBase
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the responses queued for each path in ``server.responses``"""
+
+    def do_GET(self):
+        self.server.requests.append(
+            (self.path, self.headers.get('Authorization')))
+        responses = self.server.responses.get(self.path)
+        status, body, headers = responses.pop(0) if responses else (
+            404, {}, {})
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode('utf8'))
+
+    def log_message(self, *args):
+        pass
+
+
+@skipIf(sys.version_info < (3, 5) or aiohttp is None,
+        'The fetch engine requires Python 3.5+ and aiohttp')
+class TestFetchEngine(FitappTransactionTestBase):
+    def setUp(self):
+        super(TestFetchEngine, self).setUp()
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.requests = []
+        self.server.responses = {}
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        endpoint = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        patcher = patch.object(Fitbit, 'API_ENDPOINT', endpoint)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _respond(self, fbuser, resource, dates, *responses):
+        path = '/1/user/{}/{}/date/{}.json'.format(
+            fbuser.fitbit_user, resource, dates)
+        self.server.responses[path] = list(responses)
+        return path
+
+    def _data(self, resource, *values):
+        return {resource.replace('/', '-'): [
+            {'dateTime': '2017-01-0{}'.format(i + 1), 'value': str(value)}
+            for i, value in enumerate(values)]}
+
+    def _request(self, fitbit_user, resource, date=None, end_date=None):
+        return [fitbit_user, TimeSeriesDataType.activities, resource, date,
+                end_date]
+
+    def _run(self, requests, **kwargs):
+        from fitapp.engine import FetchEngine
+        # SQLite's shared in-memory test database can't take writes from
+        # several threads at a time
+        kwargs.setdefault('threads', 1)
+        return FetchEngine(**kwargs).run(requests)
+
+    def test_fetch(self):
+        """The engine retrieves and stores the data of many users."""
+        fbuser2 = self.create_userfitbit()
+        headers = {'Fitbit-Rate-Limit-Limit': '150',
+                   'Fitbit-Rate-Limit-Remaining': '140',
+                   'Fitbit-Rate-Limit-Reset': '600'}
+        path1 = self._respond(
+            self.fbuser, 'activities/steps', '2017-01-01/2017-01-02',
+            (200, self._data('activities/steps', 10, 20), headers))
+        path2 = self._respond(
+            fbuser2, 'activities/steps', 'today/max',
+            (200, self._data('activities/steps', 30), {}))
+
+        outcomes = self._run([
+            self._request(self.fbuser.fitbit_user, 'steps', date(2017, 1, 1),
+                          '2017-01-02'),
+            self._request(fbuser2.fitbit_user, 'steps'),
+        ], concurrency=2)
+
+        self.assertEqual(outcomes, {'success': 2})
+        self.assertEqual(sorted(self.server.requests), sorted([
+            (path1, 'Bearer ' + self.fbuser.access_token),
+            (path2, 'Bearer ' + fbuser2.access_token),
+        ]))
+        self.assertEqual(sorted(TimeSeriesData.objects.values_list(
+            'user_id', 'date', 'value')), sorted([
+                (self.user.id, date(2017, 1, 1), '10'),
+                (self.user.id, date(2017, 1, 2), '20'),
+                (fbuser2.user_id, date(2017, 1, 1), '30'),
+            ]))
+        self.assertEqual(
+            utils.get_rate_limit(self.fbuser.fitbit_user)['remaining'], 140)
+
+    def test_blocking_refresh(self):
+        """Other users' data is retrieved while a refresh blocks."""
+        fbuser2 = self.create_userfitbit()
+        UserFitbit.objects.filter(pk=self.fbuser.pk).update(expires_at=0)
+        self._respond(
+            self.fbuser, 'activities/steps', 'today/max',
+            (200, self._data('activities/steps', 10), {}))
+        self._respond(
+            fbuser2, 'activities/steps', 'today/max',
+            (200, self._data('activities/steps', 30), {}))
+        saved = threading.Event()
+        refreshed = []
+        save_time_series_data = utils.save_time_series_data
+
+        def refresh(fbuser):
+            refreshed.append(saved.wait(5))
+
+        def save(user, _type, data):
+            save_time_series_data(user, _type, data)
+            saved.set()
+
+        with patch('fitapp.utils.refresh_access_token', refresh), \
+                patch('fitapp.utils.save_time_series_data', save):
+            outcomes = self._run([
+                self._request(self.fbuser.fitbit_user, 'steps'),
+                self._request(fbuser2.fitbit_user, 'steps'),
+            ], threads=2)
+
+        self.assertEqual(outcomes, {'success': 2})
+        # The refresh only returned once the other user's data was saved
+        self.assertEqual(refreshed, [True])
+        self.assertEqual(TimeSeriesData.objects.count(), 2)
+
+    @patch('fitapp.engine.asyncio.sleep')
+    def test_errors(self, sleep):
+        """Failures are counted by the name of the error."""
+        sleep.side_effect = lambda delay: self._sleep(delay)
+        self._respond(
+            self.fbuser, 'activities/steps', '2017-01-01/2017-01-01',
+            (429, {}, {'Retry-After': '30'}),
+            (200, self._data('activities/steps', 10), {}))
+        self._respond(
+            self.fbuser, 'activities/floors', '2017-01-01/2017-01-01',
+            (400, {}, {}))
+        self._respond(
+            self.fbuser, 'activities/steps', '2017-01-02/2017-01-02',
+            (401, {}, {}))
+        self._respond(
+            self.fbuser, 'activities/steps', '2017-01-03/2017-01-03',
+            (503, {}, {}))
+
+        outcomes = self._run([
+            self._request(self.fbuser.fitbit_user, 'steps', '2017-01-01'),
+            self._request(self.fbuser.fitbit_user, 'floors', '2017-01-01'),
+            self._request(self.fbuser.fitbit_user, 'steps', '2017-01-02'),
+            self._request(self.fbuser.fitbit_user, 'steps', '2017-01-03'),
+            self._request(self.fbuser.fitbit_user, 'bogus', '2017-01-01'),
+            self._request('unknown', 'steps', '2017-01-01'),
+        ])
+
+        self.assertEqual(outcomes, {
+            'success': 2, 'HTTPUnauthorized': 1, 'HTTPServerError': 1,
+            'DoesNotExist': 2})
+        self.assertEqual(self.delays, [30])
+        self.assertEqual(TimeSeriesData.objects.count(), 1)
+
+    @override_settings(FITAPP_CIRCUIT_BREAKER_THRESHOLD=1)
+    def test_circuit_breaker(self):
+        """The engine stops calling Fitbit while it is failing."""
+        self._respond(
+            self.fbuser, 'activities/steps', '2017-01-01/2017-01-01',
+            (503, {}, {}))
+
+        outcomes = self._run([
+            self._request(self.fbuser.fitbit_user, 'steps', '2017-01-01'),
+            self._request(self.fbuser.fitbit_user, 'steps', '2017-01-02'),
+        ])
+
+        self.assertEqual(
+            outcomes, {'HTTPServerError': 1, 'CircuitOpenError': 1})
+        self.assertEqual(len(self.server.requests), 1)
+
+    def _sleep(self, delay):
+        self.delays = getattr(self, 'delays', []) + [delay]
+        future = asyncio.get_event_loop().create_future()
+        future.set_result(None)
+        return future
+
+    def test_batch_task(self):
+        """The batch task runs the engine and returns the outcomes."""
+        self._respond(
+            self.fbuser, 'activities/steps', '2017-01-01/2017-01-01',
+            (200, self._data('activities/steps', 10), {}))
+        result = get_time_series_data_batch.apply_async(([
+            self._request(self.fbuser.fitbit_user, 'steps', '2017-01-01'),
+            self._request(self.fbuser.fitbit_user, 'steps', '2017-01-02'),
+        ],))
+        self.assertEqual(result.get(), {'success': 1, 'HTTPNotFound': 1})
+
+    def test_fetch_command(self):
+        """The fitapp_fetch command retrieves data for the selected users."""
+        self.create_userfitbit()
+        self._respond(
+            self.fbuser, 'activities/steps', '2017-01-01/2017-01-02',
+            (200, self._data('activities/steps', 10, 20), {}))
+        out = StringIO()
+        management.call_command(
+            'fitapp_fetch', users=[self.user.id], types=['activities/steps'],
+            start_date=date(2017, 1, 1), end_date=date(2017, 1, 2),
+            stdout=out)
+
+        self.assertIn('Retrieved 1/1 time series', out.getvalue())
+        self.assertEqual(TimeSeriesData.objects.count(), 2)
+
+        with self.assertRaises(management.CommandError):
+            management.call_command(
+                'fitapp_fetch', types=['activities/bogus'], stdout=out)
+
+    @patch('fitapp.engine.aiohttp', None)
+    def test_fetch_command_without_aiohttp(self):
+        """The fitapp_fetch command requires aiohttp."""
+        with self.assertRaises(management.CommandError):
+            management.call_command('fitapp_fetch', stdout=StringIO())
@@ -3,11 +3,12 @@ import requests_mock
 import time
 
 from collections import OrderedDict
-from datetime import datetime
+from datetime import date, datetime
 
 from django.conf import settings
 from django.contrib import messages
-from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.http import HttpRequest
 from django.test.utils import override_settings
@@ -18,10 +19,14 @@ from requests.auth import _basic_auth_str
 
 from fitapp import utils
 from fitapp.decorators import fitbit_integration_warning
-from fitapp.models import UserFitbit, TimeSeriesDataType
-from fitapp.tasks import subscribe, unsubscribe
+from fitapp.models import (UserFitbit, TimeSeriesData, TimeSeriesDataArchive,
+                           TimeSeriesDataType)
+from fitapp.tasks import (
+    subscribe, unsubscribe, get_time_series_data, refresh_expiring_tokens,
+    refresh_token, purge_time_series_data, reconcile_time_series_data,
+    archive_time_series_data)
 
-from .base import FitappTestBase
+from .base import FitappTestBase, FitappTransactionTestBase
 
 
 class TestIntegrationUtility(FitappTestBase):
@@ -40,6 +45,27 @@ class TestIntegrationUtility(FitappTestBase):
         user = AnonymousUser()
         self.assertFalse(utils.is_integrated(user))
 
+    def test_is_integrated_cached(self):
+        """Integration status is remembered on the user and in the cache."""
+        cache.clear()
+        with self.assertNumQueries(1):
+            self.assertTrue(utils.is_integrated(self.user))
+        with self.assertNumQueries(0):
+            self.assertTrue(utils.is_integrated(self.user))
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(utils.is_integrated(user))
+
+    def test_is_integrated_invalidated(self):
+        """Saving or deleting a UserFitbit updates the cached status."""
+        self.assertTrue(utils.is_integrated(self.user))
+        self.fbuser.delete()
+        user = User.objects.get(pk=self.user.pk)
+        self.assertFalse(utils.is_integrated(user))
+        self.create_userfitbit(user=self.user)
+        user = User.objects.get(pk=self.user.pk)
+        self.assertTrue(utils.is_integrated(user))
+
 
 class TestIntegrationDecorator(FitappTestBase):
 
@@ -168,21 +194,22 @@ class TestCompleteView(FitappTestBase):
             (fbuser.fitbit_user, settings.FITAPP_SUBSCRIBER_ID), countdown=5)
         tsdts = TimeSeriesDataType.objects.all()
         self.assertEqual(tsd_apply_async.call_count, tsdts.count())
-        for i, _type in enumerate(tsdts):
+        for _type in tsdts:
             tsd_apply_async.assert_any_call(
                 (fbuser.fitbit_user, _type.category, _type.resource,),
-                countdown=10 + (i * 5))
+                countdown=10, priority=0)
         self.assertEqual(fbuser.user, self.user)
         self.assertEqual(fbuser.access_token, self.token['access_token'])
         self.assertEqual(fbuser.refresh_token, self.token['refresh_token'])
         self.assertEqual(fbuser.fitbit_user, self.user_id)
 
     @override_settings(FITAPP_HISTORICAL_INIT_DELAY=11)
-    @override_settings(FITAPP_BETWEEN_DELAY=6)
+    @override_settings(FITAPP_TASK_PRIORITIES={
+        'today': 0, 'recent': 1, 'historical': 2})
     @patch('fitapp.tasks.subscribe.apply_async')
     @patch('fitapp.tasks.get_time_series_data.apply_async')
     def test_complete_different_delays(self, tsd_apply_async, sub_apply_async):
-        """Complete view should use configured delays"""
+        """Complete view should use the configured delay and priority"""
         tsdts = TimeSeriesDataType.objects.all()
         response = self._mock_client(
             client_kwargs=self.token, get_kwargs={'code': self.code})
@@ -190,10 +217,28 @@ class TestCompleteView(FitappTestBase):
 
         self.assertRedirectsNoFollow(
             response, utils.get_setting('FITAPP_LOGIN_REDIRECT'))
-        for i, _type in enumerate(tsdts):
+        for _type in tsdts:
+            tsd_apply_async.assert_any_call(
+                (fbuser.fitbit_user, _type.category, _type.resource,),
+                countdown=11, priority=2)
+
+    @override_settings(FITAPP_QUEUES={
+        'realtime': 'rt', 'backfill': 'bf', 'subscriptions': 'subs'})
+    @patch('fitapp.tasks.subscribe.apply_async')
+    @patch('fitapp.tasks.get_time_series_data.apply_async')
+    def test_complete_queues(self, tsd_apply_async, sub_apply_async):
+        """Complete view should use the configured queues"""
+        self._mock_client(
+            client_kwargs=self.token, get_kwargs={'code': self.code})
+        fbuser = UserFitbit.objects.get()
+
+        sub_apply_async.assert_called_once_with(
+            (fbuser.fitbit_user, settings.FITAPP_SUBSCRIBER_ID), countdown=5,
+            queue='subs')
+        for _type in TimeSeriesDataType.objects.all():
             tsd_apply_async.assert_any_call(
                 (fbuser.fitbit_user, _type.category, _type.resource,),
-                countdown=11 + (i * 6))
+                countdown=10, priority=0, queue='bf')
 
     @override_settings(FITAPP_SUBSCRIPTIONS=OrderedDict([]))
     @patch('fitapp.tasks.subscribe.apply_async')
@@ -256,17 +301,14 @@ class TestCompleteView(FitappTestBase):
 
         self.assertRedirectsNoFollow(
             response, utils.get_setting('FITAPP_LOGIN_REDIRECT'))
-        tsd_apply_async.assert_any_call(
-            (fbuser.fitbit_user, activities, 'steps',), countdown=10)
-        tsd_apply_async.assert_any_call(
-            (fbuser.fitbit_user, activities, 'calories',), countdown=15)
-        tsd_apply_async.assert_any_call(
-            (fbuser.fitbit_user, activities, 'distance',), countdown=20)
-        tsd_apply_async.assert_any_call(
-            (fbuser.fitbit_user, activities, 'activityCalories'), countdown=25)
-        tsd_apply_async.assert_any_call(
-            (fbuser.fitbit_user, TimeSeriesDataType.foods, 'log/water',),
-            countdown=30)
+        self.assertEqual(tsd_apply_async.call_args_list, [
+            (((fbuser.fitbit_user, activities, res),),
+             {'countdown': 10, 'priority': 0})
+            for res in ('steps', 'calories', 'distance', 'activityCalories')
+        ] + [
+            (((fbuser.fitbit_user, TimeSeriesDataType.foods, 'log/water'),),
+             {'countdown': 10, 'priority': 0})
+        ])
 
     @patch('fitapp.tasks.subscribe.apply_async')
     @patch('fitapp.tasks.get_time_series_data.apply_async')
@@ -287,6 +329,19 @@ class TestCompleteView(FitappTestBase):
         self.assertEqual(sub_apply_async.call_count, 0)
         self.assertEqual(tsd_apply_async.call_count, 0)
 
+    @patch('fitapp.tasks.subscribe.apply_async')
+    @patch('fitapp.tasks.get_time_series_data.apply_async')
+    @patch('django.contrib.auth.middleware.get_user')
+    def test_complete_is_integrated(self, get_user, tsd_apply_async,
+                                    sub_apply_async):
+        """Complete view should update the integration status of the user."""
+        get_user.return_value = self.user
+        self.assertFalse(utils.is_integrated(self.user))
+        self._mock_client(
+            client_kwargs=self.token, get_kwargs={'code': self.code})
+        self.assertEqual(UserFitbit.objects.count(), 1)
+        self.assertTrue(utils.is_integrated(self.user))
+
     def test_unauthenticated(self):
         """User must be logged in to access Complete view."""
         self.client.logout()
@@ -438,6 +493,51 @@ class TestLogoutView(FitappTestBase):
         subscription.assert_called_once_with(
             sub['subscriptionId'], sub['subscriberId'], method="DELETE")
 
+    @override_settings(FITAPP_PURGE_DATA=True)
+    @patch('fitapp.tasks.purge_time_series_data.apply_async')
+    @patch('fitapp.tasks.unsubscribe.apply_async')
+    def test_purge(self, unsub_apply_async, purge_apply_async):
+        """Logout view should queue a purge of the user's data if enabled."""
+        steps = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='steps')
+        tsd = TimeSeriesData.objects.create(
+            user=self.user, resource_type=steps, date='2017-01-01', value='1')
+        response = self._get()
+        purge_apply_async.assert_called_once_with(
+            (self.user.id, tsd.pk), countdown=5)
+        self.assertEqual(UserFitbit.objects.count(), 0)
+
+    @override_settings(FITAPP_PURGE_DATA=True, FITAPP_QUEUES={
+        'realtime': 'rt', 'backfill': 'bf', 'subscriptions': 'subs'})
+    @patch('fitapp.tasks.purge_time_series_data.apply_async')
+    @patch('fitapp.tasks.unsubscribe.apply_async')
+    def test_queues(self, unsub_apply_async, purge_apply_async):
+        """Logout view should use the configured queues."""
+        kwargs = self.fbuser.get_user_data()
+        del kwargs['refresh_cb']
+        self._get()
+        unsub_apply_async.assert_called_once_with(
+            kwargs=kwargs, countdown=5, queue='subs')
+        purge_apply_async.assert_called_once_with(
+            (self.user.id, None), countdown=5, queue='bf')
+
+    @patch('fitapp.tasks.purge_time_series_data.apply_async')
+    @patch('fitapp.tasks.unsubscribe.apply_async')
+    def test_no_purge(self, unsub_apply_async, purge_apply_async):
+        """Logout view should not purge the user's data by default."""
+        response = self._get()
+        self.assertEqual(purge_apply_async.call_count, 0)
+
+    @patch('fitapp.tasks.unsubscribe.apply_async')
+    @patch('django.contrib.auth.middleware.get_user')
+    def test_is_integrated(self, get_user, apply_async):
+        """Logout view should update the integration status of the user."""
+        get_user.return_value = self.user
+        self.assertTrue(utils.is_integrated(self.user))
+        self._get()
+        self.assertEqual(UserFitbit.objects.count(), 0)
+        self.assertFalse(utils.is_integrated(self.user))
+
     def test_unauthenticated(self):
         """User must be logged in to access Logout view."""
         self.client.logout()
@@ -495,6 +595,22 @@ class TestSubscription(FitappTestBase):
         subscription.assert_called_once_with(
             sub['subscriptionId'], sub['subscriberId'], method="DELETE")
 
+    @patch('fitbit.Fitbit.subscription')
+    @patch('fitbit.Fitbit.list_subscriptions')
+    def test_subscriptions_cache(self, list_subscriptions, subscription):
+        """Subscription listings are cached until subscriptions change."""
+        list_subscriptions.return_value = {'apiSubscriptions': []}
+        fb = utils.create_fitbit(**self.fbuser.get_user_data())
+        utils.get_subscriptions(fb, self.fbuser.fitbit_user)
+        utils.get_subscriptions(fb, self.fbuser.fitbit_user)
+        self.assertEqual(list_subscriptions.call_count, 1)
+        utils.get_subscriptions(fb, self.fbuser.fitbit_user, refresh=True)
+        self.assertEqual(list_subscriptions.call_count, 2)
+
+        subscribe.apply_async((self.fbuser.fitbit_user, 1,))
+        utils.get_subscriptions(fb, self.fbuser.fitbit_user)
+        self.assertEqual(list_subscriptions.call_count, 3)
+
     @patch('fitbit.Fitbit.subscription')
     @patch('fitbit.Fitbit.list_subscriptions')
     def test_unsubscribe_error(self, list_subscriptions, subscription):
@@ -505,3 +621,285 @@ class TestSubscription(FitappTestBase):
         self.assertEqual(result.status, 'REJECTED')
         list_subscriptions.assert_called_once_with()
         self.assertEqual(subscription.call_count, 0)
+
+
+class TestTokenRefresh(FitappTransactionTestBase):
+    token = {
+        'access_token': 'fake_access_token',
+        'refresh_token': 'fake_refresh_token',
+        'expires_at': time.time() + 28800,
+    }
+
+    @override_settings(FITAPP_TOKEN_REFRESH_BATCH_SIZE=2)
+    @patch('fitapp.tasks.refresh_token.apply_async')
+    def test_refresh_expiring_tokens(self, apply_async):
+        """Tokens expiring within the window are scheduled in batches."""
+        now = time.time()
+        self.fbuser.expires_at = now + 100
+        self.fbuser.save()
+        soonest = self.create_userfitbit(expires_at=now - 100)
+        expiring = [self.create_userfitbit(expires_at=now + 200 + i)
+                    for i in range(3)]
+        self.create_userfitbit(expires_at=now + 7200)
+
+        refresh_expiring_tokens.apply_async()
+
+        self.assertEqual(apply_async.call_count, 5)
+        self.assertEqual(apply_async.call_args_list, [
+            (((soonest.fitbit_user,),), {'countdown': 0}),
+            (((self.fbuser.fitbit_user,),), {'countdown': 0}),
+            (((expiring[0].fitbit_user,),), {'countdown': 600}),
+            (((expiring[1].fitbit_user,),), {'countdown': 600}),
+            (((expiring[2].fitbit_user,),), {'countdown': 1200}),
+        ])
+
+    def test_refresh_token(self):
+        """An expiring token is refreshed, and only once."""
+        self.fbuser.expires_at = time.time() + 60
+        self.fbuser.save()
+        with requests_mock.mock() as m:
+            m.post('https://api.fitbit.com/oauth2/token',
+                   text=json.dumps(self.token))
+            refresh_token.apply_async((self.fbuser.fitbit_user,))
+            refresh_token.apply_async((self.fbuser.fitbit_user,))
+
+        self.assertEqual(m.call_count, 1)
+        fbuser = UserFitbit.objects.get()
+        self.assertEqual(fbuser.access_token, self.token['access_token'])
+        self.assertEqual(fbuser.refresh_token, self.token['refresh_token'])
+
+    def test_refresh_token_error(self):
+        """Failing to refresh a token rejects the task."""
+        self.fbuser.expires_at = time.time() - 60
+        self.fbuser.save()
+        with requests_mock.mock() as m:
+            m.post('https://api.fitbit.com/oauth2/token', text=json.dumps({
+                'errors': [{'errorType': 'invalid_grant'}],
+            }))
+            result = refresh_token.apply_async((self.fbuser.fitbit_user,))
+
+        self.assertEqual(result.status, 'REJECTED')
+
+
+class TestPurge(FitappTestBase):
+
+    def setUp(self):
+        super(TestPurge, self).setUp()
+        self.steps = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='steps')
+        self.fbuser.delete()
+
+    def _create_data(self, user, days):
+        for day in days:
+            TimeSeriesData.objects.create(
+                user=user, resource_type=self.steps,
+                date='2017-01-0{}'.format(day), value=str(day))
+        return TimeSeriesData.objects.filter(user=user).latest('pk').pk
+
+    @override_settings(FITAPP_PURGE_CHUNK_SIZE=2, FITAPP_PURGE_DELAY=0.5)
+    @patch('fitapp.tasks.time.sleep')
+    def test_purge_time_series_data(self, sleep):
+        """All of the user's data is deleted, a chunk at a time."""
+        other_user = self.create_user()
+        self._create_data(other_user, range(1, 6))
+        last_pk = self._create_data(self.user, range(1, 6))
+
+        purge_time_series_data.apply_async((self.user.id, last_pk))
+
+        self.assertEqual(
+            TimeSeriesData.objects.filter(user=self.user).count(), 0)
+        self.assertEqual(
+            TimeSeriesData.objects.filter(user=other_user).count(), 5)
+        # 3 chunks, with a pause between each
+        self.assertEqual(sleep.call_count, 2)
+        sleep.assert_called_with(0.5)
+
+    def test_purge_new_data(self):
+        """Data saved after the user logged out is left alone."""
+        last_pk = self._create_data(self.user, range(1, 4))
+        self._create_data(self.user, range(4, 6))
+
+        purge_time_series_data.apply_async((self.user.id, last_pk))
+
+        self.assertEqual(list(TimeSeriesData.objects.filter(
+            user=self.user).values_list('value', flat=True)), ['4', '5'])
+
+    def test_purge_integrated(self):
+        """Nothing is deleted if the user has integrated again."""
+        last_pk = self._create_data(self.user, range(1, 6))
+        self.create_userfitbit(user=self.user)
+
+        purge_time_series_data.apply_async((self.user.id, last_pk))
+
+        self.assertEqual(
+            TimeSeriesData.objects.filter(user=self.user).count(), 5)
+
+    @override_settings(FITAPP_PURGE_CHUNK_SIZE=2)
+    @patch('fitapp.tasks.time.sleep')
+    def test_purge_integrated_during_purge(self, sleep):
+        """The purge stops when the user integrates again."""
+        last_pk = self._create_data(self.user, range(1, 6))
+        sleep.side_effect = lambda seconds: self.create_userfitbit(
+            user=self.user)
+
+        purge_time_series_data.apply_async((self.user.id, last_pk))
+
+        self.assertEqual(
+            TimeSeriesData.objects.filter(user=self.user).count(), 3)
+
+    def test_purge_archived_data(self):
+        """The user's archived data is deleted too."""
+        TimeSeriesDataArchive.objects.create(
+            user=self.user, month=date(2017, 1, 1), values='[]',
+            resource_type=self.steps)
+
+        purge_time_series_data.apply_async((self.user.id, None))
+
+        self.assertEqual(TimeSeriesDataArchive.objects.count(), 0)
+
+    def test_purge_no_data(self):
+        """Purging a user without any data does nothing."""
+        result = purge_time_series_data.apply_async((self.user.id, None))
+        self.assertTrue(result.successful())
+
+
+@freeze_time('2017-01-08 12:00:00')
+@override_settings(FITAPP_SUBSCRIPTIONS={'activities': ['steps']})
+class TestReconcile(FitappTestBase):
+
+    def setUp(self):
+        super(TestReconcile, self).setUp()
+        self.steps = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='steps')
+        for day in (1, 2, 5, 6, 7):
+            TimeSeriesData.objects.create(
+                user=self.user, resource_type=self.steps,
+                date=date(2017, 1, day), value=str(day))
+
+    @override_settings(FITAPP_RECONCILE_DAYS=7, FITAPP_QUEUES={
+        'realtime': 'rt', 'backfill': 'bf', 'subscriptions': 'subs'})
+    @patch('fitapp.utils.get_rate_limit_delay')
+    @patch('fitapp.tasks.get_time_series_data.apply_async')
+    def test_reconcile(self, tsd_apply_async, delay):
+        """Only the missing date ranges are retrieved"""
+        delay.return_value = 5
+        # Data of a disconnected user is left alone
+        other_user = self.create_user()
+        TimeSeriesData.objects.create(
+            user=other_user, resource_type=self.steps,
+            date=date(2017, 1, 3), value='3')
+
+        result = reconcile_time_series_data.apply_async()
+
+        self.assertEqual(tsd_apply_async.call_count, 1)
+        tsd_apply_async.assert_called_with(
+            (self.fbuser.fitbit_user, self.steps.category, 'steps'),
+            {'date': date(2017, 1, 3), 'end_date': date(2017, 1, 4),
+             'queue': 'backfill', 'priority': 6},
+            countdown=0, priority=6, queue='bf')
+        self.assertEqual(result.get(), {self.user.id: 5 / 7.0,
+                                        other_user.id: 1 / 7.0})
+
+    @override_settings(FITAPP_RECONCILE_DAYS=7)
+    @patch('fitapp.tasks.get_time_series_data.apply_async')
+    def test_reconcile_no_data(self, tsd_apply_async):
+        """Integrated users without any data in the period are reconciled"""
+        fbuser = self.create_userfitbit()
+
+        result = reconcile_time_series_data.apply_async()
+
+        self.assertEqual(tsd_apply_async.call_count, 2)
+        self.assertEqual(tsd_apply_async.call_args_list[-1][0], (
+            (fbuser.fitbit_user, self.steps.category, 'steps'),
+            {'date': date(2017, 1, 1), 'end_date': date(2017, 1, 7),
+             'queue': 'backfill', 'priority': 9}))
+        self.assertEqual(result.get(), {self.user.id: 5 / 7.0,
+                                        fbuser.user_id: 0.0})
+
+    @override_settings(FITAPP_QUEUES={
+        'realtime': 'rt', 'backfill': 'bf', 'subscriptions': 'subs'})
+    @patch('fitapp.utils.get_rate_limit_delay')
+    def test_reconcile_deferred(self, delay):
+        """Deferred backfills stay on the backfill queue"""
+        delay.return_value = 30
+        kwargs = {'date': date(2017, 1, 3), 'end_date': date(2017, 1, 4),
+                  'queue': 'backfill', 'priority': 0}
+        args = (self.fbuser.fitbit_user, self.steps.category, 'steps')
+        with patch('fitapp.tasks.get_time_series_data.apply_async') as aa:
+            get_time_series_data.apply(args, kwargs)
+
+        aa.assert_called_once_with(
+            args, kwargs, countdown=30, priority=0, queue='bf')
+
+    @override_settings(FITAPP_RECONCILE_DAYS=3)
+    @patch('fitapp.tasks.get_time_series_data.apply_async')
+    def test_reconcile_complete(self, tsd_apply_async):
+        """Nothing is retrieved when no data is missing"""
+        result = reconcile_time_series_data.apply_async()
+
+        self.assertEqual(tsd_apply_async.call_count, 0)
+        self.assertEqual(result.get(), {self.user.id: 1.0})
+
+    @patch('fitapp.utils.get_fitbit_data')
+    def test_retrieve_range(self, get_fitbit_data):
+        """A range of dates is retrieved with a single API call"""
+        get_fitbit_data.return_value = [
+            {'dateTime': '2017-01-03', 'value': '3'},
+            {'dateTime': '2017-01-04', 'value': '4'},
+        ]
+        get_time_series_data.apply_async(
+            (self.fbuser.fitbit_user, self.steps.category, 'steps'),
+            {'date': date(2017, 1, 3), 'end_date': date(2017, 1, 4)})
+
+        self.assertEqual(get_fitbit_data.call_count, 1)
+        self.assertEqual(get_fitbit_data.call_args[1], {
+            'base_date': date(2017, 1, 3), 'end_date': date(2017, 1, 4)})
+        self.assertEqual(TimeSeriesData.objects.filter(
+            user=self.user, date__gte=date(2017, 1, 3),
+            date__lte=date(2017, 1, 4)).count(), 2)
+
+
+@freeze_time('2017-03-15 12:00:00')
+class TestArchive(FitappTestBase):
+
+    def setUp(self):
+        super(TestArchive, self).setUp()
+        self.steps = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='steps')
+        self.water = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.foods, resource='log/water')
+        archive = TimeSeriesDataArchive(
+            user=self.user, resource_type=self.steps, month=date(2017, 1, 1))
+        archive.set_days({date(2017, 1, 1): '1', date(2017, 1, 30): '0'})
+        archive.save()
+        for _type, day in ((self.steps, date(2017, 1, 30)),
+                           (self.steps, date(2017, 1, 31)),
+                           (self.water, date(2016, 12, 31)),
+                           (self.steps, date(2017, 2, 1))):
+            TimeSeriesData.objects.create(
+                user=self.user, resource_type=_type, date=day,
+                value=str(day.day))
+
+    @override_settings(FITAPP_ARCHIVE_AFTER_DAYS=30)
+    def test_archive(self):
+        """Data of months that ended long enough ago is archived"""
+        archive_time_series_data.apply_async().get()
+
+        self.assertEqual(
+            list(TimeSeriesData.objects.values_list('date', flat=True)),
+            [date(2017, 2, 1)])
+        archives = TimeSeriesDataArchive.objects.order_by('month')
+        self.assertEqual(
+            [(a.resource_type, a.month, a.days()) for a in archives], [
+                (self.water, date(2016, 12, 1), [(date(2016, 12, 31), '31')]),
+                (self.steps, date(2017, 1, 1), [(date(2017, 1, 1), '1'),
+                                                (date(2017, 1, 30), '30'),
+                                                (date(2017, 1, 31), '31')]),
+            ])
+
+    def test_archive_disabled(self):
+        """No data is archived by default"""
+        archive_time_series_data.apply_async()
+
+        self.assertEqual(TimeSeriesData.objects.count(), 4)
+        self.assertEqual(TimeSeriesDataArchive.objects.count(), 1)
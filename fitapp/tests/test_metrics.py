@@ -0,0 +1,144 @@
+import json
+import requests_mock
+import time
+
+from collections import OrderedDict
+
+from django.core.urlresolvers import reverse
+from django.test.utils import override_settings
+from fitbit.api import FitbitOauth2Client
+from fitbit.exceptions import HTTPTooManyRequests
+from mock import patch
+
+from fitapp import metrics
+from fitapp.models import TimeSeriesDataType
+from fitapp.utils import (create_fitbit, refresh_access_token,
+                          save_time_series_data)
+
+from .base import FitappTestBase, FitappTransactionTestBase
+
+
+@override_settings(FITAPP_METRICS_BACKEND='fitapp.metrics.MemoryBackend')
+class TestMetrics(FitappTestBase):
+    url = 'https://api.fitbit.com/1/user/-/profile.json'
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        self.metrics = metrics.get_backend()
+        self.metrics.reset()
+        self.steps = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='steps')
+
+    def test_backend(self):
+        """Counters are summed and timings are kept per name and tags"""
+        metrics.increment('api_calls', status=200)
+        metrics.increment('api_calls', 2, status=404)
+        metrics.timing('api_latency', 0.5)
+        with metrics.timed('db_write', resource='activities/steps'):
+            pass
+
+        self.assertEqual(self.metrics.count('api_calls'), 3)
+        self.assertEqual(self.metrics.count('api_calls', status=404), 2)
+        self.assertEqual(self.metrics.count('api_calls', status=500), 0)
+        self.assertEqual(self.metrics.times('api_latency'), [0.5])
+        self.assertEqual(len(self.metrics.times(
+            'db_write', resource='activities/steps')), 1)
+
+    @override_settings(FITAPP_METRICS_BACKEND=None)
+    def test_disabled(self):
+        """No metrics are collected without a backend"""
+        self.assertEqual(metrics.get_backend(), None)
+        metrics.increment('api_calls')
+        with metrics.timed('db_write'):
+            pass
+        fb = create_fitbit(**self.fbuser.get_user_data())
+        self.assertEqual(len(fb.client.session.hooks['response']), 1)
+
+    def test_api_calls(self):
+        """Fitbit API calls, their latency and 429s are recorded"""
+        fb = create_fitbit(**self.fbuser.get_user_data())
+        with requests_mock.mock() as m:
+            m.get(self.url, [
+                {'text': '{}'},
+                {'text': '{}', 'status_code': 429,
+                 'headers': {'Retry-After': '10'}},
+            ])
+            fb.user_profile_get()
+            self.assertRaises(HTTPTooManyRequests, fb.user_profile_get)
+
+        self.assertEqual(self.metrics.count('api_calls', status=200), 1)
+        self.assertEqual(self.metrics.count('api_calls', status=429), 1)
+        self.assertEqual(self.metrics.count('api_rate_limited'), 1)
+        self.assertEqual(len(self.metrics.times('api_latency')), 2)
+
+    def test_rows_written(self):
+        """Stored rows and the time it takes to store them are recorded"""
+        save_time_series_data(self.user, self.steps, [
+            {'dateTime': '2017-01-01', 'value': '10'},
+            {'dateTime': '2017-01-02', 'value': '20'},
+        ])
+
+        self.assertEqual(self.metrics.count(
+            'rows_written', resource='activities/steps'), 2)
+        self.assertEqual(len(self.metrics.times('db_write')), 1)
+
+        # Only the new and changed rows are counted when data is retrieved
+        # again
+        save_time_series_data(self.user, self.steps, [
+            {'dateTime': '2017-01-01', 'value': '10'},
+            {'dateTime': '2017-01-02', 'value': '25'},
+            {'dateTime': '2017-01-03', 'value': '30'},
+        ])
+
+        self.assertEqual(self.metrics.count(
+            'rows_written', resource='activities/steps'), 4)
+        self.assertEqual(len(self.metrics.times('db_write')), 2)
+
+    @override_settings(FITAPP_SUBSCRIPTIONS=OrderedDict([
+        ('activities', ['steps', 'distance']),
+    ]))
+    @patch('fitapp.tasks.get_time_series_data.apply_async')
+    def test_notifications(self, apply_async):
+        """Notifications and the tasks sent for them are counted"""
+        updates = [{
+            'collectionType': 'activities',
+            'date': '2017-01-01',
+            'ownerId': self.fbuser.fitbit_user,
+            'subscriptionId': self.user.id,
+        }] * 3
+        response = self.client.post(
+            reverse('fitbit-update'), data=json.dumps(updates),
+            content_type='application/json')
+
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.metrics.count('notifications'), 3)
+        self.assertEqual(self.metrics.count(
+            'tasks_dispatched', task='fitapp.tasks.get_time_series_data'), 6)
+        self.assertEqual(self.metrics.count('tasks_dispatched'), 6)
+
+    @override_settings(FITAPP_SUBSCRIBE=True)
+    def test_get_data(self):
+        """The get_data view is timed"""
+        self.client.get(reverse('fitbit-data', args=['activities', 'steps']),
+                        {'base_date': '2017-01-01', 'period': '1w'})
+        self.assertEqual(len(self.metrics.times('get_data')), 1)
+
+
+@override_settings(FITAPP_METRICS_BACKEND='fitapp.metrics.MemoryBackend')
+class TestTokenRefreshMetrics(FitappTransactionTestBase):
+    def setUp(self):
+        super(TestTokenRefreshMetrics, self).setUp()
+        self.metrics = metrics.get_backend()
+        self.metrics.reset()
+
+    def test_token_refreshes(self):
+        """Refreshed tokens are counted"""
+        with requests_mock.mock() as m:
+            m.post(FitbitOauth2Client.refresh_token_url, text=json.dumps({
+                'access_token': 'fake_access_token',
+                'refresh_token': 'fake_refresh_token',
+                'expires_at': time.time() + 300,
+            }))
+            refresh_access_token(self.fbuser)
+
+        self.assertEqual(self.metrics.count('token_refreshes'), 1)
@@ -1,4 +1,6 @@
-from fitapp.models import TimeSeriesDataType
+from datetime import date
+
+from fitapp.models import TimeSeriesDataArchive, TimeSeriesDataType, UserFitbit
 from django.db import IntegrityError
 
 from .base import FitappTestBase
@@ -24,6 +26,39 @@ class TestFitappModels(FitappTestBase):
         self.assertRaises(IntegrityError, self.create_userfitbit,
                           user=user2, fitbit_user=self.fbuser.fitbit_user)
 
+    def test_refresh_cb(self):
+        """ refresh_cb only saves the token fields """
+        UserFitbit.objects.filter(pk=self.fbuser.pk).update(fitbit_user='new')
+        token = {
+            'access_token': 'fake_access_token',
+            'refresh_token': 'fake_refresh_token',
+            'expires_at': 1234,
+        }
+        self.fbuser.refresh_cb(token)
+
+        fbuser = UserFitbit.objects.get()
+        self.assertEqual(fbuser.fitbit_user, 'new')
+        for obj in (self.fbuser, fbuser):
+            self.assertEqual(obj.access_token, token['access_token'])
+            self.assertEqual(obj.refresh_token, token['refresh_token'])
+            self.assertEqual(obj.expires_at, token['expires_at'])
+
+    def test_refresh_cb_lost_race(self):
+        """ refresh_cb keeps a token saved by another process """
+        UserFitbit.objects.filter(pk=self.fbuser.pk).update(
+            access_token='winner_access_token',
+            refresh_token='winner_refresh_token')
+        self.fbuser.refresh_cb({
+            'access_token': 'loser_access_token',
+            'refresh_token': 'loser_refresh_token',
+            'expires_at': 1234,
+        })
+
+        fbuser = UserFitbit.objects.get()
+        for obj in (self.fbuser, fbuser):
+            self.assertEqual(obj.access_token, 'winner_access_token')
+            self.assertEqual(obj.refresh_token, 'winner_refresh_token')
+
     def test_timeseriesdatatype(self):
         """ TimeSeriesDataTypes are created via fixtures. """
         self.assertEqual(TimeSeriesDataType.objects.count(), 36)
@@ -33,3 +68,21 @@ class TestFitappModels(FitappTestBase):
         assert hasattr(TimeSeriesDataType, 'foods')
         self.assertEqual(str(TimeSeriesDataType.objects.get(resource='steps')),
                          'activities/steps')
+
+    def test_timeseriesdataarchive(self):
+        """ A month of data is packed into a single JSON array """
+        archive = TimeSeriesDataArchive(
+            user=self.user, month=date(2017, 2, 1),
+            resource_type=TimeSeriesDataType.objects.get(resource='steps'))
+        archive.set_days({
+            date(2017, 2, 1): '100',
+            date(2017, 2, 3): '300',
+            date(2017, 2, 28): None,
+        })
+        archive.save()
+
+        archive = TimeSeriesDataArchive.objects.get()
+        self.assertEqual(archive.values, '["100",null,"300"{}]'.format(
+            ',null' * 25))
+        self.assertEqual(archive.days(), [
+            (date(2017, 2, 1), '100'), (date(2017, 2, 3), '300')])
@@ -0,0 +1,75 @@
+import os
+import pstats
+import shutil
+import tempfile
+
+from datetime import date
+
+from django.test.utils import override_settings
+from mock import patch
+
+from fitapp.models import TimeSeriesDataType
+from fitapp.tasks import get_time_series_data, subscribe
+
+from .base import FitappTestBase
+
+
+class TestProfiling(FitappTestBase):
+    def setUp(self):
+        super(TestProfiling, self).setUp()
+        self.profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profile_dir)
+        patcher = patch('fitapp.utils.get_fitbit_data', return_value=[
+            {'dateTime': '2017-01-01', 'value': '10'}])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _run_task(self, **settings):
+        settings.setdefault('FITAPP_PROFILE_DIR', self.profile_dir)
+        with override_settings(**settings):
+            get_time_series_data.apply_async(
+                (self.fbuser.fitbit_user, TimeSeriesDataType.activities,
+                 'steps'), {'date': date(2017, 1, 1)})
+        return sorted(os.listdir(self.profile_dir))
+
+    def test_profile(self):
+        """Profiles are written, named after the task, user and resource"""
+        profiles = self._run_task(FITAPP_PROFILE_RATE=1)
+
+        self.assertEqual(len(profiles), 1)
+        self.assertTrue(profiles[0].startswith(
+            'get_time_series_data-{}-activities-steps-'.format(
+                self.fbuser.fitbit_user)))
+        self.assertTrue(profiles[0].endswith('.prof'))
+        stats = pstats.Stats(os.path.join(self.profile_dir, profiles[0]))
+        self.assertTrue(any(
+            function == 'save_time_series_data'
+            for _, _, function in stats.stats))
+
+    def test_disabled(self):
+        """No tasks are profiled by default"""
+        self.assertEqual(self._run_task(), [])
+
+    @patch('fitapp.profiling.random.random')
+    def test_sample(self, random):
+        """Only the configured fraction of the executions is profiled"""
+        random.return_value = 0.5
+        self.assertEqual(self._run_task(FITAPP_PROFILE_RATE=0.25), [])
+        self.assertEqual(len(self._run_task(FITAPP_PROFILE_RATE=0.75)), 1)
+
+    def test_profile_dir(self):
+        """The profile directory is created as needed"""
+        profile_dir = os.path.join(self.profile_dir, 'profiles')
+        self._run_task(FITAPP_PROFILE_RATE=1, FITAPP_PROFILE_DIR=profile_dir)
+        self.assertEqual(len(os.listdir(profile_dir)), 1)
+
+    @override_settings(FITAPP_PROFILE_RATE=1)
+    @patch('fitbit.Fitbit.subscription')
+    def test_other_tasks(self, subscription):
+        """Tasks without a resource are named after the task and user"""
+        with override_settings(FITAPP_PROFILE_DIR=self.profile_dir):
+            subscribe.apply_async((self.fbuser.fitbit_user, 1))
+        profiles = os.listdir(self.profile_dir)
+        self.assertEqual(len(profiles), 1)
+        self.assertTrue(profiles[0].startswith(
+            'subscribe-{}-'.format(self.fbuser.fitbit_user)))
@@ -0,0 +1,167 @@
+import json
+
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils.dateparse import parse_date
+from mock import patch
+
+from fitapp.models import TimeSeriesData, TimeSeriesDataType
+from fitapp.tasks import get_time_series_data
+from fitapp.utils import QueryBudget, get_query_budget
+from fitapp.views import get_data, update
+
+from .base import FitappTestBase
+
+
+class TestQueryBudgets(FitappTestBase):
+    """The hot paths stay within their budgets in FITAPP_QUERY_BUDGETS"""
+
+    def setUp(self):
+        super(TestQueryBudgets, self).setUp()
+        self.factory = RequestFactory()
+        self.steps = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='steps')
+        self.start = date(2012, 1, 1)
+
+    @contextmanager
+    def assertQueryBudget(self, name, rows=0):
+        budget = get_query_budget(name, rows)
+        with override_settings(FITAPP_LOG_QUERY_BUDGETS=True), \
+                CaptureQueriesContext(connection) as queries, \
+                QueryBudget(name) as counter:
+            yield
+        self.assertLessEqual(
+            counter.queries, budget,
+            '{} made {} queries, over its budget of {}:\n{}'.format(
+                name, counter.queries, budget,
+                '\n'.join(query['sql'] for query in queries[:20])))
+
+    def _days(self, days):
+        return [{'dateTime': (self.start + timedelta(days=i)).strftime(
+            '%Y-%m-%d'), 'value': str(i)} for i in range(days)]
+
+    def _post_updates(self, count):
+        updates = [{
+            'collectionType': collection_type,
+            'date': '2017-01-01',
+            'ownerId': 'USER{}'.format(i),
+            'subscriptionId': i,
+        } for i in range(count // 4)
+            for collection_type in ('activities', 'foods', 'sleep', 'body')]
+        with self.assertQueryBudget('update'):
+            response = self._update(updates)
+        self.assertEqual(response.status_code, 204)
+
+    def _get_data(self, **params):
+        request = self.factory.get('/', params)
+        request.user = self.user
+        request.session = {}
+        with self.assertQueryBudget('get_data'):
+            response = get_data(request, 'activities', 'steps')
+        return json.loads(response.content.decode('utf8'))
+
+    def _update(self, updates):
+        request = self.factory.post(
+            '/', data=json.dumps(updates), content_type='application/json')
+        return update(request)
+
+    @patch('fitapp.tasks.get_intraday_time_series_data.apply_async')
+    @patch('fitapp.tasks.get_time_series_data.apply_async')
+    def test_update(self, *apply_asyncs):
+        """A large batch of notifications"""
+        self._post_updates(1000)
+
+    @override_settings(FITAPP_SUBSCRIPTIONS=OrderedDict([
+        ('activities', ['steps', 'distance']),
+        ('sleep', ['timeInBed']),
+    ]))
+    @patch('fitapp.tasks.get_time_series_data.apply_async')
+    def test_update_subscriptions(self, apply_async):
+        """A large batch of notifications with FITAPP_SUBSCRIPTIONS"""
+        self._post_updates(1000)
+
+    @override_settings(FITAPP_SUBSCRIBE=True)
+    def test_get_data_stored(self):
+        """Stored data, with years of history"""
+        TimeSeriesData.objects.bulk_create([TimeSeriesData(
+            user=self.user, resource_type=self.steps,
+            date=self.start + timedelta(days=i), value=str(i))
+            for i in range(5 * 365)])
+        base_date = self.start.strftime('%Y-%m-%d')
+
+        data = self._get_data(base_date=base_date, period='max')
+        self.assertEqual(data['meta']['total_count'], 5 * 365)
+        data = self._get_data(base_date=base_date, period='6m')
+        self.assertEqual(data['meta']['total_count'], 183)
+        data = self._get_data(base_date=base_date, end_date='2013-01-01',
+                              format='columnar')
+        self.assertEqual(data['meta']['total_count'], 367)
+        data = self._get_data(base_date=base_date, period='max', limit=100)
+        self.assertEqual(data['meta']['total_count'], 100)
+
+    @override_settings(FITAPP_SUBSCRIBE=False)
+    @patch('fitapp.utils.get_fitbit_data')
+    def test_get_data_live(self, get_fitbit_data):
+        """Data from the Fitbit API"""
+        get_fitbit_data.return_value = self._days(365)
+        data = self._get_data(period='1y')
+        self.assertEqual(data['meta']['total_count'], 365)
+
+    @patch('fitapp.utils.get_fitbit_data')
+    def test_ingestion(self, get_fitbit_data):
+        """A year of new data, then the same year again, then changed"""
+        days = self._days(365)
+        changed = [dict(day, value=day['value'] + '0') for day in days]
+        for data in (days, days, changed):
+            get_fitbit_data.return_value = data
+            with self.assertQueryBudget('get_time_series_data', rows=365):
+                get_time_series_data(
+                    self.fbuser.fitbit_user, self.steps.category,
+                    self.steps.resource, date=self.start,
+                    end_date=self.start + timedelta(days=364))
+            self.assertEqual(sorted(TimeSeriesData.objects.values_list(
+                'date', 'value')), [
+                    (parse_date(day['dateTime']), day['value'])
+                    for day in data])
+
+    @patch('fitapp.tasks.get_time_series_data.apply_async')
+    @patch('fitapp.utils.logger')
+    def test_log(self, logger, apply_async):
+        """Going over a budget is logged, if enabled"""
+        updates = [{'collectionType': 'foods', 'date': '2017-01-01',
+                    'ownerId': self.fbuser.fitbit_user, 'subscriptionId': 1}]
+        with override_settings(FITAPP_QUERY_BUDGETS={'update': (0, 0)}):
+            self._update(updates)
+            self.assertEqual(logger.warning.call_count, 0)
+
+            with override_settings(FITAPP_LOG_QUERY_BUDGETS=True):
+                with CaptureQueriesContext(connection) as queries:
+                    self._update(updates)
+        logger.warning.assert_called_once_with(
+            '%s made %s database queries, over its budget of %s',
+            'update', 1, 0)
+        # The queries are still logged on the connection
+        self.assertEqual(len(queries), 1)
+
+        with override_settings(FITAPP_LOG_QUERY_BUDGETS=True):
+            self._update(updates)
+        self.assertEqual(logger.warning.call_count, 1)
+
+    @override_settings(FITAPP_LOG_QUERY_BUDGETS=True,
+                       FITAPP_QUERY_BUDGETS={'update': (0, 0)})
+    @patch('fitapp.utils.logger')
+    def test_log_many_queries(self, logger):
+        """Queries past the connection's log limit are counted"""
+        with patch.object(connection, 'queries_log', deque(maxlen=2)):
+            with QueryBudget('update') as budget:
+                for i in range(5):
+                    TimeSeriesData.objects.exists()
+        self.assertEqual(budget.queries, 5)
+        logger.warning.assert_called_once_with(
+            '%s made %s database queries, over its budget of %s',
+            'update', 5, 0)
@@ -2,10 +2,13 @@ from __future__ import absolute_import
 
 import celery
 import json
+import requests
 import sys
 import time
+import warnings
 
 from collections import OrderedDict
+from datetime import date, timedelta
 from dateutil import parser
 from django.core.cache import cache
 from django.core.files.uploadedfile import InMemoryUploadedFile
@@ -19,8 +22,9 @@ from fitbit import exceptions as fitbit_exceptions
 from fitbit.api import Fitbit, FitbitOauth2Client
 
 from fitapp import utils
-from fitapp.models import UserFitbit, TimeSeriesData, TimeSeriesDataType
-from fitapp.tasks import get_time_series_data
+from fitapp.models import (UserFitbit, IntradayTimeSeriesData, TimeSeriesData,
+                           TimeSeriesDataArchive, TimeSeriesDataType)
+from fitapp.tasks import get_intraday_time_series_data, get_time_series_data
 
 try:
     from io import BytesIO
@@ -91,6 +95,18 @@ class TestRetrievalUtility(FitappTestBase):
         """HTTPBadRequest from the Fitbit.time_series should propagate."""
         self._error_test(fitbit_exceptions.HTTPBadRequest)
 
+    def test_timeout(self):
+        """The API call gives up after the timeout."""
+        with patch.object(OAuth2Session, 'request') as request:
+            request.side_effect = requests.Timeout
+            resource_type = TimeSeriesDataType.objects.get(
+                category=TimeSeriesDataType.activities, resource='steps')
+            with self.assertRaises(fitbit_exceptions.Timeout):
+                utils.get_fitbit_data(
+                    self.fbuser, resource_type, base_date=self.base_date,
+                    period=self.period, timeout=2.5)
+        self.assertEqual(request.call_args[1]['timeout'], 2.5)
+
     def test_too_many_requests(self):
         """HTTPTooManyRequests from the Fitbit.time_series should propagate."""
         try:
@@ -133,6 +149,13 @@ class TestRetrievalUtility(FitappTestBase):
         self.assertEqual(self.fbuser.access_token, 'fake_access_token')
         self.assertEqual(self.fbuser.refresh_token, 'fake_refresh_token')
 
+    def test_refresh_expired(self):
+        """An expired token is refreshed before the request is made"""
+        self.fbuser.expires_at = time.time() - 60
+        with patch('fitapp.utils.refresh_access_token') as refresh:
+            self._mock_time_series(response={'activities-steps': [1, 2, 3]})
+        refresh.assert_called_once_with(self.fbuser)
+
 
 class TestRetrievalTask(FitappTestBase):
     def setUp(self):
@@ -244,11 +267,52 @@ class TestRetrievalTask(FitappTestBase):
             'date': self.date
         })
 
-        self.assertEqual(tsd_apply_async.call_count, 2)
-        tsd_apply_async.assert_any_call(
-            (fbuser.fitbit_user, foods, 'log/water',), kwargs, countdown=0)
-        tsd_apply_async.assert_any_call(
-            (fbuser.fitbit_user, foods, 'log/caloriesIn'), kwargs, countdown=5)
+        self.assertEqual(tsd_apply_async.call_args_list, [
+            (((fbuser.fitbit_user, foods, 'log/water',), kwargs),
+             {'countdown': 0, 'priority': 0}),
+            (((fbuser.fitbit_user, foods, 'log/caloriesIn'), kwargs),
+             {'countdown': 0, 'priority': 0}),
+        ])
+
+    @override_settings(FITAPP_QUEUES={
+        'realtime': 'rt', 'backfill': 'bf', 'subscriptions': 'subs'})
+    @patch('fitapp.tasks.get_time_series_data.apply_async')
+    def test_subscription_update_queue(self, tsd_apply_async):
+        # Check that notifications are handled on the realtime queue
+        self._receive_fitbit_updates()
+        self.assertTrue(tsd_apply_async.call_count > 0)
+        for args, kwargs in tsd_apply_async.call_args_list:
+            self.assertEqual(kwargs['queue'], 'rt')
+
+    @freeze_time('2013-05-03 06:00:00')
+    @patch('fitapp.tasks.get_time_series_data.apply_async')
+    def test_subscription_update_priority(self, tsd_apply_async):
+        # Check that more recent data is retrieved with a higher priority
+        for date, priority in (('2013-05-04', 9), ('2013-05-03', 9),
+                               ('2013-05-02', 9), ('2013-04-26', 6),
+                               ('2013-04-25', 0)):
+            tsd_apply_async.reset_mock()
+            self.date = date
+            self._receive_fitbit_updates()
+            self.assertTrue(tsd_apply_async.call_count > 0)
+            for args, kwargs in tsd_apply_async.call_args_list:
+                self.assertEqual(kwargs['priority'], priority, date)
+
+    @override_settings(FITAPP_BETWEEN_DELAY=5)
+    @patch('fitapp.tasks.get_time_series_data.apply_async')
+    def test_subscription_update_between_delay(self, tsd_apply_async):
+        # Check that the old delay setting is ignored, with a warning
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self._receive_fitbit_updates()
+        self.assertTrue(tsd_apply_async.call_count > 0)
+        for args, kwargs in tsd_apply_async.call_args_list:
+            self.assertEqual(kwargs['countdown'], 0)
+        caught = [
+            w for w in caught if 'FITAPP_BETWEEN_DELAY' in str(w.message)]
+        self.assertTrue(caught)
+        for warning in caught:
+            self.assertEqual(warning.category, DeprecationWarning)
 
     @override_settings(FITAPP_SUBSCRIPTIONS=OrderedDict([
         ('foods', ['log/water', 'log/caloriesIn', 'bogus']),
@@ -313,6 +377,82 @@ class TestRetrievalTask(FitappTestBase):
         self.assertEqual(TimeSeriesData.objects.count(), 1)
         self.assertEqual(TimeSeriesData.objects.get().value, '34')
 
+    @override_settings(FITAPP_QUEUES={
+        'realtime': 'rt', 'backfill': 'bf', 'subscriptions': 'subs'})
+    @patch('fitapp.utils.get_rate_limit_delay')
+    @patch('fitapp.utils.get_fitbit_data')
+    def test_subscription_update_paced(self, get_fitbit_data, delay):
+        # Check that the task is deferred when the user's quota runs low
+        delay.return_value = 30
+        _type = TimeSeriesDataType.objects.filter(
+            category=getattr(TimeSeriesDataType, self.category))[0]
+        date = parser.parse(self.date)
+        args = (self.fbuser.fitbit_user, _type.category, _type.resource,)
+        with patch('fitapp.tasks.get_time_series_data.apply_async') as aa:
+            self.assertRaises(
+                celery.exceptions.Ignore, get_time_series_data, *args,
+                date=date)
+
+        aa.assert_called_once_with(
+            args, {'date': date, 'end_date': None, 'queue': 'realtime',
+                   'priority': 0}, countdown=30, priority=0, queue='rt')
+        self.assertEqual(get_fitbit_data.call_count, 0)
+
+    @patch('fitapp.utils.get_rate_limit_delay')
+    @patch('fitapp.tasks.get_time_series_data.apply_async')
+    def test_subscription_update_pacing(self, tsd_apply_async, delay):
+        # Check that notifications are spread out when quota runs low
+        delay.return_value = 5
+        self._receive_fitbit_updates()
+        delay.assert_called_with(self.fbuser.fitbit_user)
+        countdowns = [
+            kwargs['countdown'] for _, kwargs in tsd_apply_async.call_args_list
+        ]
+        self.assertEqual(
+            countdowns, [i * 5 for i in range(tsd_apply_async.call_count)])
+
+    @freeze_time('2017-01-01')
+    @override_settings(FITAPP_CIRCUIT_BREAKER_THRESHOLD=1)
+    @patch.object(Fitbit, 'time_series')
+    def test_subscription_update_circuit_open(self, time_series):
+        # Check that the task is deferred while Fitbit is failing
+        time_series.side_effect = fitbit_exceptions.HTTPServerError(
+            self._error_response())
+        _type = TimeSeriesDataType.objects.filter(
+            category=getattr(TimeSeriesDataType, self.category))[0]
+        date = parser.parse(self.date)
+        args = (self.fbuser.fitbit_user, _type.category, _type.resource,)
+        with patch('fitapp.tasks.get_time_series_data.apply_async') as aa:
+            self.assertRaises(
+                celery.exceptions.Ignore, get_time_series_data, *args,
+                date=date)
+            # While the circuit is open, Fitbit isn't called at all
+            self.assertRaises(
+                celery.exceptions.Ignore, get_time_series_data, *args,
+                date=date)
+
+        self.assertEqual(aa.call_args_list, [
+            ((args, {'date': date, 'end_date': None, 'queue': 'realtime',
+                     'priority': 0}),
+             {'countdown': 60, 'priority': 0}),
+        ] * 2)
+        self.assertEqual(time_series.call_count, 1)
+
+    @freeze_time('2017-01-01')
+    @override_settings(FITAPP_CIRCUIT_BREAKER_THRESHOLD=1)
+    @patch.object(Fitbit, 'intraday_time_series')
+    def test_intraday_circuit_open(self, intraday_time_series):
+        # Check that intraday tasks are deferred while Fitbit is failing
+        intraday_time_series.side_effect = fitbit_exceptions.Timeout
+        date = parser.parse(self.date)
+        args = (self.fbuser.fitbit_user, 'activities/heart', date, '1min')
+        with patch.object(get_intraday_time_series_data, 'apply_async') as aa:
+            self.assertRaises(
+                celery.exceptions.Ignore, get_intraday_time_series_data,
+                *args)
+        aa.assert_called_once_with(
+            args, countdown=60, priority=0)
+
     @patch('fitapp.tasks.get_time_series_data.retry')
     @patch('fitapp.utils.get_fitbit_data')
     def test_subscription_update_too_many_retry(self, get_fitbit_data, mock_retry):
@@ -483,6 +623,25 @@ class RetrievalViewTestBase(object):
                                       error=fitbit_exceptions.HTTPServerError)
         self._check_response(response, 106)
 
+    @override_settings(FITAPP_SUBSCRIBE=False, FITAPP_LIVE_DATA_TIMEOUT=3)
+    @patch('fitapp.utils.get_fitbit_data')
+    def test_fitbit_timeout(self, get_fitbit_data):
+        """Status code should be 106 when Fitbit doesn't respond in time."""
+        get_fitbit_data.side_effect = fitbit_exceptions.Timeout
+        response = self._get(get_kwargs=self._data())
+        self._check_response(response, 106)
+        self.assertEqual(get_fitbit_data.call_args[1]['timeout'], 3)
+
+    @override_settings(FITAPP_SUBSCRIBE=False)
+    @patch('fitapp.utils.check_circuit')
+    @patch.object(Fitbit, 'time_series')
+    def test_fitbit_circuit_open(self, time_series, check_circuit):
+        """Status code should be 106 while calls to Fitbit are suspended."""
+        check_circuit.side_effect = utils.CircuitOpenError(30)
+        response = self._get(get_kwargs=self._data())
+        self._check_response(response, 106)
+        self.assertEqual(time_series.call_count, 0)
+
     def test_405(self):
         """View should not respond to anything but a GET request."""
         url = reverse('fitbit-data', args=['activities', 'steps'])
@@ -641,3 +800,340 @@ class TestRetrieveRange(RetrievalViewTestBase, FitappTestBase):
         response = self._mock_utility(response=steps,
                                       get_kwargs=self._data())
         self._check_response(response, 100, steps)
+
+
+class TestRetrievePages(FitappTestBase):
+    url_name = 'fitbit-steps'
+
+    def setUp(self):
+        super(TestRetrievePages, self).setUp()
+        self.steps = [
+            {'dateTime': '2012-06-0{}'.format(day), 'value': str(day * 10)}
+            for day in range(1, 8)
+        ]
+        resource_type = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='steps')
+        # Create in reverse to make sure the results are sorted by date
+        for step in reversed(self.steps):
+            TimeSeriesData.objects.create(
+                user=self.user, resource_type=resource_type,
+                date=step['dateTime'], value=step['value'])
+
+    def _data(self, **kwargs):
+        data = {'base_date': '2012-06-01', 'end_date': '2012-06-30'}
+        data.update(kwargs)
+        return data
+
+    def _get_page(self, **kwargs):
+        response = self._get(get_kwargs=self._data(**kwargs))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf8'))
+
+    def test_unpaginated(self):
+        """All data is returned, without a cursor, when no limit is given."""
+        data = self._get_page()
+        self.assertEqual(data['objects'], self.steps)
+        self.assertNotIn('next', data['meta'])
+
+    def test_pages(self):
+        """Following the next cursors returns all the data in order."""
+        data = self._get_page(limit=3)
+        self.assertEqual(data['meta']['status_code'], 100)
+        self.assertEqual(data['meta']['total_count'], 3)
+        self.assertEqual(data['objects'], self.steps[:3])
+
+        data = self._get_page(limit=3, cursor=data['meta']['next'])
+        self.assertEqual(data['objects'], self.steps[3:6])
+
+        data = self._get_page(limit=3, cursor=data['meta']['next'])
+        self.assertEqual(data['objects'], self.steps[6:])
+        self.assertEqual(data['meta']['next'], None)
+
+    def test_exact_page(self):
+        """There is no next cursor when the last page is exactly full."""
+        data = self._get_page(limit=7)
+        self.assertEqual(data['objects'], self.steps)
+        self.assertEqual(data['meta']['next'], None)
+
+    @override_settings(FITAPP_MAX_PAGE_SIZE=2)
+    def test_max_page_size(self):
+        """The page size is capped by FITAPP_MAX_PAGE_SIZE."""
+        data = self._get_page()
+        self.assertEqual(data['objects'], self.steps[:2])
+        self.assertEqual(data['meta']['next'], utils.encode_cursor(
+            parser.parse(self.steps[1]['dateTime']).date()))
+
+        data = self._get_page(limit=5)
+        self.assertEqual(data['objects'], self.steps[:2])
+
+    def test_invalid_page(self):
+        """Status code should be 104 for an invalid limit or cursor."""
+        for kwargs in ({'limit': 0}, {'limit': 'bad'}, {'cursor': '!!'},
+                       {'cursor': utils.encode_cursor(
+                           parser.parse('2012-06-01')) + 'x'}):
+            data = self._get_page(**kwargs)
+            self.assertEqual(data['meta']['status_code'], 104, kwargs)
+            self.assertEqual(data['objects'], [])
+
+    def test_columnar(self):
+        """The columnar format returns typed values with nulls for gaps."""
+        TimeSeriesData.objects.filter(date='2012-06-03').delete()
+        TimeSeriesData.objects.filter(date='2012-06-04').update(value='1.5')
+        TimeSeriesData.objects.filter(date='2012-06-05').update(value=None)
+        data = self._get_page(format='columnar')
+        self.assertEqual(data['meta']['status_code'], 100)
+        self.assertEqual(data['meta']['format'], 'columnar')
+        self.assertEqual(data['meta']['start_date'], '2012-06-01')
+        self.assertEqual(data['meta']['total_count'], 7)
+        self.assertEqual(data['objects'], [10, 20, None, 1.5, None, 60, 70])
+
+    def test_columnar_pages(self):
+        """The columnar format can be paginated."""
+        data = self._get_page(format='columnar', limit=4)
+        self.assertEqual(data['objects'], [10, 20, 30, 40])
+        data = self._get_page(format='columnar', limit=4,
+                              cursor=data['meta']['next'])
+        self.assertEqual(data['meta']['start_date'], '2012-06-05')
+        self.assertEqual(data['objects'], [50, 60, 70])
+        self.assertEqual(data['meta']['next'], None)
+
+    def test_columnar_empty(self):
+        """The columnar format has no start date when there is no data."""
+        TimeSeriesData.objects.all().delete()
+        data = self._get_page(format='columnar')
+        self.assertEqual(data['meta']['start_date'], None)
+        self.assertEqual(data['objects'], [])
+
+    @override_settings(FITAPP_SUBSCRIBE=False)
+    def test_columnar_api(self):
+        """The columnar format is also available for data from the API."""
+        response = self._mock_utility(response=[
+            {'dateTime': '2012-06-01', 'value': '5'},
+            {'dateTime': '2012-06-03', 'value': 'xyz'},
+        ], get_kwargs=self._data(format='columnar'))
+        data = json.loads(response.content.decode('utf8'))
+        self.assertEqual(data['meta']['start_date'], '2012-06-01')
+        self.assertEqual(data['objects'], [5, None, 'xyz'])
+
+    def _archive(self):
+        resource_type = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='steps')
+        for month, days in ((date(2012, 5, 1), {date(2012, 5, 31): '1'}),
+                            (date(2012, 6, 1), {date(2012, 6, 1): '2',
+                                                date(2012, 6, 8): '80',
+                                                date(2012, 6, 9): '90'})):
+            archive = TimeSeriesDataArchive(
+                user=self.user, resource_type=resource_type, month=month)
+            archive.set_days(days)
+            archive.save()
+        return self.steps + [{'dateTime': '2012-06-08', 'value': '80'},
+                             {'dateTime': '2012-06-09', 'value': '90'}]
+
+    def test_archived(self):
+        """Archived data is merged with the live data."""
+        steps = self._archive()
+        data = self._get_page()
+        self.assertEqual(data['objects'], steps)
+
+        data = self._get_page(format='columnar')
+        self.assertEqual(data['objects'], [
+            int(step['value']) for step in steps])
+
+    def test_archived_pages(self):
+        """Archived data is paginated with the live data."""
+        steps = self._archive()
+        data = self._get_page(limit=5)
+        self.assertEqual(data['objects'], steps[:5])
+        data = self._get_page(limit=5, cursor=data['meta']['next'])
+        self.assertEqual(data['objects'], steps[5:])
+        self.assertEqual(data['meta']['next'], None)
+
+        data = self._get_page(limit=1, end_date='2012-06-09',
+                              base_date='2012-06-09')
+        self.assertEqual(data['objects'], steps[-1:])
+
+    def test_archived_pages_read(self):
+        """Only the archived months needed for a page are read."""
+        resource_type = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='steps')
+        for month in range(24):
+            archive = TimeSeriesDataArchive(
+                user=self.user, resource_type=resource_type,
+                month=date(2010 + month // 12, month % 12 + 1, 1))
+            archive.set_days(dict(
+                (archive.month + timedelta(days=i), str(i))
+                for i in range(28)))
+            archive.save()
+
+        with patch.object(TimeSeriesDataArchive, 'days', autospec=True,
+                          side_effect=TimeSeriesDataArchive.days) as days:
+            data = self._get_page(limit=30, base_date='2010-01-01',
+                                  end_date='2011-12-31')
+        self.assertEqual(len(data['objects']), 30)
+        self.assertEqual(data['objects'][-1]['dateTime'], '2010-02-02')
+        self.assertEqual([call[0][0].month for call in days.call_args_list],
+                         [date(2010, 1, 1), date(2010, 2, 1)])
+
+    def test_invalid_format(self):
+        """Status code should be 104 for an unknown format."""
+        data = self._get_page(format='bogus')
+        self.assertEqual(data['meta']['status_code'], 104)
+
+
+class TestIntraday(FitappTestBase):
+    url_name = 'fitbit-intraday-data'
+    url_kwargs = {'category': 'activities', 'resource': 'heart'}
+
+    def setUp(self):
+        super(TestIntraday, self).setUp()
+        self.date = date(2013, 5, 2)
+        self.dataset = [
+            {'time': '00:00:00', 'value': 61},
+            {'time': '00:01:00', 'value': 62.5},
+            {'time': '00:03:00', 'value': 64},
+            {'time': '23:59:00', 'value': 58},
+        ]
+
+    def _create_data(self, detail_level='1min'):
+        return IntradayTimeSeriesData.objects.create(
+            user=self.user, resource='activities/heart', date=self.date,
+            detail_level=detail_level, values=IntradayTimeSeriesData.pack(
+                self.dataset, detail_level))
+
+    def _get_data(self, **kwargs):
+        get_kwargs = {'date': '2013-05-02'}
+        get_kwargs.update(kwargs)
+        response = self._get(url_kwargs=self.url_kwargs, get_kwargs=get_kwargs)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf8'))
+
+    def test_pack(self):
+        """A day of data is packed into an array of 32-bit floats."""
+        values = IntradayTimeSeriesData.pack(self.dataset, '1min')
+        self.assertEqual(len(values), 1440 * 4)
+        values = IntradayTimeSeriesData.unpack(values)
+        self.assertEqual(values[:4], [61, 62.5, None, 64])
+        self.assertEqual(values[4:-1], [None] * 1435)
+        self.assertEqual(values[-1], 58)
+
+        values = IntradayTimeSeriesData.unpack(
+            IntradayTimeSeriesData.pack(self.dataset, '15min'))
+        self.assertEqual(values[0], 64)
+        self.assertEqual(len(values), 96)
+
+    @patch.object(Fitbit, 'intraday_time_series')
+    def test_retrieval_utility(self, intraday_time_series):
+        """get_fitbit_intraday_data returns the dataset of the day."""
+        intraday_time_series.return_value = {
+            'activities-heart': [],
+            'activities-heart-intraday': {
+                'dataset': self.dataset, 'datasetInterval': 1,
+                'datasetType': 'minute'},
+        }
+        self.assertEqual(utils.get_fitbit_intraday_data(
+            self.fbuser, 'activities/heart', self.date, '1min'), self.dataset)
+        intraday_time_series.assert_called_once_with(
+            'activities/heart', base_date=self.date, detail_level='1min')
+
+    @patch('fitapp.utils.get_fitbit_intraday_data')
+    def test_task(self, get_fitbit_intraday_data):
+        """The intraday task stores the day of data."""
+        get_fitbit_intraday_data.return_value = self.dataset
+        self._create_data(detail_level='15min')
+        for i in range(2):
+            get_intraday_time_series_data.apply_async(
+                (self.fbuser.fitbit_user, 'activities/heart', self.date,
+                 '1min')).get()
+
+        self.assertEqual(get_fitbit_intraday_data.call_count, 2)
+        data = IntradayTimeSeriesData.objects.get(detail_level='1min')
+        self.assertEqual(data.user, self.user)
+        self.assertEqual(IntradayTimeSeriesData.unpack(data.values)[:2],
+                         [61, 62.5])
+        self.assertEqual(IntradayTimeSeriesData.objects.count(), 2)
+
+    @override_settings(FITAPP_INTRADAY_RESOURCES={
+        'activities/heart': '1min', 'activities/steps': '15min',
+        'foods/log/water': '1min'})
+    @patch('fitapp.tasks.get_intraday_time_series_data.apply_async')
+    @patch('fitapp.tasks.get_time_series_data.apply_async')
+    def test_subscription_update(self, tsd_apply_async, intraday_apply_async):
+        """Notifications retrieve the intraday data of the collection."""
+        data = json.dumps([{
+            'subscriptionId': self.user.id,
+            'ownerId': self.fbuser.fitbit_user,
+            'collectionType': 'activities',
+            'date': '2013-05-02',
+        }]).encode('utf8')
+        response = self.client.post(
+            reverse('fitbit-update'), data=data,
+            content_type='application/json')
+
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual([
+            (args, kwargs['priority'])
+            for args, kwargs in intraday_apply_async.call_args_list
+        ], [
+            (((self.fbuser.fitbit_user, 'activities/heart',
+               parser.parse('2013-05-02'), '1min'),), 0),
+            (((self.fbuser.fitbit_user, 'activities/steps',
+               parser.parse('2013-05-02'), '15min'),), 0),
+        ])
+
+    def test_get_intraday_data(self):
+        """The whole day is returned by default, with nulls for gaps."""
+        self._create_data()
+        data = self._get_data()
+        self.assertEqual(data['meta']['status_code'], 100)
+        self.assertEqual(data['meta']['detail_level'], '1min')
+        self.assertEqual(data['meta']['start_time'], '00:00')
+        self.assertEqual(data['meta']['total_count'], 1440)
+        self.assertEqual(data['objects'][:4], [61, 62.5, None, 64])
+        self.assertEqual(data['objects'][-1], 58)
+
+    def test_get_intraday_data_slice(self):
+        """A range of the day can be requested."""
+        self._create_data()
+        data = self._get_data(start_time='00:01', end_time='00:03')
+        self.assertEqual(data['meta']['start_time'], '00:01')
+        self.assertEqual(data['objects'], [62.5, None, 64])
+
+        data = self._get_data(start_time='23:58')
+        self.assertEqual(data['objects'], [None, 58])
+
+    def test_get_intraday_data_midnight(self):
+        """Midnight is a time like any other, not the end of the day."""
+        self._create_data()
+        data = self._get_data(end_time='00:00')
+        self.assertEqual(data['meta']['start_time'], '00:00')
+        self.assertEqual(data['objects'], [61])
+
+        data = self._get_data(start_time='00:01', end_time='00:00')
+        self.assertEqual(data['meta']['status_code'], 104)
+
+    @override_settings(FITAPP_INTRADAY_RESOURCES={'activities/heart': '15min'})
+    def test_get_intraday_data_detail_level(self):
+        """The detail level defaults to the configured one."""
+        self._create_data(detail_level='15min')
+        data = self._get_data(start_time='00:15', end_time='01:00')
+        self.assertEqual(data['meta']['detail_level'], '15min')
+        self.assertEqual(data['meta']['start_time'], '00:15')
+        self.assertEqual(data['objects'], [None] * 4)
+
+        data = self._get_data(detail_level='1min')
+        self.assertEqual(data['meta']['start_time'], None)
+        self.assertEqual(data['objects'], [])
+
+    def test_get_intraday_data_invalid(self):
+        """Status code should be 104 for invalid parameters."""
+        for kwargs in ({'date': 'bogus'}, {'detail_level': '1sec'},
+                       {'start_time': '25:00'},
+                       {'start_time': '12:00', 'end_time': '11:00'}):
+            data = self._get_data(**kwargs)
+            self.assertEqual(data['meta']['status_code'], 104, kwargs)
+
+    def test_get_intraday_data_not_logged_in(self):
+        """Status code should be 101 when the user isn't logged in."""
+        self.client.logout()
+        data = self._get_data()
+        self.assertEqual(data['meta']['status_code'], 101)
@@ -1,11 +1,30 @@
+import json
+import requests_mock
+import time
+
 from collections import OrderedDict
+from datetime import date, timedelta
 
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
 from django.test import TestCase
 from django.test.utils import override_settings
 from fitbit import Fitbit
+from fitbit.exceptions import HTTPNotFound, HTTPServerError, Timeout
+from fitbit.api import FitbitOauth2Client
+from freezegun import freeze_time
+from mock import patch
+
+from fitapp.models import (UserFitbit, TimeSeriesData, TimeSeriesDataArchive,
+                           TimeSeriesDataType)
+from fitapp.utils import (CircuitOpenError, _find_gaps, circuit_breaker,
+                          create_fitbit, find_time_series_gaps,
+                          get_circuit_delay, get_rate_limit,
+                          get_rate_limit_delay, get_setting,
+                          has_window_functions, refresh_access_token)
 
-from fitapp.utils import create_fitbit, get_setting
+from .base import FitappTestBase, FitappTransactionTestBase
 
 
 class TestFitappUtilities(TestCase):
@@ -71,3 +90,314 @@ class TestFitappUtilities(TestCase):
         subs = get_setting('FITAPP_SUBSCRIPTIONS')
 
         self.assertEqual(subs['activities'], ['steps'])
+
+
+class TestRefreshAccessToken(FitappTransactionTestBase):
+    token = {
+        'access_token': 'fake_access_token',
+        'refresh_token': 'fake_refresh_token',
+        'expires_at': time.time() + 300,
+    }
+
+    def setUp(self):
+        super(TestRefreshAccessToken, self).setUp()
+        self.lock_id = 'fitapp.utils-refresh-lock-{}'.format(
+            self.fbuser.fitbit_user)
+
+    def test_refresh(self):
+        """The token is refreshed and the lock is released"""
+        with requests_mock.mock() as m:
+            m.post(FitbitOauth2Client.refresh_token_url,
+                   text=json.dumps(self.token))
+            refresh_access_token(self.fbuser)
+
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(self.fbuser.access_token, 'fake_access_token')
+        self.assertEqual(
+            UserFitbit.objects.get().refresh_token, 'fake_refresh_token')
+        self.assertEqual(cache.get(self.lock_id), None)
+
+    def test_refresh_rollback(self):
+        """The new token is kept when the caller's transaction rolls back"""
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                with requests_mock.mock() as m:
+                    m.post(FitbitOauth2Client.refresh_token_url,
+                           text=json.dumps(self.token))
+                    refresh_access_token(self.fbuser)
+                self.assertEqual(
+                    self.fbuser.refresh_token, 'fake_refresh_token')
+                raise ValueError
+
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(
+            UserFitbit.objects.get().refresh_token, 'fake_refresh_token')
+        self.assertEqual(cache.get(self.lock_id), None)
+
+    @patch('fitbit.api.FitbitOauth2Client.refresh_token')
+    def test_refresh_failed(self, refresh_token):
+        """The lock is released right away if the refresh fails"""
+        refresh_token.side_effect = ValueError
+        self.assertRaises(ValueError, refresh_access_token, self.fbuser)
+
+        self.assertEqual(cache.get(self.lock_id), None)
+
+    @patch('fitapp.utils.time.sleep')
+    def test_refresh_in_flight(self, sleep):
+        """The token saved by a refresh already in flight is used"""
+        cache.add(self.lock_id, 'true')
+        self.addCleanup(cache.delete, self.lock_id)
+
+        def other_refresh(seconds):
+            if sleep.call_count == 2:
+                UserFitbit.objects.filter(pk=self.fbuser.pk).update(
+                    access_token='fake_access_token',
+                    refresh_token='fake_refresh_token')
+        sleep.side_effect = other_refresh
+
+        with requests_mock.mock() as m:
+            refresh_access_token(self.fbuser)
+
+        self.assertEqual(m.call_count, 0)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(self.fbuser.access_token, 'fake_access_token')
+        self.assertEqual(self.fbuser.refresh_token, 'fake_refresh_token')
+
+    @patch('fitapp.utils.time.sleep')
+    def test_refresh_after_failed_refresh(self, sleep):
+        """The token is refreshed if the refresh in flight doesn't save one"""
+        cache.add(self.lock_id, 'true')
+        sleep.side_effect = lambda seconds: cache.delete(self.lock_id)
+
+        with requests_mock.mock() as m:
+            m.post(FitbitOauth2Client.refresh_token_url,
+                   text=json.dumps(self.token))
+            refresh_access_token(self.fbuser)
+
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(self.fbuser.access_token, 'fake_access_token')
+
+
+@freeze_time('2017-01-01 12:00:00')
+class TestRateLimit(FitappTestBase):
+    url = 'https://api.fitbit.com/1/user/-/profile.json'
+
+    def _request(self, **headers):
+        fb = create_fitbit(**self.fbuser.get_user_data())
+        with requests_mock.mock() as m:
+            m.get(self.url, text='{}', headers=dict(
+                ('Fitbit-Rate-Limit-' + k, v) for k, v in headers.items()))
+            fb.user_profile_get()
+
+    def test_rate_limit_saved(self):
+        """The rate limit headers of API responses are saved per user"""
+        self.assertEqual(get_rate_limit(self.fbuser.fitbit_user), None)
+        self._request(Limit='150', Remaining='120', Reset='600')
+        self.assertEqual(get_rate_limit(self.fbuser.fitbit_user), {
+            'limit': 150,
+            'remaining': 120,
+            'reset_at': time.time() + 600,
+        })
+        self.assertEqual(get_rate_limit_delay(self.fbuser.fitbit_user), 0)
+
+    def test_rate_limit_missing_headers(self):
+        """Responses without rate limit headers are ignored"""
+        self._request()
+        self._request(Limit='150', Remaining='bogus', Reset='600')
+        self.assertEqual(get_rate_limit(self.fbuser.fitbit_user), None)
+        self.assertEqual(get_rate_limit_delay(self.fbuser.fitbit_user), 0)
+
+    def test_rate_limit_delay(self):
+        """Calls are spread out more as the quota runs low"""
+        self._request(Limit='150', Remaining='75', Reset='600')
+        self.assertEqual(get_rate_limit_delay(self.fbuser.fitbit_user), 8)
+        self._request(Limit='150', Remaining='10', Reset='600')
+        self.assertEqual(get_rate_limit_delay(self.fbuser.fitbit_user), 60)
+        self._request(Limit='150', Remaining='0', Reset='600')
+        self.assertEqual(get_rate_limit_delay(self.fbuser.fitbit_user), 600)
+
+    @override_settings(FITAPP_RATE_LIMIT_THRESHOLD=0.1)
+    def test_rate_limit_threshold(self):
+        """Calls are only paced below the configured threshold"""
+        self._request(Limit='150', Remaining='20', Reset='600')
+        self.assertEqual(get_rate_limit_delay(self.fbuser.fitbit_user), 0)
+        self._request(Limit='150', Remaining='15', Reset='600')
+        self.assertEqual(get_rate_limit_delay(self.fbuser.fitbit_user), 40)
+
+
+@override_settings(FITAPP_CIRCUIT_BREAKER_THRESHOLD=3,
+                   FITAPP_CIRCUIT_BREAKER_TIMEOUT=60)
+class TestCircuitBreaker(FitappTestBase):
+    def _call(self, error=None):
+        with circuit_breaker():
+            if error:
+                raise error(self._error_response())
+
+    def _fail(self, times, error=HTTPServerError):
+        for i in range(times):
+            with self.assertRaises(error):
+                self._call(error)
+
+    def test_trip(self):
+        """The circuit opens after too many failures in a row"""
+        with freeze_time('2017-01-01 00:00:00') as frozen:
+            self._fail(2)
+            self._call()
+            self._fail(2, Timeout)
+            self.assertEqual(get_circuit_delay(), 0)
+            self._fail(1)
+            self.assertEqual(get_circuit_delay(), 60)
+            with self.assertRaises(CircuitOpenError) as cm:
+                self._call()
+            self.assertEqual(cm.exception.retry_after_secs, 60)
+
+            frozen.tick(timedelta(seconds=45))
+            self.assertEqual(get_circuit_delay(), 15)
+            with self.assertRaises(CircuitOpenError):
+                self._call()
+
+    def test_half_open(self):
+        """A single probe is let through after the timeout"""
+        with freeze_time('2017-01-01 00:00:00') as frozen:
+            self._fail(3)
+            frozen.tick(timedelta(seconds=60))
+            self.assertEqual(get_circuit_delay(), 0)
+            # The probe fails, so the circuit opens again
+            self._fail(1)
+            self.assertEqual(get_circuit_delay(), 60)
+
+            frozen.tick(timedelta(seconds=60))
+            with self.assertRaises(HTTPNotFound):
+                self._call(HTTPNotFound)
+            # Any response from Fitbit closes the circuit
+            self._call()
+            self._call()
+
+    def test_probe_in_flight(self):
+        """Other calls wait for the result of the probe"""
+        with freeze_time('2017-01-01 00:00:00') as frozen:
+            self._fail(3)
+            frozen.tick(timedelta(seconds=60))
+            with circuit_breaker():
+                with self.assertRaises(CircuitOpenError) as cm:
+                    self._call()
+                self.assertEqual(cm.exception.retry_after_secs, 5)
+            # The probe succeeded
+            self._call()
+
+    @override_settings(FITAPP_CIRCUIT_BREAKER_THRESHOLD=None)
+    def test_disabled(self):
+        """The circuit breaker can be disabled"""
+        self._fail(5)
+        self._call()
+        self.assertEqual(get_circuit_delay(), 0)
+
+
+@override_settings(FITAPP_SUBSCRIPTIONS=OrderedDict([
+    ('activities', ['steps']), ('foods', ['log/water'])]))
+class TestFindGaps(FitappTestBase):
+    def setUp(self):
+        super(TestFindGaps, self).setUp()
+        self.steps = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.activities, resource='steps')
+        self.water = TimeSeriesDataType.objects.get(
+            category=TimeSeriesDataType.foods, resource='log/water')
+        self.other_user = self.create_user()
+        for user, _type, days in (
+                (self.user, self.steps, (1, 2, 5, 6, 7, 10)),
+                (self.user, self.water, (1, 2, 3, 4, 5, 6, 7, 8, 9, 10)),
+                (self.other_user, self.steps, (3, 8))):
+            for day in days:
+                TimeSeriesData.objects.create(
+                    user=user, resource_type=_type, date=date(2017, 1, day),
+                    value=str(day))
+
+    def _test_gaps(self):
+        gaps = find_time_series_gaps(date(2017, 1, 2), date(2017, 1, 12))
+        self.assertEqual(gaps, sorted([
+            (self.user.id, self.steps.id, date(2017, 1, 3), date(2017, 1, 4)),
+            (self.user.id, self.steps.id, date(2017, 1, 8), date(2017, 1, 9)),
+            (self.user.id, self.steps.id, date(2017, 1, 11),
+             date(2017, 1, 12)),
+            (self.user.id, self.water.id, date(2017, 1, 11),
+             date(2017, 1, 12)),
+            (self.other_user.id, self.steps.id, date(2017, 1, 2),
+             date(2017, 1, 2)),
+            (self.other_user.id, self.steps.id, date(2017, 1, 4),
+             date(2017, 1, 7)),
+            (self.other_user.id, self.steps.id, date(2017, 1, 9),
+             date(2017, 1, 12)),
+        ]))
+
+    def test_find_gaps(self):
+        """Missing date ranges are found with a window function query"""
+        self._test_gaps()
+
+    @patch('fitapp.utils.GAP_CONDITIONS', {})
+    def test_find_gaps_fallback(self):
+        """Missing date ranges are found on databases without gap queries"""
+        self._test_gaps()
+
+    @patch('fitapp.utils.sqlite3.sqlite_version_info', (3, 24, 0))
+    def test_find_gaps_old_sqlite(self):
+        """SQLite before 3.25 doesn't have window functions"""
+        self.assertFalse(has_window_functions())
+        with patch('fitapp.utils._find_gaps', wraps=_find_gaps) as find_gaps:
+            self._test_gaps()
+        self.assertEqual(find_gaps.call_count, 1)
+
+    def test_window_functions_mysql(self):
+        """MySQL has window functions from 8.0, and MariaDB from 10.2"""
+        for server_info, supported in (
+                ('5.7.20-log', False), ('8.0.11', True),
+                ('10.1.30-MariaDB', False), ('10.2.12-MariaDB-log', True)):
+            with patch('fitapp.utils.connection') as db:
+                db.vendor = 'mysql'
+                db.connection.get_server_info.return_value = server_info
+                db.mysql_version = tuple(
+                    int(n) for n in server_info.split('-')[0].split('.'))
+                self.assertEqual(has_window_functions(), supported)
+
+    def test_no_stored_data(self):
+        """Integrated users are missing the types they have no data of"""
+        fbuser = self.create_userfitbit()
+        TimeSeriesData.objects.filter(
+            user=self.user, resource_type=self.water).delete()
+        self.assertEqual(
+            find_time_series_gaps(date(2017, 1, 1), date(2017, 1, 2)), [
+                (self.user.id, self.water.id, date(2017, 1, 1),
+                 date(2017, 1, 2)),
+                (fbuser.user_id, self.steps.id, date(2017, 1, 1),
+                 date(2017, 1, 2)),
+                (fbuser.user_id, self.water.id, date(2017, 1, 1),
+                 date(2017, 1, 2)),
+            ])
+
+    def test_no_gaps(self):
+        """No gaps are found when all data is stored"""
+        self.assertEqual(
+            find_time_series_gaps(date(2017, 1, 1), date(2017, 1, 2)), [])
+
+    def test_leading_gap(self):
+        """The dates before the first stored date are missing"""
+        self.assertEqual(
+            find_time_series_gaps(date(2016, 12, 30), date(2017, 1, 1)), [
+                (self.user.id, self.steps.id, date(2016, 12, 30),
+                 date(2016, 12, 31)),
+                (self.user.id, self.water.id, date(2016, 12, 30),
+                 date(2016, 12, 31)),
+            ])
+
+    def test_archived_months(self):
+        """Archived months aren't missing"""
+        for month in (date(2016, 10, 1), date(2016, 12, 1)):
+            TimeSeriesDataArchive.objects.create(
+                user=self.user, resource_type=self.water, month=month,
+                values='[]')
+        self.assertEqual(
+            find_time_series_gaps(date(2016, 10, 15), date(2017, 1, 1)), [
+                (self.user.id, self.steps.id, date(2016, 10, 15),
+                 date(2016, 12, 31)),
+                (self.user.id, self.water.id, date(2016, 11, 1),
+                 date(2016, 11, 30)),
+            ])
@@ -16,5 +16,7 @@ urlpatterns = [
     # Fitbit data retrieval
     url(r'^get_data/(?P<category>[\w]+)/(?P<resource>[/\w]+)/$',
         views.get_data, name='fitbit-data'),
+    url(r'^get_intraday_data/(?P<category>[\w]+)/(?P<resource>[/\w]+)/$',
+        views.get_intraday_data, name='fitbit-intraday-data'),
     url(r'^get_steps/$', views.get_steps, name='fitbit-steps')
 ]
@@ -1,10 +1,68 @@
+import base64
+import binascii
+import copy
+import logging
+import sqlite3
+import sys
+import threading
+import time
+import warnings
+
+from contextlib import contextmanager
+from functools import wraps
+
+from datetime import datetime, timedelta
+
+from dateutil import parser
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
+from django.db import (DEFAULT_DB_ALIAS, IntegrityError, connection,
+                       connections, transaction)
+from django.db.backends.utils import CursorWrapper
+from django.db.models import Case, Max, Min, Value, When
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from six import reraise, string_types
 
 from fitbit import Fitbit
+from fitbit.exceptions import HTTPException, HTTPServerError, Timeout
+
+from . import defaults, metrics
+from .models import (INTEGRATED_CACHE_KEY, UserFitbit, TimeSeriesData,
+                     TimeSeriesDataArchive, TimeSeriesDataType)
 
-from . import defaults
-from .models import UserFitbit, TimeSeriesDataType
+
+logger = logging.getLogger(__name__)
+INTEGRATED_CACHE_EXPIRE = 60 * 60  # Integration status expires in 1 hour
+REFRESH_LOCK_EXPIRE = 30  # Refresh lock expires in 30 seconds
+REFRESH_POLL_INTERVAL = 0.5
+RATE_LIMIT_CACHE_KEY = 'fitapp-rate-limit-{0}'
+SUBSCRIPTIONS_CACHE_KEY = 'fitapp-subscriptions-{0}'
+SUBSCRIPTIONS_CACHE_EXPIRE = 60 * 60  # Subscription listings expire in 1 hour
+RATE_LIMIT_HEADERS = ('Limit', 'Remaining', 'Reset')
+# Rows updated per query, within SQLite's limit of 999 query parameters
+UPDATE_BATCH_SIZE = 300
+CIRCUIT_FAILURES_CACHE_KEY = 'fitapp-circuit-failures'
+CIRCUIT_OPEN_CACHE_KEY = 'fitapp-circuit-open'
+CIRCUIT_PROBE_CACHE_KEY = 'fitapp-circuit-probe'
+CIRCUIT_PROBE_WAIT = 5  # Wait 5 seconds for the result of a probe
+# Finds consecutive stored dates with missing dates between them
+GAP_SQL = """
+    SELECT user_id, resource_type_id, prev_date, date FROM (
+        SELECT user_id, resource_type_id, date, LAG(date) OVER (
+            PARTITION BY user_id, resource_type_id ORDER BY date
+        ) AS prev_date
+        FROM {table}
+        WHERE date >= %s AND date <= %s
+    ) dates
+    WHERE {condition}
+"""
+GAP_CONDITIONS = {
+    'postgresql': 'date - prev_date > 1',
+    'mysql': 'DATEDIFF(date, prev_date) > 1',
+    'sqlite': 'julianday(date) - julianday(prev_date) > 1',
+}
 
 
 def create_fitbit(consumer_key=None, consumer_secret=None, **kwargs):
@@ -25,7 +83,240 @@ def create_fitbit(consumer_key=None, consumer_secret=None, **kwargs):
             "Django settings"
         )
 
-    return Fitbit(consumer_key, consumer_secret, **kwargs)
+    fb = Fitbit(consumer_key, consumer_secret, **kwargs)
+    if kwargs.get('user_id'):
+        # Keep track of the user's remaining API quota, see get_rate_limit
+        fb.client.session.hooks['response'].append(
+            _rate_limit_hook(kwargs['user_id']))
+    if metrics.get_backend() is not None:
+        fb.client.session.hooks['response'].append(_metrics_hook)
+    return fb
+
+
+def _metrics_hook(response, *args, **kwargs):
+    """A requests response hook that counts and times Fitbit API calls"""
+    metrics.increment('api_calls', status=response.status_code)
+    if response.status_code == 429:
+        metrics.increment('api_rate_limited')
+    metrics.timing('api_latency', response.elapsed.total_seconds())
+
+
+def _rate_limit_hook(fitbit_user):
+    """Returns a requests response hook that saves the Fitbit rate limit
+    headers of the response in the cache, until the rate limit resets.
+    """
+    def hook(response, *args, **kwargs):
+        save_rate_limit(fitbit_user, response.headers)
+    return hook
+
+
+def save_rate_limit(fitbit_user, headers):
+    """Saves the Fitbit rate limit headers of an API response for a user in
+    the cache, until the rate limit resets. See :func:`get_rate_limit`.
+    """
+    try:
+        limit, remaining, reset = [
+            int(headers['Fitbit-Rate-Limit-' + header])
+            for header in RATE_LIMIT_HEADERS]
+    except (KeyError, ValueError):
+        return
+    cache.set(RATE_LIMIT_CACHE_KEY.format(fitbit_user), {
+        'limit': limit,
+        'remaining': remaining,
+        'reset_at': time.time() + reset,
+    }, max(reset, 1))
+
+
+def get_rate_limit(fitbit_user):
+    """Returns the last known Fitbit API rate limit of a user.
+
+    The result is a dict with the ``limit`` and ``remaining`` number of calls,
+    and the time the limit resets at as ``reset_at``, in seconds since the
+    epoch. ``None`` is returned if we haven't made an API call for the user
+    since the limit last reset.
+    """
+    return cache.get(RATE_LIMIT_CACHE_KEY.format(fitbit_user))
+
+
+def get_rate_limit_delay(fitbit_user):
+    """Returns how many seconds to wait before the next API call for a user.
+
+    While more than :ref:`FITAPP_RATE_LIMIT_THRESHOLD` of the user's quota
+    remains, there is no delay. Below that, the remaining calls are spread
+    evenly over the time until the rate limit resets, so we slow down as the
+    quota shrinks instead of running into it.
+    """
+    rate_limit = get_rate_limit(fitbit_user)
+    if rate_limit is None:
+        return 0
+    threshold = get_setting('FITAPP_RATE_LIMIT_THRESHOLD')
+    if rate_limit['remaining'] > rate_limit['limit'] * threshold:
+        return 0
+    reset_in = max(rate_limit['reset_at'] - time.time(), 0)
+    if rate_limit['remaining'] <= 0:
+        return reset_in
+    return reset_in / rate_limit['remaining']
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the Fitbit API while the circuit breaker is
+    open. ``retry_after_secs`` is the number of seconds until the API may be
+    called again.
+    """
+
+    def __init__(self, retry_after_secs):
+        super(CircuitOpenError, self).__init__(
+            'Fitbit API calls are suspended for {:.0f} seconds'.format(
+                retry_after_secs))
+        self.retry_after_secs = retry_after_secs
+
+
+@contextmanager
+def circuit_breaker():
+    """Guards a Fitbit API call with a circuit breaker shared by all processes.
+
+    After :ref:`FITAPP_CIRCUIT_BREAKER_THRESHOLD` server errors or timeouts
+    in a row, the circuit opens and :class:`CircuitOpenError` is raised
+    instead of making API calls, for :ref:`FITAPP_CIRCUIT_BREAKER_TIMEOUT`
+    seconds. Then the circuit is half-open: a single call is let through as a
+    probe, which closes the circuit if it gets a response from Fitbit, or
+    opens it again if it fails too.
+    """
+    check_circuit()
+    try:
+        yield
+    except (HTTPServerError, Timeout):
+        record_circuit_failure()
+        raise
+    except HTTPException:
+        # Fitbit responded, even if it didn't like the request
+        record_circuit_success()
+        raise
+    record_circuit_success()
+
+
+def check_circuit():
+    """Raises :class:`CircuitOpenError` unless a Fitbit API call may be made
+    now, see :func:`circuit_breaker`.
+    """
+    if not get_setting('FITAPP_CIRCUIT_BREAKER_THRESHOLD'):
+        return
+    half_open_at = cache.get(CIRCUIT_OPEN_CACHE_KEY)
+    if half_open_at is None:
+        return
+    delay = half_open_at - time.time()
+    if delay <= 0:
+        # Let one call through to find out if Fitbit has recovered, and have
+        # everybody else wait for its result
+        if cache.add(CIRCUIT_PROBE_CACHE_KEY, True,
+                     get_setting('FITAPP_CIRCUIT_BREAKER_TIMEOUT')):
+            return
+        delay = CIRCUIT_PROBE_WAIT
+    raise CircuitOpenError(delay)
+
+
+def get_circuit_delay():
+    """Returns how many seconds until the circuit breaker lets a Fitbit API
+    call through again, or 0 if it is closed or half-open.
+    """
+    if not get_setting('FITAPP_CIRCUIT_BREAKER_THRESHOLD'):
+        return 0
+    half_open_at = cache.get(CIRCUIT_OPEN_CACHE_KEY)
+    if half_open_at is None:
+        return 0
+    return max(half_open_at - time.time(), 0)
+
+
+def record_circuit_failure():
+    """Counts a failed Fitbit API call, and opens the circuit breaker when
+    there have been too many failures in a row or the probe of a half-open
+    circuit failed.
+    """
+    threshold = get_setting('FITAPP_CIRCUIT_BREAKER_THRESHOLD')
+    if not threshold:
+        return
+    timeout = get_setting('FITAPP_CIRCUIT_BREAKER_TIMEOUT')
+    cache.add(CIRCUIT_FAILURES_CACHE_KEY, 0, timeout)
+    try:
+        failures = cache.incr(CIRCUIT_FAILURES_CACHE_KEY)
+    except ValueError:
+        # The count expired in the meantime
+        failures = 1
+    if failures >= threshold or cache.get(CIRCUIT_PROBE_CACHE_KEY):
+        logger.warning('Fitbit API is failing, suspending calls for {} '
+                       'seconds'.format(timeout))
+        # The circuit closes by itself if nobody probes it in time
+        cache.set(CIRCUIT_OPEN_CACHE_KEY, time.time() + timeout, timeout * 2)
+        cache.delete_many(
+            [CIRCUIT_FAILURES_CACHE_KEY, CIRCUIT_PROBE_CACHE_KEY])
+
+
+def record_circuit_success():
+    """Closes the circuit breaker after a successful Fitbit API call"""
+    keys = [CIRCUIT_FAILURES_CACHE_KEY, CIRCUIT_OPEN_CACHE_KEY]
+    threshold = get_setting('FITAPP_CIRCUIT_BREAKER_THRESHOLD')
+    if threshold and cache.get_many(keys):
+        cache.delete_many(keys + [CIRCUIT_PROBE_CACHE_KEY])
+
+
+def refresh_access_token(fbuser):
+    """Refreshes the access token of a :class:`~fitapp.models.UserFitbit`.
+
+    Only one refresh per user is in flight at a time, across processes. If
+    another process is already refreshing the user's token, this waits for it
+    to finish and then uses the token it saved. Refresh tokens can only be
+    used once, so the new token is committed right away, outside of the
+    caller's transaction, if any, which may still be rolled back.
+    """
+    if not connection.in_atomic_block:
+        return _refresh_access_token(fbuser)
+    # A thread has its own database connection, outside of the transaction
+    token_user = copy.copy(fbuser)
+    run_in_thread(_refresh_access_token, token_user)
+    for field in UserFitbit.TOKEN_FIELDS:
+        setattr(fbuser, field, getattr(token_user, field))
+
+
+def _refresh_access_token(fbuser):
+    lock_id = '{0}-refresh-lock-{1}'.format(__name__, fbuser.fitbit_user)
+    old_refresh_token = fbuser.refresh_token
+    while not cache.add(lock_id, 'true', REFRESH_LOCK_EXPIRE):
+        time.sleep(REFRESH_POLL_INTERVAL)
+        fbuser.refresh_from_db(fields=UserFitbit.TOKEN_FIELDS)
+        if fbuser.refresh_token != old_refresh_token:
+            return
+    try:
+        # The token may have been refreshed before we got the lock
+        fbuser.refresh_from_db(fields=UserFitbit.TOKEN_FIELDS)
+        if fbuser.refresh_token == old_refresh_token:
+            fb = create_fitbit(**fbuser.get_user_data())
+            fb.client.refresh_token()
+    finally:
+        # The new token has been committed by refresh_cb
+        cache.delete(lock_id)
+
+
+def run_in_thread(func, *args):
+    """Calls ``func`` in a new thread and waits for its result, so that its
+    database queries run on their own connection, in autocommit mode.
+    Exceptions are raised again in the calling thread.
+    """
+    result = {}
+
+    def run():
+        try:
+            result['value'] = func(*args)
+        except Exception:
+            result['error'] = sys.exc_info()
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    if 'error' in result:
+        reraise(*result['error'])
+    return result.get('value')
 
 
 def is_integrated(user):
@@ -33,22 +324,129 @@ def is_integrated(user):
 
     This does not require that the token and secret are valid.
 
+    The result is remembered on the user object, so that it is looked up at
+    most once per request, and in the Django cache until the user's
+    :class:`~fitapp.models.UserFitbit` is saved or deleted.
+
     :param user: A Django User.
     """
     if user.is_authenticated() and user.is_active:
-        return UserFitbit.objects.filter(user=user).exists()
+        integrated = getattr(user, '_fitapp_integrated', None)
+        if integrated is None:
+            key = INTEGRATED_CACHE_KEY.format(user.pk)
+            integrated = cache.get(key)
+            if integrated is None:
+                integrated = UserFitbit.objects.filter(user=user).exists()
+                cache.set(key, integrated, INTEGRATED_CACHE_EXPIRE)
+            user._fitapp_integrated = integrated
+        return integrated
     return False
 
 
+def forget_integrated(user):
+    """Forgets the integration status remembered on the user object by
+    :func:`is_integrated`, after the user's
+    :class:`~fitapp.models.UserFitbit` has been saved or deleted during the
+    request.
+
+    :param user: A Django User.
+    """
+    try:
+        del user._fitapp_integrated
+    except AttributeError:
+        pass
+
+
 def get_valid_periods():
     """Returns list of periods for which one may request time series data."""
     return ['1d', '7d', '30d', '1w', '1m', '3m', '6m', '1y', 'max']
 
 
+def get_fetch_priority(date=None):
+    """Returns the celery task priority for retrieving data for a date.
+
+    Data for today (or yesterday, to allow for the user's time zone) gets the
+    highest priority, then data for the last :ref:`FITAPP_RECENT_DAYS` days.
+    Historical data, including an import of all data when no date is given,
+    gets the lowest priority. The priorities are taken from
+    :ref:`FITAPP_TASK_PRIORITIES`.
+    """
+    if hasattr(settings, 'FITAPP_BETWEEN_DELAY'):
+        warnings.warn(
+            'FITAPP_BETWEEN_DELAY is deprecated and ignored, data is '
+            'retrieved by priority instead, see FITAPP_TASK_PRIORITIES',
+            DeprecationWarning)
+    priorities = get_setting('FITAPP_TASK_PRIORITIES')
+    if date is None:
+        return priorities['historical']
+    if isinstance(date, datetime):
+        date = date.date()
+    age = (timezone.now().date() - date).days
+    if age <= 1:
+        return priorities['today']
+    if age <= get_setting('FITAPP_RECENT_DAYS'):
+        return priorities['recent']
+    return priorities['historical']
+
+
+def get_queue_options(name):
+    """Returns the celery options for sending a task to a fitapp queue.
+
+    ``name`` is one of the keys of :ref:`FITAPP_QUEUES`. If no queue is
+    configured for it, no options are returned, so that celery's default
+    routing applies.
+    """
+    queue = get_setting('FITAPP_QUEUES')[name]
+    return {'queue': queue} if queue else {}
+
+
+def get_subscribed_types():
+    """Returns the types of time series data to retrieve for each user, all
+    of them or those in :ref:`FITAPP_SUBSCRIPTIONS`, in its order.
+    """
+    subs = get_setting('FITAPP_SUBSCRIPTIONS')
+    tsdts = TimeSeriesDataType.objects.all()
+    if subs is None:
+        return list(tsdts)
+    cats = [getattr(TimeSeriesDataType, k) for k in subs.keys()]
+    # Combine all the resource sublists from FITAPP_SUBSCRIPTIONS
+    res = [res for _, sublist in subs.items() for res in sublist]
+    tsdts = tsdts.filter(category__in=cats, resource__in=res)
+    # Sort as specified in FITAPP_SUBSCRIPTIONS
+    return sorted(tsdts, key=lambda tsdt: (
+        cats.index(tsdt.category) + res.index(tsdt.resource)
+    ))
+
+
+def get_subscriptions(fb, fitbit_user, refresh=False):
+    """Returns the Fitbit subscriptions of a user.
+
+    ``fb`` is a Fitbit instance authorized as the user. The listing is cached
+    for an hour, unless ``refresh`` is true, and should be forgotten with
+    :func:`forget_subscriptions` after changing the user's subscriptions.
+    """
+    key = SUBSCRIPTIONS_CACHE_KEY.format(fitbit_user)
+    subscriptions = None if refresh else cache.get(key)
+    if subscriptions is None:
+        subscriptions = [
+            sub for sub in fb.list_subscriptions()['apiSubscriptions']
+            if sub['ownerId'] == fitbit_user
+        ]
+        cache.set(key, subscriptions, SUBSCRIPTIONS_CACHE_EXPIRE)
+    return subscriptions
+
+
+def forget_subscriptions(fitbit_user):
+    """Forgets the cached subscription listing of a user"""
+    cache.delete(SUBSCRIPTIONS_CACHE_KEY.format(fitbit_user))
+
+
 def get_fitbit_data(fbuser, resource_type, base_date=None, period=None,
-                    end_date=None):
+                    end_date=None, timeout=None):
     """Creates a Fitbit API instance and retrieves step data for the period.
 
+    If ``timeout`` is given, the API call gives up after that many seconds.
+
     Several exceptions may be thrown:
         TypeError           - Either end_date or period must be specified, but
                               not both.
@@ -61,15 +459,293 @@ def get_fitbit_data(fbuser, resource_type, base_date=None, period=None,
         HTTPTooManyRequests - 429 - Hitting the rate limit
         HTTPServerError     - >=500 - Fitbit server error or maintenance.
         HTTPBadRequest      - >=400 - Bad request.
+        Timeout             - The API call took longer than ``timeout``.
+        CircuitOpenError    - Fitbit is failing, see circuit_breaker.
     """
-    fb = create_fitbit(**fbuser.get_user_data())
+    if fbuser.expires_at < time.time():
+        refresh_access_token(fbuser)
+    fb = create_fitbit(timeout=timeout, **fbuser.get_user_data())
     resource_path = resource_type.path()
-    data = fb.time_series(resource_path, user_id=fbuser.fitbit_user,
-                          period=period, base_date=base_date,
-                          end_date=end_date)
+    with circuit_breaker():
+        data = fb.time_series(resource_path, user_id=fbuser.fitbit_user,
+                              period=period, base_date=base_date,
+                              end_date=end_date)
     return data[resource_path.replace('/', '-')]
 
 
+def save_time_series_data(user, resource_type, data):
+    """Stores time series data retrieved from the Fitbit API for a user,
+    creating or updating a :class:`~fitapp.models.TimeSeriesData` for each
+    ``{'dateTime': ..., 'value': ...}`` item of ``data``.
+    """
+    resource = resource_type.path()
+    values = dict(
+        (parser.parse(datum['dateTime']).date(), datum['value'])
+        for datum in data)
+    written = 0
+    with metrics.timed('db_write', resource=resource):
+        if values:
+            try:
+                written = _save_values(user, resource_type, values)
+            except IntegrityError:
+                # Some of the rows were created in the meantime, so they are
+                # updated instead on the second attempt
+                written = _save_values(user, resource_type, values)
+    metrics.increment('rows_written', written, resource=resource)
+
+
+def _save_values(user, resource_type, values):
+    # The stored rows are read in one query, and the new and changed ones
+    # written in bulk, so that the number of queries doesn't grow with the
+    # number of days. Returns the number of rows created or changed.
+    with transaction.atomic():
+        stored = dict(
+            (date, (pk, value)) for pk, date, value in
+            TimeSeriesData.objects.filter(
+                user=user, resource_type=resource_type,
+                date__gte=min(values), date__lte=max(values),
+            ).values_list('pk', 'date', 'value'))
+        created = TimeSeriesData.objects.bulk_create([
+            TimeSeriesData(user=user, resource_type=resource_type, date=date,
+                           value=value)
+            for date, value in sorted(values.items()) if date not in stored])
+        written = len(created)
+        changed = sorted(
+            (stored[date][0], value) for date, value in values.items()
+            if date in stored and stored[date][1] != value)
+        for i in range(0, len(changed), UPDATE_BATCH_SIZE):
+            batch = changed[i:i + UPDATE_BATCH_SIZE]
+            written += TimeSeriesData.objects.filter(
+                pk__in=[pk for pk, value in batch],
+            ).update(value=Case(
+                *[When(pk=pk, then=Value(value)) for pk, value in batch],
+                output_field=TimeSeriesData._meta.get_field('value')))
+    return written
+
+
+def get_fitbit_intraday_data(fbuser, resource, date, detail_level):
+    """Creates a Fitbit API instance and retrieves a day of intraday data.
+
+    Returns the dataset of the day, a list of
+    ``{'time': 'HH:MM:SS', 'value': 123}`` dicts. The same exceptions as
+    :func:`get_fitbit_data` may be thrown.
+    """
+    if fbuser.expires_at < time.time():
+        refresh_access_token(fbuser)
+    fb = create_fitbit(**fbuser.get_user_data())
+    with circuit_breaker():
+        data = fb.intraday_time_series(
+            resource, base_date=date, detail_level=detail_level)
+    return data[resource.replace('/', '-') + '-intraday']['dataset']
+
+
+def find_time_series_gaps(since, until):
+    """Returns the missing ranges of stored time series data.
+
+    The result is a list of ``(user_id, resource_type_id, start, end)``
+    tuples, one for each range of dates between ``since`` and ``until``
+    (inclusive) for which a user has no data of a type that they have data
+    for in that period, or that is retrieved for every integrated user, see
+    :func:`get_subscribed_types`. This includes the dates before the first
+    and after the last stored date. Months that have been moved to a
+    :class:`~fitapp.models.TimeSeriesDataArchive` aren't missing.
+
+    Gaps are found with a window function query on PostgreSQL, MySQL 8.0,
+    MariaDB 10.2 and SQLite 3.25 or later, or by reading the stored dates on
+    other databases.
+    """
+    data = TimeSeriesData.objects.filter(date__gte=since, date__lte=until)
+    condition = GAP_CONDITIONS.get(connection.vendor)
+    if condition is not None and has_window_functions():
+        sql = GAP_SQL.format(
+            table=TimeSeriesData._meta.db_table, condition=condition)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [since, until])
+            rows = cursor.fetchall()
+    else:
+        rows = _find_gaps(data.order_by(
+            'user_id', 'resource_type_id', 'date'
+        ).values_list('user_id', 'resource_type_id', 'date').iterator())
+
+    gaps = []
+    for user_id, type_id, prev_date, date in rows:
+        # Some database drivers return dates as strings
+        if isinstance(prev_date, string_types):
+            prev_date = parse_date(prev_date)
+        if isinstance(date, string_types):
+            date = parse_date(date)
+        gaps.append((user_id, type_id, prev_date + timedelta(days=1),
+                     date - timedelta(days=1)))
+    bounds = data.values('user_id', 'resource_type_id').annotate(
+        first_date=Min('date'), last_date=Max('date'))
+    stored = set()
+    for bound in bounds.order_by('user_id', 'resource_type_id'):
+        key = (bound['user_id'], bound['resource_type_id'])
+        stored.add(key)
+        if bound['first_date'] > since:
+            gaps.append(key + (since,
+                               bound['first_date'] - timedelta(days=1)))
+        if bound['last_date'] < until:
+            gaps.append(key + (bound['last_date'] + timedelta(days=1),
+                               until))
+    # Integrated users without any data of a type in the period
+    type_ids = [tsdt.pk for tsdt in get_subscribed_types()]
+    for user_id in UserFitbit.objects.values_list('user_id', flat=True):
+        for type_id in type_ids:
+            if (user_id, type_id) not in stored:
+                gaps.append((user_id, type_id, since, until))
+
+    archived = set(TimeSeriesDataArchive.objects.filter(
+        month__gte=since.replace(day=1), month__lte=until
+    ).values_list('user_id', 'resource_type_id', 'month'))
+    if archived:
+        gaps = list(_exclude_archived(gaps, archived))
+    return sorted(gaps)
+
+
+def has_window_functions():
+    """Returns whether the database supports the ``LAG()`` window function
+    of the gap query
+    """
+    if connection.vendor == 'sqlite':
+        return sqlite3.sqlite_version_info >= (3, 25, 0)
+    if connection.vendor == 'mysql':
+        with connection.temporary_connection():
+            server_info = connection.connection.get_server_info()
+        if 'mariadb' in server_info.lower():
+            return connection.mysql_version >= (10, 2)
+        return connection.mysql_version >= (8, 0)
+    return True
+
+
+def _exclude_archived(gaps, archived):
+    for user_id, type_id, start, end in gaps:
+        gap_start = None
+        day = start
+        while day <= end:
+            month = day.replace(day=1)
+            next_month = (month + timedelta(days=32)).replace(day=1)
+            if (user_id, type_id, month) not in archived:
+                gap_start = gap_start or day
+            elif gap_start is not None:
+                yield user_id, type_id, gap_start, day - timedelta(days=1)
+                gap_start = None
+            day = next_month
+        if gap_start is not None:
+            yield user_id, type_id, gap_start, end
+
+
+def _find_gaps(rows):
+    prev = None
+    for user_id, type_id, date in rows:
+        if prev is not None and prev[:2] == (user_id, type_id) and \
+                (date - prev[2]).days > 1:
+            yield user_id, type_id, prev[2], date
+        prev = (user_id, type_id, date)
+
+
+class QueryBudget(object):
+    """Logs a warning when a block of code makes more database queries than
+    its budget in :ref:`FITAPP_QUERY_BUDGETS`, if
+    :ref:`FITAPP_LOG_QUERY_BUDGETS` is True.
+
+    Use :func:`query_budget` to create one, as a context manager or a view
+    decorator. The block can add the number of rows it handles to ``rows``,
+    for budgets that allow a number of queries per row. The number of queries
+    made is counted in ``queries``.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.queries = 0
+
+    def __enter__(self):
+        self.enabled = get_setting('FITAPP_LOG_QUERY_BUDGETS')
+        if self.enabled:
+            # Count the block's queries with a wrapper around the connection's
+            # debug cursors, rather than in its log, which only keeps the last
+            # queries_limit queries
+            self.connection = connections[DEFAULT_DB_ALIAS]
+            self.force_debug_cursor = self.connection.force_debug_cursor
+            self.make_debug_cursor = self.connection.__dict__.get(
+                'make_debug_cursor')
+            make_debug_cursor = self.connection.make_debug_cursor
+            self.connection.make_debug_cursor = lambda cursor: QueryCounter(
+                make_debug_cursor(cursor), self.connection, self)
+            self.connection.force_debug_cursor = True
+        return self
+
+    def __exit__(self, *exc_info):
+        if not self.enabled:
+            return
+        self.connection.force_debug_cursor = self.force_debug_cursor
+        if self.make_debug_cursor is None:
+            del self.connection.make_debug_cursor
+        else:
+            self.connection.make_debug_cursor = self.make_debug_cursor
+        budget = get_query_budget(self.name, self.rows)
+        if self.queries > budget:
+            logger.warning(
+                '%s made %s database queries, over its budget of %s',
+                self.name, self.queries, budget)
+
+    def __call__(self, view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            with QueryBudget(self.name):
+                return view(*args, **kwargs)
+        return wrapper
+
+
+class QueryCounter(CursorWrapper):
+    """Counts the queries made with a cursor in a :class:`QueryBudget`"""
+
+    def __init__(self, cursor, db, budget):
+        super(QueryCounter, self).__init__(cursor, db)
+        self.budget = budget
+
+    def execute(self, sql, params=None):
+        self.budget.queries += 1
+        return super(QueryCounter, self).execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.budget.queries += 1
+        return super(QueryCounter, self).executemany(sql, param_list)
+
+
+def query_budget(name):
+    """Returns a :class:`QueryBudget` for the hot path ``name``"""
+    return QueryBudget(name)
+
+
+def get_query_budget(name, rows=0):
+    """Returns the number of database queries that the hot path ``name`` may
+    make when handling ``rows`` rows, see :ref:`FITAPP_QUERY_BUDGETS`.
+    """
+    queries, queries_per_row = get_setting('FITAPP_QUERY_BUDGETS')[name]
+    return queries + queries_per_row * rows
+
+
+def encode_cursor(date):
+    """Returns an opaque pagination cursor pointing just past ``date``."""
+    value = date.strftime('%Y-%m-%d').encode('utf8')
+    return base64.urlsafe_b64encode(value).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Returns the date encoded in a cursor made by :func:`encode_cursor`.
+
+    A ValueError is raised if the cursor is not valid.
+    """
+    try:
+        cursor = str(cursor)
+        value = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        return datetime.strptime(value.decode('utf8'), '%Y-%m-%d').date()
+    except (TypeError, binascii.Error, UnicodeError):
+        raise ValueError('Invalid cursor: {}'.format(cursor))
+
+
 def get_setting(name, use_defaults=True):
     """Retrieves the specified setting from the settings file.
 
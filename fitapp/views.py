@@ -1,12 +1,17 @@
-from functools import cmp_to_key
+import math
 import simplejson as json
 
+from collections import Counter
+from datetime import datetime
+
 from dateutil import parser
 from dateutil.relativedelta import relativedelta
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.signals import user_logged_in
 from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse
+from django.db.models import BinaryField, Max
+from django.db.models.functions import Substr
 from django.dispatch import receiver
 from django.http import HttpResponse, HttpResponseServerError, Http404
 from django.shortcuts import redirect, render
@@ -16,12 +21,16 @@ from django.views.decorators.http import require_GET
 from six import string_types
 
 from fitbit.exceptions import (HTTPUnauthorized, HTTPForbidden, HTTPConflict,
-                               HTTPServerError)
+                               HTTPServerError, Timeout)
 
 from . import forms
+from . import metrics
 from . import utils
-from .models import UserFitbit, TimeSeriesData, TimeSeriesDataType
-from .tasks import get_time_series_data, subscribe, unsubscribe
+from .models import (UserFitbit, IntradayTimeSeriesData, TimeSeriesData,
+                     TimeSeriesDataArchive, TimeSeriesDataType)
+from .tasks import (
+    get_intraday_time_series_data, get_time_series_data,
+    purge_time_series_data, subscribe, unsubscribe)
 
 
 @login_required
@@ -97,46 +106,38 @@ def complete(request):
         'refresh_token': token['refresh_token'],
         'expires_at': token['expires_at'],
     })
+    utils.forget_integrated(user)
 
     # Add the Fitbit user info to the session
     fb = utils.create_fitbit(**fbuser.get_user_data())
     request.session['fitbit_profile'] = fb.user_profile_get()
     if utils.get_setting('FITAPP_SUBSCRIBE'):
         init_delay = utils.get_setting('FITAPP_HISTORICAL_INIT_DELAY')
-        btw_delay = utils.get_setting('FITAPP_BETWEEN_DELAY')
         try:
-            subs = utils.get_setting('FITAPP_SUBSCRIPTIONS')
+            # If FITAPP_SUBSCRIPTIONS is specified, narrow the list of data
+            # types to retrieve
+            tsdts = utils.get_subscribed_types()
         except ImproperlyConfigured as e:
             return HttpResponseServerError(getattr(e, 'message', e.args[0]))
         try:
             SUBSCRIBER_ID = utils.get_setting('FITAPP_SUBSCRIBER_ID')
         except ImproperlyConfigured:
             return redirect(reverse('fitbit-error'))
-        subscribe.apply_async((fbuser.fitbit_user, SUBSCRIBER_ID), countdown=5)
-        tsdts = TimeSeriesDataType.objects.all()
-        # If FITAPP_SUBSCRIPTIONS is specified, narrow the list of data types
-        # to retrieve
-        if subs is not None:
-            cats = list(map(
-                lambda k: getattr(TimeSeriesDataType, k),
-                subs.keys()
-            ))
-            tsdts = tsdts.filter(category__in=cats)
-            # Combine all the resource sublists from FITAPP_SUBSCRIPTIONS
-            res = [res for _, sublist in subs.items() for res in sublist]
-            tsdts = tsdts.filter(resource__in=res)
-            # Sort as specified in FITAPP_SUBSCRIPTIONS
-            tsdts = sorted(tsdts, key=lambda tsdt: (
-                cats.index(tsdt.category) + res.index(tsdt.resource)
-            ))
-
-        # Create tasks for all data in all data types
+        subscribe.apply_async(
+            (fbuser.fitbit_user, SUBSCRIBER_ID), countdown=5,
+            **utils.get_queue_options('subscriptions'))
+
+        # Create tasks for all data in all data types, with the lowest
+        # priority so they don't hold up more recent data for other users
+        priority = utils.get_fetch_priority()
+        options = utils.get_queue_options('backfill')
+        # Pace the tasks if the user is running low on API quota
+        delay = utils.get_rate_limit_delay(fbuser.fitbit_user)
         for i, _type in enumerate(tsdts):
             # Delay execution for a few seconds to speed up response
-            # Offset each call a bit so they don't bog down the server
             get_time_series_data.apply_async(
                 (fbuser.fitbit_user, _type.category, _type.resource,),
-                countdown=init_delay + (i * btw_delay))
+                countdown=init_delay + i * delay, priority=priority, **options)
 
     next_url = request.session.pop('fitbit_next', None) or utils.get_setting(
         'FITAPP_LOGIN_REDIRECT')
@@ -149,9 +150,9 @@ def create_fitbit_session(sender, request, user, **kwargs):
 
     if user.is_authenticated() and utils.is_integrated(user) and \
             user.is_active:
-        fbuser = UserFitbit.objects.filter(user=user)
-        if fbuser.exists():
-            fb = utils.create_fitbit(**fbuser[0].get_user_data())
+        fbuser = UserFitbit.objects.filter(user=user).first()
+        if fbuser is not None:
+            fb = utils.create_fitbit(**fbuser.get_user_data())
             try:
                 request.session['fitbit_profile'] = fb.user_profile_get()
             except:
@@ -188,6 +189,9 @@ def error(request):
 def logout(request):
     """Forget this user's Fitbit credentials.
 
+    If :ref:`FITAPP_PURGE_DATA` is True, a task is also queued to delete the
+    user's time series data in the background.
+
     If the request has a `next` parameter, the user is redirected to that URL.
     Otherwise, they're redirected to the URL defined in the setting
     :ref:`FITAPP_LOGOUT_REDIRECT`.
@@ -209,14 +213,26 @@ def logout(request):
             kwargs = fbuser.get_user_data()
             # The refresh callback is not desired since the user will be gone
             del kwargs['refresh_cb']
-            unsubscribe.apply_async(kwargs=kwargs, countdown=5)
+            unsubscribe.apply_async(
+                kwargs=kwargs, countdown=5,
+                **utils.get_queue_options('subscriptions'))
         fbuser.delete()
+        utils.forget_integrated(user)
+        if utils.get_setting('FITAPP_PURGE_DATA'):
+            # Only purge the data stored until now, in case the user
+            # integrates again before the purge runs
+            last_pk = TimeSeriesData.objects.filter(user=user).aggregate(
+                last_pk=Max('pk'))['last_pk']
+            purge_time_series_data.apply_async(
+                (user.id, last_pk), countdown=5,
+                **utils.get_queue_options('backfill'))
     next_url = request.GET.get('next', None) or utils.get_setting(
         'FITAPP_LOGOUT_REDIRECT')
     return redirect(next_url)
 
 
 @csrf_exempt
+@utils.query_budget('update')
 def update(request):
     """Receive notification from Fitbit or verify subscriber endpoint.
 
@@ -252,32 +268,55 @@ def update(request):
         try:
             # Create a celery task for each data type in the update
             subs = utils.get_setting('FITAPP_SUBSCRIPTIONS')
-            btw_delay = utils.get_setting('FITAPP_BETWEEN_DELAY')
             all_tsdts = list(TimeSeriesDataType.objects.all())
+            intraday_resources = utils.get_setting(
+                'FITAPP_INTRADAY_RESOURCES')
+            options = utils.get_queue_options('realtime')
+            dispatched = Counter()
             for update in updates:
                 c_type = update['collectionType']
                 if subs is not None and c_type not in subs:
                     continue
                 cat = getattr(TimeSeriesDataType, c_type)
-                tsdts = filter(lambda tsdt: tsdt.category == cat, all_tsdts)
+                tsdts = [tsdt for tsdt in all_tsdts if tsdt.category == cat]
                 if subs is not None:
                     res_list = subs[c_type]
                     tsdts = sorted(
                         filter(lambda tsdt: tsdt.resource in res_list, tsdts),
                         key=lambda tsdt: res_list.index(tsdt.resource)
                     )
+                date = parser.parse(update['date'])
+                # Prioritize the most recent data, so it isn't held up by
+                # historical data
+                priority = utils.get_fetch_priority(date)
+                # Pace the tasks if the user is running low on API quota
+                delay = utils.get_rate_limit_delay(update['ownerId'])
                 for i, _type in enumerate(tsdts):
-                    # Offset each call by a few seconds so they don't bog down
-                    # the server
                     get_time_series_data.apply_async(
                         (update['ownerId'], _type.category, _type.resource,),
-                        {'date': parser.parse(update['date'])},
-                        countdown=(btw_delay * i))
+                        {'date': date}, countdown=i * delay,
+                        priority=priority, **options)
+                dispatched[get_time_series_data.name] += len(tsdts)
+                # Retrieve the collection type's intraday data too
+                intraday = [(resource, detail_level) for resource, detail_level
+                            in sorted(intraday_resources.items())
+                            if resource.split('/')[0] == c_type]
+                for i, (resource, detail_level) in enumerate(
+                        intraday, len(tsdts)):
+                    get_intraday_time_series_data.apply_async(
+                        (update['ownerId'], resource, date, detail_level),
+                        countdown=i * delay, priority=priority, **options)
+                dispatched[get_intraday_time_series_data.name] += len(
+                    intraday)
         except (KeyError, ValueError, OverflowError):
             raise Http404
         except ImproperlyConfigured as e:
             return HttpResponseServerError(getattr(e, 'message', e.args[0]))
 
+        metrics.increment('notifications', len(updates))
+        for task, count in dispatched.items():
+            if count:
+                metrics.increment('tasks_dispatched', count, task=task)
         return HttpResponse(status=204)
     elif request.method == 'GET':
         # Verify fitbit subscriber endpoints
@@ -290,16 +329,97 @@ def update(request):
     raise Http404
 
 
-def make_response(code=None, objects=[]):
+def make_response(code=None, objects=[], **meta):
     """AJAX helper method to generate a response"""
 
+    meta.update({'total_count': len(objects), 'status_code': code})
     data = {
-        'meta': {'total_count': len(objects), 'status_code': code},
+        'meta': meta,
         'objects': objects,
     }
     return HttpResponse(json.dumps(data))
 
 
+def typed_value(value):
+    """Convert a Fitbit value string to a number, when it is one"""
+
+    for number_type in (int, float):
+        try:
+            number = number_type(value)
+        except (TypeError, ValueError):
+            continue
+        if not (math.isinf(number) or math.isnan(number)):
+            return number
+    return value
+
+
+def make_columnar_response(code, days, **meta):
+    """AJAX helper method to generate a compact, columnar response.
+
+    ``days`` is a list of (date, value) pairs, ordered by date. The objects of
+    the response are the typed values for every day from the first date to
+    the last, with nulls for the missing days, and the first date is included
+    in the meta as *start_date*.
+    """
+
+    values = []
+    start_date = None
+    if days:
+        start_date = days[0][0]
+        values = [None] * ((days[-1][0] - start_date).days + 1)
+        for date, value in days:
+            values[(date - start_date).days] = typed_value(value)
+        start_date = start_date.strftime('%Y-%m-%d')
+    meta.update({'format': 'columnar', 'start_date': start_date})
+    return make_response(code, values, **meta)
+
+
+def get_stored_days(user, resource_type, date_range, after=None, limit=None):
+    """Returns the stored (date, value) pairs of a user's data, ordered by
+    date, merging the live data with archived months of data.
+
+    ``date_range`` is the result of :func:`normalize_date_range`. Only the
+    days after ``after`` are returned, if it is given, and at most ``limit``
+    days. With a ``limit``, the archived months are read in order only until
+    ``limit`` days have been found.
+    """
+
+    live = TimeSeriesData.objects.filter(
+        user=user, resource_type=resource_type, **date_range
+    ).order_by('date').values_list('date', 'value')
+    if after:
+        live = live.filter(date__gt=after)
+    if limit:
+        live = live[:limit]
+    days = dict(live)
+
+    start = parser.parse(str(date_range['date__gte'])).date()
+    if after:
+        start = max(start, after + relativedelta(days=1))
+    archives = TimeSeriesDataArchive.objects.filter(
+        user=user, resource_type=resource_type,
+        month__gte=start.replace(day=1)).order_by('month')
+    end = date_range.get('date__lte')
+    if end:
+        end = parser.parse(str(end)).date()
+        archives = archives.filter(month__lte=end)
+    if limit and len(days) == limit:
+        # The page ends at the last live day at the latest
+        archives = archives.filter(month__lte=max(days))
+    for archive in archives.iterator():
+        for date, value in archive.days():
+            if date >= start and (not end or date <= end):
+                # Live data takes precedence over archived data
+                days.setdefault(date, value)
+        if limit:
+            next_month = archive.month + relativedelta(months=1)
+            if sum(1 for date in days if date < next_month) >= limit:
+                # Later months can't be part of the page
+                break
+    days = sorted(days.items())
+    return days[:limit] if limit else days
+
+
 def normalize_date_range(request, fitbit_data):
     """Prepare a fitbit date range for django database access. """
 
@@ -350,6 +470,8 @@ def get_steps(request):
 
 
 @require_GET
+@metrics.timed_view('get_data')
+@utils.query_budget('get_data')
 def get_data(request, category, resource):
     """An AJAX view that retrieves this user's data from Fitbit.
 
@@ -377,6 +499,16 @@ def get_data(request, category, resource):
         :base_date: The first day of the range, in the format 'yyyy-mm-dd'.
         :end_date: The final day of the range, in the format 'yyyy-mm-dd'.
 
+    When :ref:`FITAPP_SUBSCRIBE` is True, the data can be retrieved in pages
+    using two more optional GET parameters:
+
+        :limit: The maximum number of days to return. This is capped at, and
+            defaults to, :ref:`FITAPP_MAX_PAGE_SIZE` when that is set.
+        :cursor: The *next* value from the meta of the previous page.
+
+    The optional *format* GET parameter can be set to 'columnar' to get a
+    more compact response, described below.
+
     The response body contains a JSON-encoded map with two items:
 
         :objects: an ordered list (from oldest to newest) of daily data
@@ -386,7 +518,14 @@ def get_data(request, category, resource):
 
            where the user has *value* on *dateTime*.
         :meta: a map containing two things: the *total_count* of objects, and
-            the *status_code* of the response.
+            the *status_code* of the response. When the response is
+            paginated, it also contains *next*, a cursor for the following
+            page, which is null on the last page.
+
+    In the columnar format, *objects* is instead a list of the values for
+    each consecutive day, converted to numbers where possible, with nulls for
+    days without data. The first day is given by the *start_date* in the
+    meta, which is null when there is no data.
 
     When everything goes well, the *status_code* is 100 and the requested data
     is included. However, there are a number of things that can 'go wrong'
@@ -403,7 +542,10 @@ def get_data(request, category, resource):
             1w, 1m, 3m, 6m, 1y, max], and dates should be of the format
             'yyyy-mm-dd'.
         :105: User exceeded the Fitbit limit of 150 calls/hour.
-        :106: Fitbit error - please try again soon.
+        :106: Fitbit error, or Fitbit didn't respond within
+            :ref:`FITAPP_LIVE_DATA_TIMEOUT`, or calls to Fitbit are
+            suspended because it is failing (see
+            :ref:`FITAPP_CIRCUIT_BREAKER_THRESHOLD`) - please try again soon.
 
     See also the `Fitbit API doc for Get Time Series
     <https://wiki.fitbit.com/display/API/API-Get-Time-Series>`_.
@@ -441,26 +583,56 @@ def get_data(request, category, resource):
     if not fitbit_data:
         return make_response(104)
 
+    response_format = request.GET.get('format', None)
+    if response_format not in (None, 'columnar'):
+        return make_response(104)
+
     if fitapp_subscribe:
+        page = forms.PageForm({
+            'limit': request.GET.get('limit', None),
+            'cursor': request.GET.get('cursor', None),
+        }).get_page()
+        if not page:
+            return make_response(104)
+
         # Get the data directly from the database.
         date_range = normalize_date_range(request, fitbit_data)
-        existing_data = TimeSeriesData.objects.filter(
-            user=user, resource_type=resource_type, **date_range)
-        simplified_data = [{'value': d.value, 'dateTime': d.string_date()}
-                           for d in existing_data]
-        return make_response(100, simplified_data)
-
-    # Request data through the API and handle related errors.
+        meta = {}
+        if page['limit']:
+            # Fetch one extra day to find out if there is a following page
+            days = get_stored_days(user, resource_type, date_range,
+                                   page['cursor'], page['limit'] + 1)
+            meta['next'] = None
+            if len(days) > page['limit']:
+                days = days[:page['limit']]
+                meta['next'] = utils.encode_cursor(days[-1][0])
+        else:
+            days = get_stored_days(
+                user, resource_type, date_range, page['cursor'])
+        if response_format == 'columnar':
+            return make_columnar_response(100, days, **meta)
+        simplified_data = [
+            {'value': value, 'dateTime': date.strftime('%Y-%m-%d')}
+            for date, value in days]
+        return make_response(100, simplified_data, **meta)
+
+    # Request data through the API and handle related errors. Don't tie up
+    # the web worker for longer than FITAPP_LIVE_DATA_TIMEOUT when Fitbit is
+    # slow to respond.
     fbuser = UserFitbit.objects.get(user=user)
     try:
-        data = utils.get_fitbit_data(fbuser, resource_type, **fitbit_data)
+        data = utils.get_fitbit_data(
+            fbuser, resource_type,
+            timeout=utils.get_setting('FITAPP_LIVE_DATA_TIMEOUT'),
+            **fitbit_data)
     except (HTTPUnauthorized, HTTPForbidden):
         # Delete invalid credentials.
         fbuser.delete()
+        utils.forget_integrated(user)
         return make_response(103)
     except HTTPConflict:
         return make_response(105)
-    except HTTPServerError:
+    except (HTTPServerError, Timeout, utils.CircuitOpenError):
         return make_response(106)
     except:
         # Other documented exceptions include TypeError, ValueError,
@@ -468,4 +640,81 @@ def get_data(request, category, resource):
         # send a 500 and check it out.
         raise
 
+    if response_format == 'columnar':
+        return make_columnar_response(100, [(
+            datetime.strptime(d['dateTime'], '%Y-%m-%d').date(), d['value']
+        ) for d in data])
     return make_response(100, data)
+
+
+@require_GET
+def get_intraday_data(request, category, resource):
+    """An AJAX view that retrieves a day of this user's stored intraday data.
+
+    Intraday data is retrieved from Fitbit for the resources in
+    :ref:`FITAPP_INTRADAY_RESOURCES` when :ref:`FITAPP_SUBSCRIBE` is True,
+    and this view returns it from the database. The category and resource
+    parameters are the two parts of the resource path, e.g. activities and
+    heart. The following GET parameters are used:
+
+        :date: The day of the data, in the format 'yyyy-mm-dd'.
+        :detail_level: Optional, '1min' or '15min'. Defaults to the detail
+            level in :ref:`FITAPP_INTRADAY_RESOURCES`, or '1min'.
+        :start_time: Optional, the first time of day (in the format 'HH:MM')
+            to return. Defaults to the start of the day.
+        :end_time: Optional, the last time of day (in the format 'HH:MM') to
+            return. Defaults to the end of the day.
+
+    The response body contains a JSON-encoded map with two items:
+
+        :objects: a list of the values of each consecutive interval, with
+            nulls for intervals without data. An empty list is returned when
+            there is no data for the day.
+        :meta: a map containing the *total_count* of objects, the
+            *status_code* of the response, the *detail_level* of the data,
+            and the *start_time* of the first interval (or null when there is
+            no data).
+
+    The *status_code* is one of:
+
+        :100: OK - Response contains JSON data.
+        :101: User is not logged in.
+        :104: Invalid input parameters.
+
+    URL name:
+        `fitbit-intraday-data`
+    """
+
+    user = request.user
+    if not user.is_authenticated() or not user.is_active:
+        return make_response(101)
+
+    resource = '{}/{}'.format(category, resource)
+    detail_level = utils.get_setting('FITAPP_INTRADAY_RESOURCES').get(
+        resource, '1min')
+    data_slice = forms.IntradayForm(request.GET).get_slice(detail_level)
+    if not data_slice:
+        return make_response(104)
+
+    # Only read the bytes of the requested intervals from the database
+    size = IntradayTimeSeriesData.VALUE_SIZE
+    values = IntradayTimeSeriesData.objects.filter(
+        user=user, resource=resource, date=data_slice['date'],
+        detail_level=data_slice['detail_level'],
+    ).annotate(requested_values=Substr(
+        'values', data_slice['start'] * size + 1,
+        (data_slice['end'] - data_slice['start'] + 1) * size,
+        output_field=BinaryField(),
+    )).values_list('requested_values', flat=True).first()
+
+    start_time = None
+    if values is None:
+        values = []
+    else:
+        values = IntradayTimeSeriesData.unpack(values)
+        minutes = data_slice['start'] * IntradayTimeSeriesData.DETAIL_LEVELS[
+            data_slice['detail_level']]
+        start_time = '{:02d}:{:02d}'.format(minutes // 60, minutes % 60)
+    return make_response(
+        100, values, detail_level=data_slice['detail_level'],
+        start_time=start_time)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+Runs fitapp's benchmarks in a test database and writes the results as JSON.
+
+    ./run_benchmarks.py [--database sqlite|postgresql] [--repeat N]
+                        [--broker memory|eager] [--users N] [--quick]
+                        [--output FILE] [suite ...]
+
+The suites are the modules of the benchmarks package, all of them by
+default. The PostgreSQL database is configured with the standard PGDATABASE,
+PGUSER, PGPASSWORD, PGHOST and PGPORT environment variables.
+"""
+
+import django
+import importlib
+import json
+import optparse
+import os
+import platform
+import sys
+
+from datetime import datetime
+
+from django.conf import settings
+
+if not settings.configured:
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "test_settings")
+
+
+SUITES = ['ingestion', 'webhook', 'reads']
+DATABASES = {
+    'sqlite': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'fitapp_benchmarks',
+    },
+    'postgresql': {
+        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        'NAME': os.environ.get('PGDATABASE', 'fitapp_benchmarks'),
+        'USER': os.environ.get('PGUSER', ''),
+        'PASSWORD': os.environ.get('PGPASSWORD', ''),
+        'HOST': os.environ.get('PGHOST', ''),
+        'PORT': os.environ.get('PGPORT', ''),
+    },
+}
+
+
+def run_benchmarks():
+    parser = optparse.OptionParser()
+    parser.add_option('--database', dest='database', default='sqlite',
+                      choices=sorted(DATABASES),
+                      help="the database to run against, sqlite (the "
+                      "default) or postgresql")
+    parser.add_option('--repeat', dest='repeat', type='int', default=3,
+                      help="the number of timed runs of each case")
+    parser.add_option('--broker', dest='broker', default='memory',
+                      choices=['eager', 'memory'],
+                      help="send celery tasks to an in-memory broker (the "
+                      "default) or run them eagerly")
+    parser.add_option('--users', dest='users', type='int', default=100,
+                      help="the number of users to store data for in the "
+                      "reads suite")
+    parser.add_option('--quick', dest='quick', action='store_true',
+                      default=False,
+                      help="only run small cases, to check that the "
+                      "benchmarks work")
+    parser.add_option('--output', dest='output', default=None,
+                      help="the file to write the results to, instead of "
+                      "stdout")
+    options, suites = parser.parse_args()
+    suites = suites or SUITES
+    unknown = set(suites) - set(SUITES)
+    if unknown:
+        parser.error('unknown suites: {}'.format(', '.join(sorted(unknown))))
+
+    settings.DATABASES = {'default': DATABASES[options.database]}
+    django.setup()
+
+    from django.db import connection
+    from django.test.runner import DiscoverRunner
+
+    import fitapp
+
+    runner = DiscoverRunner(verbosity=0, interactive=False)
+    old_config = runner.setup_databases()
+    try:
+        results = []
+        for suite in suites:
+            sys.stderr.write('Running {}...\n'.format(suite))
+            module = importlib.import_module('benchmarks.' + suite)
+            results.extend(module.run(options))
+    finally:
+        runner.teardown_databases(old_config)
+
+    report = {
+        'meta': {
+            'fitapp': fitapp.__version__,
+            'django': django.get_version(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'repeat': options.repeat,
+            'broker': options.broker,
+            'users': options.users,
+            'quick': options.quick,
+            'timestamp': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        },
+        'results': results,
+    }
+    output = open(options.output, 'w') if options.output else sys.stdout
+    try:
+        json.dump(report, output, indent=2, sort_keys=True)
+        output.write('\n')
+    finally:
+        if options.output:
+            output.close()
+
+
+if __name__ == '__main__':
+    run_benchmarks()
@@ -7,7 +7,7 @@ setup(
     version=__import__("fitapp").__version__,
     author="orcas",
     author_email="developer@orcasinc.com",
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     install_requires=["setuptools"] + required,
     include_package_data=True,
     url="https://github.com/orcasgit/django-fitbit/",
@@ -34,6 +34,7 @@ LOGGING = {
     },
     'loggers': {
         'fitapp.tasks': {'handlers': ['null'], 'level': 'DEBUG'},
+        'fitapp.utils': {'handlers': ['null'], 'level': 'DEBUG'},
     },
 }
 